@@ -46,6 +46,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'subscription.routers.PrimaryPinningMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -87,6 +88,27 @@ DATABASES = {
     'default': dj_database_url.config(),
 }
 
+# Read replicas, as comma separated database URLs (i.e: DATABASE_REPLICA_URLS=postgres://...,postgres://...)
+SUBSCRIPTION_DATABASE_REPLICAS = []
+for number, replica_url in enumerate(filter(None, str(env('DATABASE_REPLICA_URLS', '')).split(',')), 1):
+    DATABASES['replica_{}'.format(number)] = dj_database_url.parse(replica_url.strip())
+    SUBSCRIPTION_DATABASE_REPLICAS.append('replica_{}'.format(number))
+
+# Shards holding the customers and their websites, as comma separated database URLs (DATABASE_SHARD_URLS),
+# only ever appended to. The default database keeps the plans and the ids sequence.
+SUBSCRIPTION_SHARDS = []
+for number, shard_url in enumerate(filter(None, str(env('DATABASE_SHARD_URLS', '')).split(',')), 1):
+    DATABASES['shard_{}'.format(number)] = dj_database_url.parse(shard_url.strip())
+    SUBSCRIPTION_SHARDS.append('shard_{}'.format(number))
+if SUBSCRIPTION_SHARDS:
+    AUTHENTICATION_BACKENDS = ['subscription.backends.ShardedModelBackend']
+
+DATABASE_ROUTERS = ['subscription.routers.ShardRouter', 'subscription.routers.PrimaryReplicaRouter']
+
+# Fraction of the requests measured by subscription.instrumentation.SQLInstrumentationMiddleware, once added
+# to MIDDLEWARE (i.e: SUBSCRIPTION_SQL_SAMPLE_RATE=0.05), each sampled request pays for the per query capture.
+SUBSCRIPTION_SQL_SAMPLE_RATE = float(env('SUBSCRIPTION_SQL_SAMPLE_RATE', 0.01))
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/dev/topics/i18n/
@@ -174,5 +196,10 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': False,
         },
+        'subscription': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
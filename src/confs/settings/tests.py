@@ -2,9 +2,33 @@ from .base import *
 
 SECRET_KEY='lHnABhdr8+:WUDV{P5g|dA%dl[K3w#,2/7EpC3br2o`5uHNZfa'
 
+# the databases outside the test runs (i.e: the makemigrations checks) are in memory, so they leave no files
+# behind, and have distinct names, since the test runner tells the databases apart by them
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': 'memory:'
-    }
+        'NAME': 'file:default?mode=memory',
+        # file based test database, so the tests using concurrent connections (i.e: threads) share it
+        'TEST': {'NAME': BASE_DIR.parent.child('test_subscription.sqlite')},
+    },
+    # only used by the database routing tests, that enable it as a replica
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'file:replica?mode=memory',
+        'TEST': {'MIRROR': 'default'},
+    },
+    # only used by the sharding tests, that enable them as SUBSCRIPTION_SHARDS
+    'shard_1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'file:shard_1?mode=memory',
+        'TEST': {'NAME': BASE_DIR.parent.child('test_subscription_shard_1.sqlite')},
+    },
+    'shard_2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'file:shard_2?mode=memory',
+        'TEST': {'NAME': BASE_DIR.parent.child('test_subscription_shard_2.sqlite')},
+    },
 }
+
+SUBSCRIPTION_DATABASE_REPLICAS = []
+SUBSCRIPTION_SHARDS = []
@@ -1,8 +1,136 @@
+from datetime import date, timedelta
+
 from django.contrib import admin
+from django.http import QueryDict
+from django.utils.translation import ugettext_lazy as _
 
-# Register your models here.
 from .models import Customer, Plan, Website
+from .pagination import EstimatedCountPaginator
+from .sharding import get_shard, get_shards, sharding_enabled
+
+
+class PlanTypeListFilter(admin.SimpleListFilter):
+    title = _('plan type')
+    parameter_name = 'plan_type'
+
+    def lookups(self, request, model_admin):
+        # the choices are fixed, so there's no need to query the distinct values over the customers table
+        return Plan.PLAN_TYPE_CHOICES
+
+    def queryset(self, request, queryset):
+        if self.value():
+            # filtering through the plan ids (instead of joining the plans) uses the customer subscription index
+            return queryset.filter(subscription__in=Plan.objects.filter(plan_type=self.value()).values('pk'))
+        return queryset
+
+
+class RenewalWindowListFilter(admin.SimpleListFilter):
+    title = _('renewal date')
+    parameter_name = 'renewal'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('overdue', _('overdue')),
+            ('week', _('next 7 days')),
+            ('month', _('next 30 days')),
+        )
+
+    def queryset(self, request, queryset):
+        today = date.today()
+        if self.value() == 'overdue':
+            return queryset.filter(subscription__isnull=False, sub_renewal_date__lt=today)
+        if self.value() == 'week':
+            return queryset.renewal_window(today, today + timedelta(days=7))
+        if self.value() == 'month':
+            return queryset.renewal_window(today, today + timedelta(days=30))
+        return queryset
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """
+    Picks the shard listed, one at a time (the first one by default), when sharding is enabled.
+    The queryset is sent to it by ShardedModelAdmin.get_queryset().
+    """
+    title = _('shard')
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        if sharding_enabled():
+            return [(shard, shard) for shard in get_shards()]
+
+    def choices(self, changelist):
+        # there's no "All" choice, the changelist can't span the shards
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': lookup == self.value() or (self.value() is None and lookup == get_shards()[0]),
+                'query_string': changelist.get_query_string({self.parameter_name: lookup}, []),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        return queryset
+
+
+class ShardedModelAdmin(admin.ModelAdmin):
+    """
+    ModelAdmin for the models placed by the customer shard, reading (and validating the related fields) from
+    the shard picked in the changelist (see ShardListFilter), which the change views keep in the preserved
+    filters. The saves and deletes go to the instance shard through ShardRouter.
+    """
+
+    def get_request_shard(self, request):
+        shards = get_shards()
+        shard = request.GET.get(ShardListFilter.parameter_name) or QueryDict(
+            request.GET.get('_changelist_filters', '')
+        ).get(ShardListFilter.parameter_name)
+        return shard if shard in shards else shards[0]
+
+    def get_list_filter(self, request):
+        return (ShardListFilter, *super().get_list_filter(request))
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return queryset.using(self.get_request_shard(request)) if sharding_enabled() else queryset
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if sharding_enabled():
+            # the plans are in every shard, the customers only in theirs
+            kwargs.setdefault('using', self.get_request_shard(request))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+@admin.register(Customer)
+class CustomerAdmin(ShardedModelAdmin):
+    # websites_count is the denormalized counter, so the column needs no annotation (nor GROUP BY) at all
+    list_display = ('username', 'email', 'plan', 'sub_renewal_date', 'websites_count', 'date_joined')
+    list_filter = (PlanTypeListFilter, RenewalWindowListFilter)
+    readonly_fields = ('websites_count', 'over_quota_since', 'blocked_for_quota')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def plan(self, customer):
+        # through the plan registry, so the changelist doesn't join (nor query) the plans
+        return customer.plan
+    plan.short_description = _('plan')
+    plan.admin_order_field = 'subscription'
+
+    def get_request_shard(self, request):
+        # the change views of a customer know its shard from the id
+        object_id = request.resolver_match.kwargs.get('object_id') if request.resolver_match else None
+        return get_shard(object_id) if object_id else super().get_request_shard(request)
+
+
+@admin.register(Plan)
+class PlanAdmin(admin.ModelAdmin):
+    list_display = ('name', 'plan_type', 'price', 'total_websites_allowed')
+    list_filter = ('plan_type',)
+
 
-admin.site.register(Customer)
-admin.site.register(Plan)
-admin.site.register(Website)
\ No newline at end of file
+@admin.register(Website)
+class WebsiteAdmin(ShardedModelAdmin):
+    list_display = ('url', 'customer')
+    list_select_related = ('customer',)
+    # a select with every customer doesn't scale
+    raw_id_fields = ('customer',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
@@ -0,0 +1,186 @@
+"""
+Cohort and churn analytics over the subscriptions history (SubscriptionChange).
+
+Periods are 'day', 'week' (starting on monday) or 'month', named by their first day. The reports cover
+whole periods, from the one of `start` to the one of `end` (default today), read from every shard and
+cached per period range: ranges of closed periods for good, the ones including the current period for
+settings.SUBSCRIPTION_ANALYTICS_CACHE_TIMEOUT seconds.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, DateField
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from .models import SubscriptionChange
+from .sharding import get_shards, scatter_gather
+
+DAY_PERIOD = 'day'
+WEEK_PERIOD = 'week'
+MONTH_PERIOD = 'month'
+PERIODS = (DAY_PERIOD, WEEK_PERIOD, MONTH_PERIOD)
+
+
+def get_period_start(day, period):
+    if period == MONTH_PERIOD:
+        return day.replace(day=1)
+    if period == WEEK_PERIOD:
+        return day - timedelta(days=day.weekday())
+    if period == DAY_PERIOD:
+        return day
+    raise ValueError('Unknown period ({})'.format(period))
+
+
+def get_next_period_start(day, period):
+    day = get_period_start(day, period)
+    if period == MONTH_PERIOD:
+        return (day + timedelta(days=32)).replace(day=1)
+    return day + timedelta(days=7 if period == WEEK_PERIOD else 1)
+
+
+def get_period_offset(start, day, period):
+    """The number of periods from the period starting on `start` to the one of `day`."""
+    day = get_period_start(day, period)
+    if period == MONTH_PERIOD:
+        return (day.year - start.year) * 12 + day.month - start.month
+    return (day - start).days // (7 if period == WEEK_PERIOD else 1)
+
+
+def to_datetime(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def get_range(period, start, end):
+    """The first day of the first period and the first day after the last one."""
+    end = end or timezone.localdate()
+    start = start or end - timedelta(days=365)
+    return get_period_start(start, period), get_next_period_start(end, period)
+
+
+def get_cache():
+    return caches[getattr(settings, 'SUBSCRIPTION_ANALYTICS_CACHE', 'default')]
+
+
+def cached_report(name, period, start, end, compute):
+    cache_key = 'subscription:analytics:{}:{}:{}:{}'.format(name, period, start.isoformat(), end.isoformat())
+    report = get_cache().get(cache_key)
+    if report is None:
+        report = compute()
+        # the closed periods don't change anymore
+        closed = end <= get_period_start(timezone.localdate(), period)
+        timeout = None if closed else getattr(settings, 'SUBSCRIPTION_ANALYTICS_CACHE_TIMEOUT', 300)
+        get_cache().set(cache_key, report, timeout)
+    return report
+
+
+def cohort_matrix(period=MONTH_PERIOD, start=None, end=None):
+    """
+    Returns the retention of the signup cohorts (the customers joined in the same period) per plan (the first
+    one they subscribed), {(cohort, plan_id): [customers, ...]}: the number of customers of the cohort that were
+    subscribed (to any plan) during each period since the one they joined, up to the `end` one.
+    """
+    start, end = get_range(period, start, end)
+    return cached_report('cohorts', period, start, end, lambda: compute_cohort_matrix(period, start, end))
+
+
+def compute_cohort_matrix(period, start, end):
+    matrix = {}
+    for shard_matrix in scatter_gather(lambda shard: stream_cohort_matrix(period, start, end, shard), get_shards()):
+        for key, row in shard_matrix.items():
+            totals = matrix.setdefault(key, [0] * len(row))
+            for offset, total in enumerate(row):
+                totals[offset] += total
+    return matrix
+
+
+def stream_cohort_matrix(period, start, end, using, chunk_size=2000):
+    """
+    Computes the cohort matrix of a database in a single pass over the history of its customers, streamed in
+    order (a customer at a time), so only the matrix itself is kept in memory whatever the number of customers.
+    """
+    until = min(timezone.now(), to_datetime(end))
+    last_day = timezone.localtime(until - timedelta(microseconds=1)).date()
+    changes = SubscriptionChange.objects.using(using).filter(
+        customer_joined__gte=to_datetime(start), customer_joined__lt=to_datetime(end), created__lt=until,
+    ).order_by('customer_id', 'created', 'pk').values_list('customer_id', 'customer_joined', 'new_plan_id', 'created')
+
+    matrix = {}
+
+    def add(history):
+        history.close(until)
+        if history.plan_id is not None:
+            row = matrix.setdefault(
+                (history.cohort, history.plan_id), [0] * (get_period_offset(history.cohort, last_day, period) + 1)
+            )
+            for offset in history.offsets:
+                row[offset] += 1
+
+    history = None
+    for customer_id, customer_joined, new_plan_id, created in changes.iterator(chunk_size=chunk_size):
+        if history is None or history.customer_id != customer_id:
+            if history is not None:
+                add(history)
+            history = CustomerHistory(customer_id, customer_joined, period)
+        history.change(new_plan_id, created)
+
+    if history is not None:
+        add(history)
+    return matrix
+
+
+class CustomerHistory:
+    """The periods (offsets from its cohort) a customer was subscribed in, built from its changes in order."""
+
+    def __init__(self, customer_id, customer_joined, period):
+        self.customer_id = customer_id
+        self.period = period
+        self.cohort = get_period_start(timezone.localtime(customer_joined).date(), period)
+        # the first plan subscribed
+        self.plan_id = None
+        self.current_plan_id = None
+        self.changed = None
+        self.offsets = set()
+
+    def change(self, new_plan_id, created):
+        self.close(created)
+        if self.plan_id is None:
+            self.plan_id = new_plan_id
+        self.current_plan_id, self.changed = new_plan_id, created
+
+    def close(self, ended):
+        """Adds the periods from the last change until `ended`, when the customer was subscribed."""
+        if self.current_plan_id is None or ended <= self.changed:
+            return
+        first = get_period_offset(self.cohort, timezone.localtime(self.changed).date(), self.period)
+        last = get_period_offset(
+            self.cohort, timezone.localtime(ended - timedelta(microseconds=1)).date(), self.period
+        )
+        self.offsets.update(range(first, last + 1))
+        self.changed = ended
+
+
+def churn_matrix(period=MONTH_PERIOD, start=None, end=None):
+    """
+    Returns the plan changes per period, {period: {(old_plan_id, new_plan_id): changes}}: the subscriptions
+    have no old plan, the cancellations no new plan. A grouped query per database.
+    """
+    start, end = get_range(period, start, end)
+    return cached_report('churn', period, start, end, lambda: compute_churn_matrix(period, start, end))
+
+
+def compute_churn_matrix(period, start, end):
+    def get_changes(using):
+        return list(SubscriptionChange.objects.using(using).filter(
+            created__gte=to_datetime(start), created__lt=to_datetime(end)
+        ).annotate(period=Trunc('created', period, output_field=DateField())).order_by().values_list(
+            'period', 'old_plan_id', 'new_plan_id'
+        ).annotate(total=Count('pk')))
+
+    matrix = defaultdict(lambda: defaultdict(int))
+    for changes in scatter_gather(get_changes, get_shards()):
+        for changed, old_plan_id, new_plan_id, total in changes:
+            matrix[changed][(old_plan_id, new_plan_id)] += total
+    return {changed: dict(changes) for changed, changes in matrix.items()}
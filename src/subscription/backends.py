@@ -0,0 +1,28 @@
+from django.contrib.auth.backends import ModelBackend
+
+from .models import Customer
+from .sharding import scatter_gather
+
+
+class ShardedModelBackend(ModelBackend):
+    """
+    Authentication backend finding the customers in their shard (settings.AUTHENTICATION_BACKENDS),
+    the usernames are looked up in every shard.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(Customer.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+
+        customers = scatter_gather(
+            lambda shard: Customer._default_manager.using(shard).filter(**{Customer.USERNAME_FIELD: username}).first()
+        )
+        for customer in filter(None, customers):
+            if customer.check_password(password) and self.user_can_authenticate(customer):
+                return customer
+
+    def get_user(self, user_id):
+        customer = Customer._default_manager.on_shard(user_id).filter(pk=user_id).first()
+        return customer if self.user_can_authenticate(customer) else None
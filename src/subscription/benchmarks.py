@@ -0,0 +1,168 @@
+"""
+Micro benchmarks of the subscription hot paths: subscribe_plan, change_plan, Website.save() and
+can_add_website(). Every path records the wall time, the queries and the rows touched per operation,
+see the run_benchmarks management command to seed a dataset, store the results and compare them.
+"""
+import json
+import math
+import random
+import time
+from contextlib import contextmanager
+
+from django.db import connections
+
+from .models import Customer, Plan, Website
+
+
+class OperationStats:
+    """Collects the queries, rows touched and wall time of the operations run inside measure()."""
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.durations = []
+        self.queries = 0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        self.queries += 1
+        cursor = context['cursor']
+        if cursor.cursor.description is None:
+            # the writes report the rows they touched
+            self.rows += max(cursor.cursor.rowcount, 0)
+        else:
+            # the rowcount of the SELECTs isn't available on every backend (i.e: -1 on sqlite), the rows
+            # fetched are counted instead
+            self.count_fetched_rows(cursor)
+        return result
+
+    def count_fetched_rows(self, cursor):
+        """Wraps the fetch methods of the (Django) cursor, adding the rows they return to the rows touched."""
+        if 'fetchmany' in vars(cursor):
+            return
+
+        def counting(fetch, count):
+            def wrapper(*args, **kwargs):
+                rows = fetch(*args, **kwargs)
+                self.rows += count(rows)
+                return rows
+            return wrapper
+
+        cursor.fetchone = counting(cursor.fetchone, lambda row: int(row is not None))
+        cursor.fetchmany = counting(cursor.fetchmany, len)
+        cursor.fetchall = counting(cursor.fetchall, len)
+
+    @contextmanager
+    def measure(self):
+        with connections[self.using].execute_wrapper(self):
+            started = time.perf_counter()
+            yield
+            self.durations.append(time.perf_counter() - started)
+
+    def as_dict(self):
+        durations = sorted(self.durations)
+        iterations = len(durations) or 1
+        return {
+            'iterations': len(durations),
+            'total_seconds': sum(durations),
+            'mean_ms': sum(durations) / iterations * 1000,
+            # nearest rank percentile
+            'p95_ms': durations[math.ceil(len(durations) * 0.95) - 1] * 1000 if durations else 0,
+            'queries_per_op': self.queries / iterations,
+            'rows_per_op': self.rows / iterations,
+        }
+
+
+def benchmark_can_add_website(customers, plans, iterations, using):
+    stats = OperationStats(using)
+    for customer in Customer.objects.using(using).filter(pk__in=customers[:iterations]):
+        with stats.measure():
+            customer.can_add_website()
+    return stats
+
+
+def benchmark_website_save(customers, plans, iterations, using):
+    stats = OperationStats(using)
+    unlimited = list(Customer.objects.using(using).filter(
+        pk__in=customers, subscription__plan_type='infinite'
+    )[:iterations])
+    for number in range(iterations if unlimited else 0):
+        website = Website(
+            url='https://benchmark{}.example.com'.format(number), customer=unlimited[number % len(unlimited)]
+        )
+        with stats.measure():
+            website.save(using=using)
+    return stats
+
+
+def benchmark_subscribe_plan(customers, plans, iterations, using):
+    stats = OperationStats(using)
+    for number, customer_id in enumerate(customers[:iterations]):
+        Customer.objects.using(using).filter(pk=customer_id).update(subscription=None, sub_renewal_date=None)
+        customer = Customer.objects.using(using).get(pk=customer_id)
+        with stats.measure():
+            Customer.with_subscriptions.db_manager(using).subscribe_plan(customer, plans[number % len(plans)])
+    return stats
+
+
+def benchmark_change_plan(customers, plans, iterations, using):
+    stats = OperationStats(using)
+    for customer in Customer.objects.using(using).filter(pk__in=customers[:iterations]):
+        new_plan = next(plan for plan in plans if plan.pk != customer.subscription_id)
+        with stats.measure():
+            Customer.with_subscriptions.db_manager(using).change_plan(customer, new_plan)
+    return stats
+
+
+HOT_PATHS = {
+    'can_add_website': benchmark_can_add_website,
+    'website_save': benchmark_website_save,
+    'subscribe_plan': benchmark_subscribe_plan,
+    'change_plan': benchmark_change_plan,
+}
+
+
+def run_benchmarks(iterations=100, seed=0, paths=None, using='default'):
+    """Runs the hot paths benchmarks over the existing data, returning the results by path name."""
+    rng = random.Random(seed)
+    plans = list(Plan.objects.using(using).order_by('pk'))
+    customers = list(Customer.with_subscriptions.db_manager(using).order_by('pk').values_list('pk', flat=True))
+    rng.shuffle(customers)
+
+    return {
+        name: HOT_PATHS[name](customers, plans, iterations, using).as_dict()
+        for name in (paths or HOT_PATHS)
+    }
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Returns the regressions of the results against the baseline ones: a path mean time more than
+    `tolerance` slower, or any path running more queries per operation.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+
+        if result['queries_per_op'] > expected['queries_per_op']:
+            regressions.append('{}: {:.2f} queries per operation, baseline {:.2f}'.format(
+                name, result['queries_per_op'], expected['queries_per_op']
+            ))
+        if result['mean_ms'] > expected['mean_ms'] * (1 + tolerance):
+            regressions.append('{}: {:.3f}ms per operation, baseline {:.3f}ms (tolerance {:.0%})'.format(
+                name, result['mean_ms'], expected['mean_ms'], tolerance
+            ))
+
+    return regressions
+
+
+def write_results(path, results, **meta):
+    with open(path, 'w') as results_file:
+        json.dump({'meta': meta, 'results': results}, results_file, indent=2, sort_keys=True)
+
+
+def read_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)['results']
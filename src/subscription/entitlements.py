@@ -0,0 +1,116 @@
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .registry import plan_registry
+from .sharding import get_shard
+
+GENERATION_CACHE_KEY = 'subscription:entitlements:generation'
+
+
+class Entitlements(namedtuple('Entitlements', 'customer_id plan_type total_allowed used remaining renewal_date')):
+    """
+    Snapshot of what a customer subscription allows.
+
+    `remaining` is None for the unlimited plans, every field but the customer id and `used` is None
+    when the customer has no subscription.
+    """
+    __slots__ = ()
+
+    def allows_websites(self, total=1):
+        if self.plan_type is None:
+            return False
+        return self.remaining is None or self.remaining >= total
+
+
+def get_cache():
+    return caches[getattr(settings, 'SUBSCRIPTION_ENTITLEMENTS_CACHE', 'default')]
+
+
+def get_cache_key(customer_id, generation):
+    return 'subscription:entitlements:{}:{}'.format(generation, customer_id)
+
+
+def get_entitlements(customer_id):
+    """
+    Returns the customer Entitlements snapshot, from the cache whenever possible.
+
+    On a cold key only one caller (the one holding the lock key) builds the snapshot, the others
+    wait up to settings.SUBSCRIPTION_ENTITLEMENTS_LOCK_WAIT seconds for it before building it themselves.
+    """
+    cache = get_cache()
+    generation = cache.get_or_set(GENERATION_CACHE_KEY, 1, None)
+    cache_key = get_cache_key(customer_id, generation)
+
+    entitlements = cache.get(cache_key)
+    if entitlements is not None:
+        return entitlements
+
+    lock_key = '{}:lock'.format(cache_key)
+    if not cache.add(lock_key, True, getattr(settings, 'SUBSCRIPTION_ENTITLEMENTS_LOCK_TIMEOUT', 10)):
+        deadline = time.monotonic() + getattr(settings, 'SUBSCRIPTION_ENTITLEMENTS_LOCK_WAIT', 0.5)
+        while time.monotonic() < deadline:
+            time.sleep(0.01)
+            entitlements = cache.get(cache_key)
+            if entitlements is not None:
+                return entitlements
+        return build_entitlements(customer_id)
+
+    try:
+        entitlements = build_entitlements(customer_id)
+        cache.set(cache_key, entitlements, getattr(settings, 'SUBSCRIPTION_ENTITLEMENTS_TIMEOUT', 60))
+    finally:
+        cache.delete(lock_key)
+
+    return entitlements
+
+
+def build_entitlements(customer_id):
+    """
+    Builds the customer Entitlements snapshot from the database the customer is written to (its shard or the
+    primary), never a replica: a lagging one could cache a stale snapshot right after its invalidation.
+    """
+    from .models import Customer
+
+    subscription_id, used, renewal_date = Customer.objects.using(get_shard(customer_id)).filter(
+        pk=customer_id
+    ).values_list('subscription_id', 'websites_count', 'sub_renewal_date').get()
+
+    if not subscription_id:
+        return Entitlements(customer_id, None, None, used, None, None)
+
+    plan = plan_registry.get(subscription_id)
+    total_allowed = plan.total_websites_allowed
+    remaining = max(total_allowed - used, 0) if total_allowed else None
+
+    return Entitlements(customer_id, plan.plan_type, total_allowed, used, remaining, renewal_date)
+
+
+def invalidate_entitlements(*customer_ids, using=None):
+    """Drops the customers snapshots, now and once again after the current transaction commits."""
+    def invalidate():
+        cache = get_cache()
+        generation = cache.get(GENERATION_CACHE_KEY)
+        if generation is not None:
+            cache.delete_many([get_cache_key(customer_id, generation) for customer_id in customer_ids])
+
+    if customer_ids:
+        invalidate()
+        transaction.on_commit(invalidate, using=using)
+
+
+def invalidate_all_entitlements(using=None):
+    """Drops every snapshot at once, by moving to a new cache keys generation."""
+    def invalidate():
+        cache = get_cache()
+        try:
+            cache.incr(GENERATION_CACHE_KEY)
+        except ValueError:
+            # there's no generation yet, so there aren't any snapshots either
+            pass
+
+    invalidate()
+    transaction.on_commit(invalidate, using=using)
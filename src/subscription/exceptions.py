@@ -2,3 +2,18 @@ from django.core import exceptions
 
 class CustomerAddWebsitePermissionDenied(exceptions.PermissionDenied):
     pass
+
+
+class SubscriptionConflict(ValueError):
+    """The customer subscription was changed by someone else since it was read."""
+    pass
+
+
+class InvalidCursor(ValueError):
+    """A pagination cursor that can't be decoded, or wasn't made for the listing."""
+    pass
+
+
+class OutboxDeliveryError(Exception):
+    """A sink couldn't take a batch of outbox events, which stays pending."""
+    pass
@@ -0,0 +1,91 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .loaders import Loader, load_websites
+from .models import Customer
+from .pagination import KeysetPaginator
+from .sharding import get_shards, sharding_enabled
+
+CSV_FORMAT = 'csv'
+NDJSON_FORMAT = 'ndjson'
+FORMATS = (CSV_FORMAT, NDJSON_FORMAT)
+
+CONTENT_TYPES = {CSV_FORMAT: 'text/csv; charset=utf-8', NDJSON_FORMAT: 'application/x-ndjson'}
+
+# the websites urls column, a list in NDJSON and whitespace separated urls in CSV (also read by imports.read_rows())
+WEBSITES_COLUMN = 'websites'
+
+# exported column -> Customer lookup, the plan columns come from the same (LEFT JOIN) query
+EXPORT_FIELDS = (
+    ('id', 'pk'),
+    ('username', 'username'),
+    ('email', 'email'),
+    ('plan', 'subscription__name'),
+    ('plan_type', 'subscription__plan_type'),
+    ('price', 'subscription__price'),
+    ('renewal_date', 'sub_renewal_date'),
+    ('websites_count', 'websites_count'),
+)
+
+
+def get_export_columns(websites=False):
+    columns = [column for column, _ in EXPORT_FIELDS]
+    return columns + [WEBSITES_COLUMN] if websites else columns
+
+
+def export_rows(queryset=None, chunk_size=2000, websites=False):
+    """
+    Yields a tuple (following get_export_columns()) per customer, ordered by id.
+
+    The rows are read in keyset pages of `chunk_size` rows by id (see KeysetPaginator), from every shard
+    when sharding is enabled, so they're never all in memory and no cursor is held open between pages.
+    A page is a single query, the websites count is the denormalized counter, so there's no per customer lookup.
+    With `websites`, the urls of the customers websites are added, batch loaded with a query per page.
+    """
+    if queryset is None:
+        queryset = Customer.objects.all()
+    lookups = [lookup for _, lookup in EXPORT_FIELDS]
+    queryset = queryset.values(*lookups)
+
+    querysets = [queryset.using(shard) for shard in get_shards()] if sharding_enabled() else [queryset]
+    for queryset in querysets:
+        for object_list in KeysetPaginator(queryset, ('pk',), per_page=chunk_size).pages():
+            rows = [tuple(row[lookup] for lookup in lookups) for row in object_list]
+            yield from add_websites(rows) if websites else rows
+
+
+def add_websites(rows):
+    """Adds the urls of the customers websites to the export rows, with a single query."""
+    # a loader per page, the customers (and their websites) aren't seen again
+    loader = Loader(load_websites, default=())
+    urls = loader.load_many([row[0] for row in rows])
+    return [row + ([website.url for website in websites],) for row, websites in zip(rows, urls)]
+
+
+class Echo:
+    """File like object that returns what's written to it, so csv.writer can write to a generator."""
+
+    def write(self, value):
+        return value
+
+
+def stream_export(rows, export_format=CSV_FORMAT, columns=None):
+    """
+    Yields the export rows as text lines in `export_format` (CSV with a header, or NDJSON).
+    The lists (i.e: the websites urls) are whitespace separated in CSV.
+    """
+    columns = columns or get_export_columns()
+
+    if export_format == CSV_FORMAT:
+        writer = csv.writer(Echo())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow([' '.join(value) if isinstance(value, list) else value for value in row])
+    elif export_format == NDJSON_FORMAT:
+        encoder = DjangoJSONEncoder()
+        for row in rows:
+            yield encoder.encode(dict(zip(columns, row))) + '\n'
+    else:
+        raise ValueError('Unknown export format ({})'.format(export_format))
@@ -0,0 +1,216 @@
+import csv
+import json
+from collections import namedtuple
+from datetime import date
+
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .exports import CSV_FORMAT, NDJSON_FORMAT, WEBSITES_COLUMN
+from .models import Customer, Plan, Website, record_subscription_changes
+from .outbox import WEBSITE_ADDED_EVENT, get_website_event, record_events
+from .rollups import record_rollup_changes
+from .seeding import bulk_create_rows, reset_sequences
+from .sharding import allocate_customer_ids, get_shard, get_shards, scatter_gather, sharding_enabled
+from .utils import get_renewal_date
+
+ImportChunk = namedtuple('ImportChunk', 'last_line customers websites rejected')
+RejectedRow = namedtuple('RejectedRow', 'line row errors')
+
+
+def read_rows(stream, input_format=CSV_FORMAT):
+    """
+    Yields a (line number, row dict) per input row, or (line number, ValidationError) for the unreadable ones.
+
+    The rows have `username`, `email`, `first_name`, `last_name`, `plan` (name or type), `renewal_date`
+    (YYYY-MM-DD) and `websites`, as written by the exports (see exports.WEBSITES_COLUMN).
+    """
+    if input_format == CSV_FORMAT:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            row[WEBSITES_COLUMN] = (row.get(WEBSITES_COLUMN) or '').split()
+            yield reader.line_num, row
+    elif input_format == NDJSON_FORMAT:
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield line_number, ValidationError('Invalid JSON ({})'.format(error))
+                continue
+            if not isinstance(row, dict):
+                yield line_number, ValidationError('Expected a JSON object')
+                continue
+            yield line_number, row
+    else:
+        raise ValueError('Unknown import format ({})'.format(input_format))
+
+
+class CustomerImporter:
+    """
+    Imports customers, with their subscription and websites, in chunks of `batch_size` rows.
+
+    Every chunk is validated in memory before being written: the urls with the Website url field rules,
+    the plan through a lookup table loaded once, the websites against the plan limit and the usernames
+    against the database (a single query). The valid rows are then written with bulk_create, in a
+    transaction per chunk (and shard). The customers get explicit ids, so their websites can reference
+    them without reading them back, which means the customers signups are better paused meanwhile
+    (without sharding the ids continue the highest one). The subscription and website events are recorded
+    in the outbox, in the same transactions.
+    """
+
+    def __init__(self, batch_size=1000, using=DEFAULT_DB_ALIAS):
+        self.batch_size = batch_size
+        self.using = using
+        self.url_field = Website._meta.get_field('url')
+        self.password_hash = make_password(None)
+        self.today = date.today()
+
+        self.plans = {}
+        for plan in Plan.objects.using(using).order_by('pk'):
+            self.plans.setdefault(plan.name.lower(), plan)
+            self.plans.setdefault(plan.plan_type, plan)
+
+    def import_rows(self, rows):
+        """
+        Imports the (line number, row) pairs (see read_rows()), yielding an ImportChunk after each chunk commits.
+        """
+        chunk = []
+        for line_number, row in rows:
+            chunk.append((line_number, row))
+            if len(chunk) >= self.batch_size:
+                yield self.import_chunk(chunk)
+                chunk = []
+
+        if chunk:
+            yield self.import_chunk(chunk)
+
+    def import_chunk(self, chunk):
+        rejected = []
+        valid = []
+        for line_number, row in chunk:
+            try:
+                if isinstance(row, ValidationError):
+                    raise row
+                valid.append((line_number, row, self.clean_row(row)))
+            except ValidationError as error:
+                rejected.append(RejectedRow(line_number, row if isinstance(row, dict) else None, error.messages))
+
+        # the usernames taken, in the database or by a previous row of the chunk
+        taken = self.taken_usernames({customer['username'] for _, _, (customer, _) in valid})
+
+        customers = []
+        for line_number, row, (customer, urls) in valid:
+            if customer['username'] in taken:
+                rejected.append(RejectedRow(line_number, row, ['A customer with this username already exists.']))
+                continue
+            taken.add(customer['username'])
+            customers.append((customer, urls))
+
+        total_websites = self.write(customers)
+        rejected.sort(key=lambda rejected_row: rejected_row.line)
+        return ImportChunk(chunk[-1][0], len(customers), total_websites, rejected)
+
+    def taken_usernames(self, usernames):
+        """Returns the usernames already in the database (in any shard, when sharding is enabled)."""
+        shards = get_shards() if sharding_enabled() else [self.using]
+        return set().union(*scatter_gather(lambda shard: Customer._base_manager.using(shard).filter(
+            username__in=usernames
+        ).values_list('username', flat=True), shards=shards))
+
+    def clean_row(self, row):
+        """Returns the customer row (dict by field attname) and the urls of an input row, or raises ValidationError."""
+        errors = []
+
+        username = str(row.get('username') or '').strip()
+        if not username:
+            errors.append('The username is required.')
+        elif len(username) > Customer._meta.get_field('username').max_length:
+            errors.append('The username is too long.')
+
+        plan = None
+        plan_name = str(row.get('plan') or '').strip()
+        if plan_name:
+            plan = self.plans.get(plan_name.lower())
+            if plan is None:
+                errors.append('Unknown plan ({}).'.format(plan_name))
+
+        renewal_date = None
+        if row.get('renewal_date'):
+            renewal_date = parse_date(str(row['renewal_date']))
+            if renewal_date is None:
+                errors.append('Invalid renewal date ({}).'.format(row['renewal_date']))
+
+        urls = row.get(WEBSITES_COLUMN) or []
+        if not isinstance(urls, list):
+            urls = [urls]
+        for url in urls:
+            try:
+                self.url_field.clean(url, None)
+            except ValidationError as error:
+                errors.extend('{} ({})'.format(message, url) for message in error.messages)
+
+        if urls and not plan_name:
+            errors.append('Websites need a subscription.')
+        elif plan and plan.total_websites_allowed and len(urls) > plan.total_websites_allowed:
+            errors.append('{} websites, but the plan only allows {}.'.format(len(urls), plan.total_websites_allowed))
+
+        if errors:
+            raise ValidationError(errors)
+
+        customer = {
+            'password': self.password_hash, 'username': username, 'email': str(row.get('email') or ''),
+            'first_name': str(row.get('first_name') or ''), 'last_name': str(row.get('last_name') or ''),
+            'is_superuser': False, 'is_staff': False, 'is_active': True, 'date_joined': timezone.now(),
+            'subscription_id': plan.pk if plan else None, 'websites_count': len(urls),
+            'sub_renewal_date': (renewal_date or get_renewal_date(self.today)) if plan else None,
+        }
+        return customer, urls
+
+    def write(self, customers):
+        """Writes the customers and their websites, returning the number of websites written."""
+        if not customers:
+            return 0
+
+        if sharding_enabled():
+            customer_ids = allocate_customer_ids(len(customers))
+            shards = {}
+            for customer_id, (customer, urls) in zip(customer_ids, customers):
+                shards.setdefault(get_shard(customer_id), []).append(({**customer, 'id': customer_id}, urls))
+            return sum(self.write_rows(shard, rows, reset=False) for shard, rows in shards.items())
+
+        with transaction.atomic(using=self.using):
+            next_customer_id = (Customer._base_manager.using(self.using).aggregate(pk=Max('pk'))['pk'] or 0) + 1
+            rows = [({**customer, 'id': customer_id}, urls) for customer_id, (customer, urls) in enumerate(
+                customers, next_customer_id
+            )]
+            return self.write_rows(self.using, rows)
+
+    def write_rows(self, using, rows, reset=True):
+        websites = [{'customer_id': customer['id'], 'url': url} for customer, urls in rows for url in urls]
+
+        with transaction.atomic(using=using):
+            bulk_create_rows(Customer, [customer for customer, _ in rows], using)
+            bulk_create_rows(Website, websites, using)
+            # the customers are new, so all their websites are the ones just inserted (read back for their ids)
+            record_events([
+                get_website_event(WEBSITE_ADDED_EVENT, customer_id, website_id, url)
+                for website_id, customer_id, url in Website._base_manager.using(using).filter(
+                    customer_id__in=[customer['id'] for customer, urls in rows if urls]
+                ).order_by('pk').values_list('pk', 'customer_id', 'url')
+            ], using=using)
+            record_rollup_changes([
+                (customer['id'], customer['subscription_id'], 1, customer['websites_count']) for customer, _ in rows
+            ], using=using)
+            record_subscription_changes([(
+                customer['id'], customer['date_joined'], None, customer['subscription_id'], customer['sub_renewal_date']
+            ) for customer, _ in rows], using=using)
+            if reset:
+                reset_sequences(using, [Customer])
+
+        return len(websites)
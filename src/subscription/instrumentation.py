@@ -0,0 +1,164 @@
+"""
+SQL and timing instrumentation: the track_queries() context manager measures a block of code and
+the (optional) SQLInstrumentationMiddleware measures the sampled requests, sending the results as
+Server-Timing headers, JSON log lines (`subscription.instrumentation` logger) and rolling per view
+histograms (see view_histograms).
+
+To enable it, add 'subscription.instrumentation.SQLInstrumentationMiddleware' to settings.MIDDLEWARE,
+the sampled requests fraction is settings.SUBSCRIPTION_SQL_SAMPLE_RATE (default 0.01, 1 measures them all).
+"""
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+DEFAULT_SAMPLE_RATE = 0.01
+
+logger = logging.getLogger('subscription.instrumentation')
+
+
+class QueryStats:
+    """Execute wrapper counting the queries, their total time and the duplicated (same SQL and params) ones."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.seconds = 0.0
+        self._statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.queries += 1
+            self._statements[(sql, repr(params))] += 1
+
+    @property
+    def duplicates(self):
+        return sum(total - 1 for total in self._statements.values())
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'duplicates': self.duplicates,
+            'db_ms': round(self.db_seconds * 1000, 3),
+            'total_ms': round(self.seconds * 1000, 3),
+        }
+
+
+@contextmanager
+def track_queries(name=None, using=None):
+    """
+    Measures the queries run inside the block, in the `using` database (default all of them).
+    When named, the results are logged as a JSON line at the end of the block.
+    """
+    stats = QueryStats()
+    started = time.perf_counter()
+
+    with ExitStack() as stack:
+        for alias in ([using] if using else connections):
+            stack.enter_context(connections[alias].execute_wrapper(stats))
+        try:
+            yield stats
+        finally:
+            stats.seconds = time.perf_counter() - started
+
+    if name:
+        logger.info(json.dumps(dict(stats.as_dict(), block=name)))
+
+
+class RollingHistogram:
+    """Keeps the last `size` observations, to answer percentiles over a rolling window."""
+
+    def __init__(self, size=1000):
+        self.values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            self.values.append(value)
+
+    def percentile(self, percent):
+        with self._lock:
+            values = sorted(self.values)
+        if not values:
+            return None
+        return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+    def summary(self):
+        return {
+            'count': len(self.values),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class ViewHistograms:
+    """Rolling histograms of the database time, total time and queries of the sampled requests, by view."""
+
+    metrics = ('queries', 'db_ms', 'total_ms')
+
+    def __init__(self):
+        self._histograms = defaultdict(self._new_histograms)
+        self._lock = threading.Lock()
+
+    def _new_histograms(self):
+        size = getattr(settings, 'SUBSCRIPTION_SQL_HISTOGRAM_SIZE', 1000)
+        return {metric: RollingHistogram(size) for metric in self.metrics}
+
+    def add(self, view, stats):
+        values = stats.as_dict()
+        with self._lock:
+            histograms = self._histograms[view]
+        for metric in self.metrics:
+            histograms[metric].add(values[metric])
+
+    def summary(self):
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {
+            view: {metric: histogram.summary() for metric, histogram in view_histograms.items()}
+            for view, view_histograms in histograms.items()
+        }
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+view_histograms = ViewHistograms()
+
+
+class SQLInstrumentationMiddleware:
+    """Measures the queries and time of the sampled requests, see the module documentation."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= getattr(settings, 'SUBSCRIPTION_SQL_SAMPLE_RATE', DEFAULT_SAMPLE_RATE):
+            return self.get_response(request)
+
+        with track_queries() as stats:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else request.path
+        view_histograms.add(view, stats)
+
+        values = stats.as_dict()
+        response['Server-Timing'] = (
+            'db;dur={db_ms};desc="{queries} queries, {duplicates} duplicated", total;dur={total_ms}'.format(**values)
+        )
+        logger.info(json.dumps(dict(values, view=view, method=request.method, status=response.status_code)))
+
+        return response
@@ -0,0 +1,114 @@
+from collections import defaultdict
+
+from .models import Customer, Website
+from .registry import plan_registry
+from .sharding import get_shard, sharding_enabled
+
+
+class Loader:
+    """
+    DataLoader style batching of key lookups.
+
+    The keys asked for (load(), load_many(), or queued ahead with queue()) are resolved together by
+    `batch_load(keys)`, which returns a {key: value} dict from a single query, and memoized: each key is
+    only ever loaded once per loader, so a loader lives as long as its data may be reused (i.e: a request).
+    The keys missing from the batch result load as `default`.
+    """
+
+    def __init__(self, batch_load, default=None):
+        self.batch_load = batch_load
+        self.default = default
+        self.cache = {}
+        self.pending = set()
+        self.batches = 0
+
+    def queue(self, *keys):
+        """Adds the keys to the next batch, without resolving them yet."""
+        self.pending.update(key for key in keys if key not in self.cache)
+
+    def load(self, key):
+        return self.load_many([key])[0]
+
+    def load_many(self, keys):
+        keys = list(keys)
+        self.queue(*keys)
+        if self.pending:
+            self.dispatch()
+        return [self.cache[key] for key in keys]
+
+    def dispatch(self):
+        """Resolves every pending key in a single batch."""
+        keys, self.pending = self.pending, set()
+        values = self.batch_load(keys)
+        self.batches += 1
+        for key in keys:
+            self.cache[key] = values.get(key, self.default)
+
+    def prime(self, key, value):
+        """Memoizes a value loaded by other means."""
+        self.cache.setdefault(key, value)
+        self.pending.discard(key)
+
+
+def load_plans(plan_ids):
+    """The plans through the plan registry, so only the ones it doesn't hold yet are queried (in one query)."""
+    return plan_registry.get_many(plan_ids)
+
+
+def load_websites(customer_ids):
+    """The websites (ordered by id) of each customer, a single query (per shard, when sharding is enabled)."""
+    customer_ids_by_db = defaultdict(list)
+    for customer_id in customer_ids:
+        customer_ids_by_db[get_shard(customer_id) if sharding_enabled() else None].append(customer_id)
+
+    websites = defaultdict(list)
+    for db, ids in customer_ids_by_db.items():
+        queryset = Website.objects.using(db) if db else Website.objects.all()
+        for website in queryset.filter(customer_id__in=ids).order_by('customer_id', 'id'):
+            websites[website.customer_id].append(website)
+    return websites
+
+
+class SubscriptionLoaders:
+    """
+    The loaders of the customers relations: `plans` by plan id and `websites` by customer id.
+
+    prime_customers() loads the relations of a list of customers in one query per relation (instead of one
+    per customer and relation) and hands them over to the customers, so customer.subscription, customer.plan,
+    get_total_websites_allowed() and customer.websites.all() don't query anymore.
+    """
+
+    def __init__(self):
+        self.plans = Loader(load_plans)
+        self.websites = Loader(load_websites, default=())
+
+    def prime_customers(self, customers, websites=False):
+        customers = list(customers)
+        subscription_field = Customer._meta.get_field('subscription')
+
+        self.plans.queue(*{customer.subscription_id for customer in customers if customer.subscription_id})
+        if websites:
+            self.websites.queue(*[customer.pk for customer in customers])
+
+        for customer in customers:
+            if customer.subscription_id and not subscription_field.is_cached(customer):
+                subscription_field.set_cached_value(customer, self.plans.load(customer.subscription_id))
+            if websites:
+                set_prefetched_websites(customer, self.websites.load(customer.pk))
+
+        return customers
+
+
+def set_prefetched_websites(customer, websites):
+    """Hands the websites over to the customer, as prefetch_related('websites') would."""
+    queryset = customer.websites.all()
+    queryset._result_cache = list(websites)
+    queryset._prefetch_done = True
+    customer.__dict__.setdefault('_prefetched_objects_cache', {})['websites'] = queryset
+
+
+def get_loaders(request):
+    """The SubscriptionLoaders of the request, so the loaded data is shared by everything handling it."""
+    if not hasattr(request, '_subscription_loaders'):
+        request._subscription_loaders = SubscriptionLoaders()
+    return request._subscription_loaders
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from subscription.exports import CSV_FORMAT, FORMATS, export_rows, get_export_columns, stream_export
+
+
+class Command(BaseCommand):
+    help = (
+        'Streams every customer with its plan, renewal date and websites count as CSV or NDJSON, '
+        'in constant memory.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default=CSV_FORMAT, help='Export format, default CSV.')
+        parser.add_argument('--output', help='File to write the export to, default the standard output.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the database at once.')
+        parser.add_argument('--websites', action='store_true', help='Add the urls of the customers websites.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        lines = stream_export(
+            export_rows(chunk_size=options['chunk_size'], websites=options['websites']), options['format'],
+            get_export_columns(options['websites']),
+        )
+
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        total = 0
+        with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+            for line in lines:
+                output.write(line)
+                total += 1
+
+        # the CSV header isn't a customer
+        total -= options['format'] == CSV_FORMAT
+        self.stdout.write(self.style.SUCCESS(
+            'Exported {} customer(s) in {:.2f}s'.format(total, time.monotonic() - started)
+        ))
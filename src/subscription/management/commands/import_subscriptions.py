@@ -0,0 +1,97 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from subscription.exports import CSV_FORMAT, FORMATS, NDJSON_FORMAT
+from subscription.imports import CustomerImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports customers, their subscription and websites from a CSV or NDJSON file, in chunked '
+        'transactions. The rejected rows go to a reject file and, with a checkpoint file, an interrupted run '
+        'resumes where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or NDJSON file to import.')
+        parser.add_argument('--format', choices=FORMATS, help='Input format, default by the file extension.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows imported per transaction.')
+        parser.add_argument('--reject-file', help='NDJSON file where the rejected rows (and why) are written.')
+        parser.add_argument('--checkpoint', help='File where the progress is saved, to resume interrupted runs.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to import to, without sharding.')
+
+    def handle(self, *args, **options):
+        path = os.path.abspath(options['path'])
+        if not os.path.exists(path):
+            raise CommandError('No such file ({})'.format(path))
+        input_format = options['format'] or (NDJSON_FORMAT if path.endswith(('.ndjson', '.jsonl')) else CSV_FORMAT)
+        checkpoint_path = options['checkpoint']
+
+        last_line = self.load_checkpoint(checkpoint_path, path)
+        if last_line:
+            self.stdout.write('Resuming after line {}'.format(last_line))
+
+        importer = CustomerImporter(batch_size=options['batch_size'], using=options['database'])
+        total_customers = total_websites = total_rejected = 0
+        started = time.monotonic()
+
+        reject_file = None
+        if options['reject_file']:
+            # a resumed run adds to the rejects of the previous one
+            reject_file = open(options['reject_file'], 'a' if last_line else 'w', encoding='utf-8')
+
+        try:
+            with open(path, newline='', encoding='utf-8') as stream:
+                rows = ((line, row) for line, row in read_rows(stream, input_format) if line > last_line)
+                for chunk in importer.import_rows(rows):
+                    total_customers += chunk.customers
+                    total_websites += chunk.websites
+                    total_rejected += len(chunk.rejected)
+
+                    if reject_file:
+                        for rejected in chunk.rejected:
+                            reject_file.write(json.dumps(rejected._asdict()) + '\n')
+                        reject_file.flush()
+                    self.save_checkpoint(checkpoint_path, path, chunk.last_line)
+
+                    if options['verbosity'] > 1:
+                        self.stdout.write('Imported up to line {}'.format(chunk.last_line))
+        finally:
+            if reject_file:
+                reject_file.close()
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {} customers and {} websites, rejected {} row(s), in {:.2f}s ({:.0f} rows/s)'.format(
+                total_customers, total_websites, total_rejected, elapsed,
+                (total_customers + total_websites) / max(elapsed, 1e-6),
+            )
+        ))
+
+    def load_checkpoint(self, path, input_path):
+        if not path or not os.path.exists(path):
+            return 0
+
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        # a checkpoint of another input file doesn't apply
+        if checkpoint.get('input') != input_path:
+            return 0
+        return checkpoint['line']
+
+    def save_checkpoint(self, path, input_path, line):
+        if not path:
+            return
+
+        # write and rename, so an interruption never leaves a truncated checkpoint behind
+        with open('{}.tmp'.format(path), 'w') as checkpoint_file:
+            json.dump({'input': input_path, 'line': line}, checkpoint_file)
+        os.replace('{}.tmp'.format(path), path)
@@ -0,0 +1,111 @@
+import json
+import os
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+
+from subscription.models import Customer
+from subscription.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Renews the subscriptions due until the given date, in chunks of set based UPDATEs, in every shard. '
+        'With a checkpoint file, an interrupted run resumes where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Renew the subscriptions due until this date (YYYY-MM-DD), default today.')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Customers renewed per transaction.')
+        parser.add_argument('--checkpoint', help='File where the progress is saved, to resume interrupted runs.')
+
+    def handle(self, *args, **options):
+        as_of = parse_date(options['date']) if options['date'] else date.today()
+        if as_of is None:
+            raise CommandError('Invalid date ({})'.format(options['date']))
+        chunk_size = options['chunk_size']
+        checkpoint_path = options['checkpoint']
+
+        databases = get_shards()
+        position = self.load_checkpoint(checkpoint_path, as_of)
+        if position:
+            self.stdout.write('Resuming after customer id={pk} (renewal date {renewal_date}) in {database}'.format(
+                **position
+            ))
+            # the databases before the checkpoint one were already processed
+            databases = databases[databases.index(position['database']):]
+
+        total_renewed = 0
+        started = time.monotonic()
+
+        for using in databases:
+            # Keyset chunks over the (sub_renewal_date, pk) index order: every chunk is a fresh bounded query,
+            # so the renewed rows (which move forward in the index) are never read by a long lived cursor, and the
+            # last key of a chunk is all that's needed to resume. The renewed customers renewal dates end up after
+            # the processing date (see CustomerQuerySet.renew()), so they're never due again in the same run.
+            due = Customer.with_subscriptions.using(using).filter(sub_renewal_date__lte=as_of).order_by(
+                'sub_renewal_date', 'pk'
+            )
+
+            while True:
+                chunk = due
+                if position and position['database'] == using:
+                    renewal_date = parse_date(position['renewal_date'])
+                    chunk = chunk.filter(
+                        Q(sub_renewal_date__gt=renewal_date) | Q(sub_renewal_date=renewal_date, pk__gt=position['pk'])
+                    )
+                keys = list(chunk.values_list('sub_renewal_date', 'pk')[:chunk_size])
+                if not keys:
+                    break
+
+                with transaction.atomic(using=using):
+                    total_renewed += Customer.objects.using(using).filter(pk__in=[pk for _, pk in keys]).renew(
+                        until=as_of
+                    )
+
+                last_renewal_date, last_pk = keys[-1]
+                position = {'database': using, 'renewal_date': last_renewal_date.isoformat(), 'pk': last_pk}
+                self.save_checkpoint(checkpoint_path, as_of, position)
+
+                if options['verbosity'] > 1:
+                    self.stdout.write('Renewed {} customers ({:.0f}/s)'.format(
+                        total_renewed, self.rate(total_renewed, started)
+                    ))
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS('Renewed {} subscriptions due until {} in {:.2f}s ({:.0f}/s)'.format(
+            total_renewed, as_of, elapsed, self.rate(total_renewed, started)
+        )))
+
+    def rate(self, total, started):
+        return total / max(time.monotonic() - started, 1e-6)
+
+    def load_checkpoint(self, path, as_of):
+        if not path or not os.path.exists(path):
+            return None
+
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        # a checkpoint from a run with another processing date (or other shards) doesn't apply
+        if checkpoint.get('date') != as_of.isoformat():
+            return None
+        position = checkpoint['position']
+        position.setdefault('database', get_shards()[0])
+        return position if position['database'] in get_shards() else None
+
+    def save_checkpoint(self, path, as_of, position):
+        if not path:
+            return
+
+        # write and rename, so an interruption never leaves a truncated checkpoint behind
+        with open('{}.tmp'.format(path), 'w') as checkpoint_file:
+            json.dump({'date': as_of.isoformat(), 'position': position}, checkpoint_file)
+        os.replace('{}.tmp'.format(path), path)
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription.models import Customer
+from subscription.rollups import rebuild_rollups
+from subscription.sharding import get_shard, get_shards, move_customer, sharding_enabled, sync_plans
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves the customers (and their websites) that aren\'t in the shard their id hashes to, '
+        'i.e: after a shard is appended to SUBSCRIPTION_SHARDS. The plans are replicated to the shards first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customer', type=int, action='append', help='Only move this customer id (repeatable).')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Customer ids read per query.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report the customers to move.')
+
+    def handle(self, *args, **options):
+        if not sharding_enabled():
+            raise CommandError('Sharding isn\'t enabled (SUBSCRIPTION_SHARDS)')
+
+        if not options['dry_run']:
+            sync_plans()
+
+        total_moved = 0
+        for source in get_shards():
+            for customer_id in self.misplaced_customer_ids(source, options['customer'], options['chunk_size']):
+                target = get_shard(customer_id)
+                self.stdout.write('Customer id={} from {} to {}'.format(customer_id, source, target))
+                if not options['dry_run']:
+                    move_customer(customer_id, source, target)
+                total_moved += 1
+
+        if total_moved and not options['dry_run']:
+            # the moves copy the rows as they are, the shards rollups are rebuilt afterwards instead
+            for shard in get_shards():
+                rebuild_rollups(using=shard)
+
+        self.stdout.write(self.style.SUCCESS('{} {} customer(s)'.format(
+            'Would move' if options['dry_run'] else 'Moved', total_moved
+        )))
+
+    def misplaced_customer_ids(self, shard, customer_ids, chunk_size):
+        customers = Customer._base_manager.using(shard).order_by('pk')
+        if customer_ids:
+            customers = customers.filter(pk__in=customer_ids)
+
+        last_customer_id = 0
+        while True:
+            chunk = list(customers.filter(pk__gt=last_customer_id).values_list('pk', flat=True)[:chunk_size])
+            if not chunk:
+                break
+            last_customer_id = chunk[-1]
+            yield from (customer_id for customer_id in chunk if get_shard(customer_id) != shard)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from subscription.rollups import rebuild_rollups
+from subscription.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the plans daily rollups of a day (default today) from the customers table, in every shard. '
+        'Run it after the writes that don\'t maintain them (i.e: raw SQL, restores) or to fix any drift.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Day (YYYY-MM-DD) of the rollups to rebuild, default today.')
+
+    def handle(self, *args, **options):
+        day = None
+        if options['date']:
+            day = parse_date(options['date'])
+            if day is None:
+                raise CommandError('Invalid date ({})'.format(options['date']))
+
+        total = 0
+        for using in get_shards():
+            rebuilt = rebuild_rollups(using=using, day=day)
+            if options['verbosity'] > 1:
+                self.stdout.write('Rebuilt {} plan rollup(s) in {}'.format(rebuilt, using))
+            total += rebuilt
+
+        self.stdout.write(self.style.SUCCESS('Rebuilt {} plan rollup(s)'.format(total)))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from subscription.entitlements import invalidate_all_entitlements
+from subscription.models import Customer
+from subscription.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the customers websites_count counter from the websites table, in every shard, '
+        'and reports any drift found.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report the customers whose counter drifted, without rebuilding it (exits with error on drift).',
+        )
+
+    def handle(self, *args, **options):
+        databases = get_shards()
+        total_drifted = 0
+
+        for using in databases:
+            drifted = Customer.objects.using(using).with_websites_count_drift().order_by('pk')
+            for customer in drifted.values('pk', 'username', 'websites_count', 'real_websites_count').iterator():
+                total_drifted += 1
+                self.stdout.write(
+                    'Customer {username} (id={pk}): counter {websites_count}, real {real_websites_count}'.format(
+                        **customer
+                    )
+                )
+
+        if options['check']:
+            if total_drifted:
+                raise CommandError('{} customer(s) with a drifted websites counter'.format(total_drifted))
+            self.stdout.write(self.style.SUCCESS('No websites counter drift found'))
+            return
+
+        updated = 0
+        for using in databases:
+            with transaction.atomic(using=using):
+                updated += Customer.objects.using(using).recount_websites()
+                invalidate_all_entitlements(using=using)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt the websites counter of {} customer(s), {} had drifted'.format(updated, total_drifted)
+        ))
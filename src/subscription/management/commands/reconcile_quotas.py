@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from subscription.entitlements import invalidate_entitlements
+from subscription.models import Customer
+from subscription.pagination import KeysetPaginator
+from subscription.sharding import get_shards
+
+REPORT_POLICY = 'report'
+FLAG_POLICY = 'flag'
+DETACH_POLICY = 'detach'
+BLOCK_POLICY = 'block'
+
+
+class Command(BaseCommand):
+    help = (
+        'Finds the customers owning more websites than their plan allows (i.e: after a downgrade) and applies a '
+        'policy to them, in chunked transactions: report only, flag them (over_quota_since), detach their newest '
+        'websites beyond the limit or block them (inactive until they are within it again).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--policy', choices=(REPORT_POLICY, FLAG_POLICY, DETACH_POLICY, BLOCK_POLICY), default=REPORT_POLICY,
+            help='What to do with the over quota customers, default only report them.',
+        )
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Customers handled per transaction.')
+
+    def handle(self, *args, **options):
+        policy = options['policy']
+        total = 0
+
+        for using in get_shards():
+            customers = Customer.objects.using(using).over_quota().values(
+                'pk', 'username', 'subscription__total_websites_allowed', 'real_websites_count'
+            )
+            # every page is a fresh query, so the customers fixed by the previous chunks are just not found again
+            for page in KeysetPaginator(customers, ('pk',), per_page=options['chunk_size']).pages():
+                for customer in page:
+                    self.stdout.write(
+                        'Customer {username} (id={pk}): {real_websites_count} websites, '
+                        '{subscription__total_websites_allowed} allowed'.format(**customer)
+                    )
+                total += len(page)
+
+                with transaction.atomic(using=using):
+                    self.apply_policy(policy, Customer.objects.using(using).filter(
+                        pk__in=[customer['pk'] for customer in page]
+                    ))
+
+            if policy in (FLAG_POLICY, BLOCK_POLICY):
+                self.clear_flags(using)
+
+        self.stdout.write(self.style.SUCCESS('{} over quota customer(s){}'.format(
+            total, '' if policy == REPORT_POLICY else ', policy {} applied'.format(policy)
+        )))
+
+    def apply_policy(self, policy, customers):
+        if policy == DETACH_POLICY:
+            customers.detach_excess_websites()
+        elif policy in (FLAG_POLICY, BLOCK_POLICY):
+            customers.filter(over_quota_since__isnull=True).update(over_quota_since=timezone.now())
+            if policy == BLOCK_POLICY:
+                # the customers already inactive (i.e: disabled by the staff) aren't ours to reactivate later
+                customers.filter(is_active=True).update(is_active=False, blocked_for_quota=True)
+            invalidate_entitlements(*customers.values_list('pk', flat=True), using=customers.db)
+
+    def clear_flags(self, using):
+        """Clears the flags of the customers back within their plan limit, reactivating the ones it blocked."""
+        customers = Customer.objects.using(using)
+        cleared = customers.filter(over_quota_since__isnull=False).exclude(pk__in=customers.over_quota().values('pk'))
+
+        with transaction.atomic(using=using):
+            cleared.filter(blocked_for_quota=True).update(is_active=True, blocked_for_quota=False)
+            total = cleared.update(over_quota_since=None)
+
+        if total:
+            self.stdout.write('Cleared {} customer(s) back within their plan limit'.format(total))
@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from subscription.exceptions import OutboxDeliveryError
+from subscription.outbox import get_sink, purge_published, relay
+from subscription.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Publishes the pending subscription events of the outbox to a sink (a local NDJSON file, an HTTP endpoint '
+        'or a Sink subclass dotted path), in batches, from every shard. Concurrent runs take different batches.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sink', help='Sink alias (file, http) or dotted path, default SUBSCRIPTION_OUTBOX_SINK.')
+        parser.add_argument('--path', help='File of the file sink.')
+        parser.add_argument('--url', help='Endpoint of the http sink.')
+        parser.add_argument('--batch-size', type=int, default=100, help='Events published per transaction.')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches (per database).')
+        parser.add_argument('--purge-days', type=int, help='Delete the events published more than these days ago.')
+
+    def handle(self, *args, **options):
+        sink_options = {name: options[name] for name in ('path', 'url') if options[name]}
+        try:
+            sink = get_sink(options['sink'], **sink_options)
+        except (ImportError, TypeError) as error:
+            raise CommandError('Invalid sink ({})'.format(error))
+
+        total = 0
+        try:
+            for using in get_shards():
+                relayed = relay(sink, using=using, batch_size=options['batch_size'], max_batches=options['max_batches'])
+                if options['verbosity'] > 1:
+                    self.stdout.write('Published {} event(s) from {}'.format(relayed, using))
+                total += relayed
+
+                if options['purge_days'] is not None:
+                    purged = purge_published(timezone.now() - timedelta(days=options['purge_days']), using=using)
+                    if purged:
+                        self.stdout.write('Purged {} published event(s) from {}'.format(purged, using))
+        except OutboxDeliveryError as error:
+            # the failed batch stays pending, for the next run
+            raise CommandError('{} ({} event(s) published before)'.format(error, total))
+        finally:
+            sink.close()
+
+        self.stdout.write(self.style.SUCCESS('Published {} event(s) to the {} sink'.format(total, sink.name)))
@@ -0,0 +1,54 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.runner import DiscoverRunner
+
+from subscription.benchmarks import HOT_PATHS, compare_results, read_results, run_benchmarks, write_results
+from subscription.seeding import seed_subscriptions
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the subscription hot paths over a seeded test database. '
+        'Fails when the results regress against a baseline results file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000, help='Customers to seed (i.e: 1000 to 1000000).')
+        parser.add_argument('--skew', type=float, default=1.5,
+                            help='Pareto shape of the websites per customer, lower values are more skewed.')
+        parser.add_argument('--max-websites', type=int, default=1000, help='Max websites of a single customer.')
+        parser.add_argument('--iterations', type=int, default=100, help='Operations measured per hot path.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the data and the operations.')
+        parser.add_argument('--path', action='append', choices=sorted(HOT_PATHS), dest='paths',
+                            help='Hot path to benchmark (can be repeated), default all.')
+        parser.add_argument('--output', help='JSON file where the results are written, default stdout.')
+        parser.add_argument('--baseline', help='JSON results file to compare against.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Mean time increase (fraction) tolerated against the baseline.')
+
+    def handle(self, *args, **options):
+        # the data is seeded in a throwaway test database, never in the configured one
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            customers, websites = seed_subscriptions(
+                options['customers'], seed=options['seed'], skew=options['skew'], max_websites=options['max_websites']
+            )
+            results = run_benchmarks(iterations=options['iterations'], seed=options['seed'], paths=options['paths'])
+            vendor = connections['default'].vendor
+        finally:
+            runner.teardown_databases(old_config)
+
+        meta = {'customers': customers, 'websites': websites, 'seed': options['seed'], 'vendor': vendor}
+        if options['output']:
+            write_results(options['output'], results, **meta)
+        else:
+            self.stdout.write(json.dumps({'meta': meta, 'results': results}, indent=2, sort_keys=True))
+
+        if options['baseline']:
+            regressions = compare_results(results, read_results(options['baseline']), options['tolerance'])
+            if regressions:
+                raise CommandError('Benchmark regressions:\n{}'.format('\n'.join(regressions)))
+            self.stderr.write(self.style.SUCCESS('No regressions against {}'.format(options['baseline'])))
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_date
+
+from subscription.seeding import DEFAULT_PASSWORD, SEED_TODAY, seed_subscriptions
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds plans, customers, subscriptions, renewal dates and websites for scale testing, '
+        'deterministically from a random seed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000, help='Customers to create.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the generated data.')
+        parser.add_argument('--skew', type=float, default=1.5,
+                            help='Pareto shape of the websites per customer, lower values are more skewed.')
+        parser.add_argument('--max-websites', type=int, default=1000, help='Max websites of a single customer.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Customers written per batch.')
+        parser.add_argument('--password', default=DEFAULT_PASSWORD,
+                            help='Password of every customer, default "{}".'.format(DEFAULT_PASSWORD))
+        parser.add_argument('--today', help='Day (YYYY-MM-DD) the signup and renewal dates are relative to, '
+                                            'default {}.'.format(SEED_TODAY.isoformat()))
+        parser.add_argument('--no-copy', action='store_false', dest='use_copy', default=None,
+                            help='Use bulk_create on PostgreSQL as well, instead of COPY.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='Database to seed, without sharding (the customers go to their shards otherwise).')
+
+    def handle(self, *args, **options):
+        today = None
+        if options['today']:
+            today = parse_date(options['today'])
+            if today is None:
+                raise CommandError('Invalid date ({})'.format(options['today']))
+
+        started = time.monotonic()
+        customers, websites = seed_subscriptions(
+            options['customers'], seed=options['seed'], skew=options['skew'], max_websites=options['max_websites'],
+            batch_size=options['batch_size'], password=options['password'], use_copy=options['use_copy'],
+            today=today, using=options['database'],
+        )
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(self.style.SUCCESS('Seeded {} customers and {} websites in {:.2f}s ({:.0f} rows/s)'.format(
+            customers, websites, elapsed, (customers + websites) / max(elapsed, 1e-6)
+        )))
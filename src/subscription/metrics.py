@@ -0,0 +1,103 @@
+"""
+Operation level metrics: the subscription operations (subscribe_plan, change_plan, the quota checks and
+the website writes) are wrapped by timed_operation(), which sends the operation_finished signal with
+the operation name, duration (seconds) and outcome ('ok', 'rejected' for the quota rejections or 'error').
+
+The in process `aggregator` listens to it, keeping counters and rolling duration percentiles that the
+metrics view renders in the plain text (prometheus) exposition format.
+"""
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.dispatch import Signal
+
+from .exceptions import CustomerAddWebsitePermissionDenied
+from .instrumentation import RollingHistogram
+
+operation_finished = Signal(providing_args=['operation', 'duration', 'outcome'])
+
+
+@contextmanager
+def timed_operation(operation):
+    """Times the block (or decorated function) and sends operation_finished with its outcome."""
+    outcome = 'ok'
+    started = time.perf_counter()
+    try:
+        yield
+    except CustomerAddWebsitePermissionDenied:
+        outcome = 'rejected'
+        raise
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        operation_finished.send(
+            sender=timed_operation, operation=operation, duration=time.perf_counter() - started, outcome=outcome
+        )
+
+
+class MetricsAggregator:
+    """Aggregates the operation_finished signals into outcome counters and duration histograms."""
+
+    quantiles = (50, 90, 99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.counters = Counter()
+            self.durations_sum = Counter()
+            self.durations = defaultdict(
+                lambda: RollingHistogram(getattr(settings, 'SUBSCRIPTION_METRICS_HISTOGRAM_SIZE', 1000))
+            )
+
+    def __call__(self, sender, operation, duration, outcome, **kwargs):
+        with self._lock:
+            self.counters[(operation, outcome)] += 1
+            self.durations_sum[operation] += duration
+            histogram = self.durations[operation]
+        histogram.add(duration)
+
+    def render(self):
+        """Renders the metrics in the prometheus plain text exposition format."""
+        from .registry import plan_registry
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            durations = sorted(self.durations.items())
+            durations_sum = dict(self.durations_sum)
+
+        lines = ['# TYPE subscription_operations_total counter']
+        lines.extend(
+            'subscription_operations_total{{operation="{}",outcome="{}"}} {}'.format(operation, outcome, total)
+            for (operation, outcome), total in counters
+        )
+
+        lines.append('# TYPE subscription_operation_duration_seconds summary')
+        for operation, histogram in durations:
+            for quantile in self.quantiles:
+                lines.append('subscription_operation_duration_seconds{{operation="{}",quantile="{}"}} {:.6f}'.format(
+                    operation, quantile / 100, histogram.percentile(quantile) or 0
+                ))
+            lines.append('subscription_operation_duration_seconds_sum{{operation="{}"}} {:.6f}'.format(
+                operation, durations_sum[operation]
+            ))
+            lines.append('subscription_operation_duration_seconds_count{{operation="{}"}} {}'.format(
+                operation, sum(total for (name, _), total in counters if name == operation)
+            ))
+
+        for name, value in sorted(plan_registry.stats().items()):
+            metric = 'subscription_plan_registry_{}'.format(name if name == 'size' else '{}_total'.format(name))
+            lines.append('# TYPE {} {}'.format(metric, 'gauge' if name == 'size' else 'counter'))
+            lines.append('{} {}'.format(metric, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+aggregator = MetricsAggregator()
+operation_finished.connect(aggregator, dispatch_uid='subscription_metrics_aggregator')
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import subscription.models
+
+
+def populate_websites_count(apps, schema_editor):
+    Customer = apps.get_model('subscription', 'Customer')
+    Website = apps.get_model('subscription', 'Website')
+
+    websites = Website.objects.filter(
+        customer=OuterRef('pk')
+    ).order_by().values('customer').annotate(total=Count('pk')).values('total')
+    Customer.objects.using(schema_editor.connection.alias).update(
+        websites_count=Coalesce(Subquery(websites, output_field=IntegerField()), 0)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0001_squashed_0014_auto_20190814_1320'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='website',
+            options={'base_manager_name': 'objects', 'verbose_name': 'website', 'verbose_name_plural': 'websites'},
+        ),
+        migrations.AlterModelManagers(
+            name='customer',
+            managers=[
+                ('objects', subscription.models.CustomerManager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='websites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='websites count'),
+        ),
+        migrations.RunPython(populate_websites_count, migrations.RunPython.noop),
+    ]
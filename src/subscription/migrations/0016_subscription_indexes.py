@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0015_customer_websites_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['subscription', 'sub_renewal_date'], name='customer_plan_renewal_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['sub_renewal_date'], name='customer_renewal_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(condition=models.Q(subscription__isnull=False), fields=['-date_joined'], name='customer_subscribed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='website',
+            index=models.Index(fields=['customer', 'id'], name='website_customer_id_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0016_subscription_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=60, unique=True, verbose_name='name')),
+                ('last_value', models.BigIntegerField(default=0, verbose_name='last value')),
+            ],
+            options={
+                'verbose_name': 'id sequence',
+                'verbose_name_plural': 'id sequences',
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0017_id_sequence'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='customer',
+            name='customer_subscribed_idx',
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['-date_joined', '-id'], name='customer_joined_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(condition=models.Q(subscription__isnull=False), fields=['-date_joined', '-id'], name='customer_subscribed_id_idx'),
+        ),
+    ]
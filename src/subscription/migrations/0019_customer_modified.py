@@ -0,0 +1,20 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0018_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='modified'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0019_customer_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='over_quota_since',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='over quota since'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:20
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def populate_plan_daily_rollups(apps, schema_editor):
+    Customer = apps.get_model('subscription', 'Customer')
+    Plan = apps.get_model('subscription', 'Plan')
+    PlanDailyRollup = apps.get_model('subscription', 'PlanDailyRollup')
+    using = schema_editor.connection.alias
+
+    plans = Customer.objects.using(using).filter(subscription__isnull=False).order_by().values(
+        'subscription_id'
+    ).annotate(customers=Count('pk'), websites=Sum('websites_count'))
+    prices = dict(Plan.objects.using(using).values_list('pk', 'price'))
+    today = timezone.localdate()
+
+    PlanDailyRollup.objects.using(using).bulk_create([
+        PlanDailyRollup(
+            day=today, plan_id=plan['subscription_id'], customers=plan['customers'], websites=plan['websites'] or 0,
+            revenue=prices[plan['subscription_id']] * plan['customers'],
+        ) for plan in plans
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0020_customer_over_quota_since'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanDailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='day')),
+                ('customers', models.IntegerField(default=0, verbose_name='customers')),
+                ('websites', models.IntegerField(default=0, verbose_name='websites')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='revenue')),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='subscription.Plan')),
+            ],
+            options={
+                'verbose_name': 'plan daily rollup',
+                'verbose_name_plural': 'plan daily rollups',
+                'unique_together': {('plan', 'day')},
+            },
+        ),
+        migrations.RunPython(populate_plan_daily_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def populate_subscription_changes(apps, schema_editor):
+    # the history before this migration is unknown, the current subscriptions start at the customers signup
+    Customer = apps.get_model('subscription', 'Customer')
+    SubscriptionChange = apps.get_model('subscription', 'SubscriptionChange')
+    using = schema_editor.connection.alias
+
+    customers = Customer.objects.using(using).filter(subscription__isnull=False).order_by().values_list(
+        'pk', 'date_joined', 'subscription_id'
+    )
+    SubscriptionChange.objects.using(using).bulk_create((
+        SubscriptionChange(
+            customer_id=customer_id, customer_joined=date_joined, new_plan_id=plan_id, created=date_joined
+        ) for customer_id, date_joined, plan_id in customers.iterator()
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0021_plan_daily_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer_joined', models.DateTimeField(verbose_name='customer joined')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+                ('customer', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='subscription_changes', to=settings.AUTH_USER_MODEL)),
+                ('new_plan', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='subscription.Plan')),
+                ('old_plan', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='subscription.Plan')),
+            ],
+            options={
+                'verbose_name': 'subscription change',
+                'verbose_name_plural': 'subscription changes',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='subscriptionchange',
+            index=models.Index(fields=['customer', 'created'], name='subchange_customer_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriptionchange',
+            index=models.Index(fields=['created'], name='subchange_created_idx'),
+        ),
+        migrations.RunPython(populate_subscription_changes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0022_subscription_change'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryOffset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sink', models.CharField(max_length=255, unique=True, verbose_name='sink')),
+                ('last_event_id', models.BigIntegerField(default=0, verbose_name='last event id')),
+                ('delivered', models.BigIntegerField(default=0, verbose_name='delivered')),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now, verbose_name='updated')),
+            ],
+            options={
+                'verbose_name': 'delivery offset',
+                'verbose_name_plural': 'delivery offsets',
+            },
+        ),
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(max_length=60, verbose_name='event type')),
+                ('payload', models.TextField(verbose_name='payload')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+                ('published', models.DateTimeField(blank=True, null=True, verbose_name='published')),
+                ('customer', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='outbox_events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'outbox event',
+                'verbose_name_plural': 'outbox events',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(condition=models.Q(published__isnull=True), fields=['id'], name='outbox_pending_idx'),
+        ),
+    ]
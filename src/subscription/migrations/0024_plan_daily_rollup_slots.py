@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 01:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0023_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plandailyrollup',
+            name='slot',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='slot'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='plandailyrollup',
+            unique_together={('plan', 'slot', 'day')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0024_plan_daily_rollup_slots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='blocked_for_quota',
+            field=models.BooleanField(default=False, editable=False, verbose_name='blocked for quota'),
+        ),
+    ]
@@ -1,47 +1,306 @@
-from datetime import date, timedelta
+from collections import defaultdict, namedtuple
+from datetime import date
 
-from django.conf import settings
 from django.contrib.auth.models import AbstractUser, UserManager
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import Count, Exists, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from .utils import get_year_total_days
-from .exceptions import CustomerAddWebsitePermissionDenied
+from .utils import get_renewal_date
+from .entitlements import get_entitlements, invalidate_entitlements
+from .exceptions import CustomerAddWebsitePermissionDenied, SubscriptionConflict
+from .metrics import timed_operation
+from .outbox import (
+    WEBSITE_ADDED_EVENT, WEBSITE_REMOVED_EVENT, get_renewal_event, get_subscription_event, get_website_event,
+    record_events,
+)
+from .registry import plan_registry
+from .rollups import record_rollup_changes
+from .sharding import allocate_customer_ids, get_shard, is_moving_customer, sharding_enabled
 
 
-class SubscriptionManager(models.Manager):
+PlanChangeReport = namedtuple('PlanChangeReport', 'first_customer_id last_customer_id updated over_quota_ids')
+
+
+class ShardedQuerySetMixin:
+    """
+    QuerySet helpers for the models placed by the customer shard (see ShardRouter).
+    """
+
+    def on_shard(self, customer_id):
+        """Sends the queryset to the shard of the customer, when sharding is enabled."""
+        return self.using(get_shard(customer_id)) if sharding_enabled() else self
+
+    def create(self, **kwargs):
+        if self._db is not None or not sharding_enabled():
+            return super().create(**kwargs)
+
+        # QuerySet.create() saves to the queryset database, which can't know the shard without the instance
+        obj = self.model(**kwargs)
+        obj.save(force_insert=True)
+        return obj
+
+
+class CustomerQuerySet(ShardedQuerySetMixin, models.QuerySet):
+    """
+    QuerySet with the set based operations over the Customer denormalized counters.
+    """
+
+    def update(self, **kwargs):
+        # every write moves the customers version stamp (the save() ones go through auto_now),
+        # the historical models of the migrations before it was added don't have it though.
+        if any(field.name == 'modified' for field in self.model._meta.concrete_fields):
+            kwargs.setdefault('modified', timezone.now())
+        return super().update(**kwargs)
+    update.alters_data = True
+
+    def touch(self):
+        """Moves the customers version stamp, for the writes to their related rows (i.e: the websites urls)."""
+        return self.update()
+    touch.alters_data = True
+
+    def recount_websites(self):
+        """Rebuilds the websites_count column from the websites table, in a single UPDATE statement."""
+        websites = Website.objects.filter(
+            customer=OuterRef('pk')
+        ).order_by().values('customer').annotate(total=Count('pk')).values('total')
+
+        return self.update(websites_count=Coalesce(Subquery(websites, output_field=IntegerField()), 0))
+
+    def renewal_window(self, start, end):
+        """Returns the subscribed customers with the renewal date between `start` and `end` (inclusive)."""
+        return self.filter(subscription__isnull=False, sub_renewal_date__range=(start, end))
+
+    def change_plan(self, new_plan, chunk_size=1000):
+        """
+        Moves every subscribed customer in the queryset to `new_plan`, in chunks of UPDATE statements.
+
+        Follows SubscriptionManager.change_plan() semantics: the renewal date is reset, the customers without
+        subscription (or already in the new plan) are skipped. Returns a PlanChangeReport per chunk, flagging
+        the customers that own more websites than the new plan allows.
+        """
+        renewal_date = get_renewal_date(date.today())
+        # the chunks are read from the database written to, not a (lagging) replica
+        using = self._db or router.db_for_write(self.model)
+        customers = self.using(using).filter(subscription__isnull=False).exclude(subscription=new_plan)
+        reports = []
+        last_customer_id = None
+
+        while True:
+            chunk = customers.order_by('pk')
+            if last_customer_id is not None:
+                chunk = chunk.filter(pk__gt=last_customer_id)
+            customer_ids = list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not customer_ids:
+                break
+
+            with transaction.atomic(using=using):
+                changed = customers.filter(pk__in=customer_ids)
+                rows = list(changed.order_by().values_list('pk', 'date_joined', 'subscription_id', 'websites_count'))
+                over_quota_ids = []
+                if new_plan.total_websites_allowed:
+                    over_quota_ids = list(changed.filter(
+                        websites_count__gt=new_plan.total_websites_allowed
+                    ).order_by('pk').values_list('pk', flat=True))
+                updated = changed.update(subscription=new_plan, sub_renewal_date=renewal_date)
+                invalidate_entitlements(*customer_ids, using=using)
+                record_rollup_changes([
+                    change for customer_id, _, plan_id, websites_count in rows for change in (
+                        (customer_id, plan_id, -1, -websites_count), (customer_id, new_plan.pk, 1, websites_count),
+                    )
+                ], using=using)
+                record_subscription_changes([
+                    (customer_id, date_joined, plan_id, new_plan.pk, renewal_date)
+                    for customer_id, date_joined, plan_id, _ in rows
+                ], using=using)
+
+            last_customer_id = customer_ids[-1]
+            reports.append(PlanChangeReport(customer_ids[0], last_customer_id, updated, over_quota_ids))
+
+        return reports
+    change_plan.alters_data = True
+
+    def migrate_plan(self, old_plan, new_plan, chunk_size=1000):
+        """Moves every customer subscribed to `old_plan` to `new_plan`, see change_plan()."""
+        return self.filter(subscription=old_plan).change_plan(new_plan, chunk_size=chunk_size)
+    migrate_plan.alters_data = True
+
+    def renew(self, until=None):
+        """
+        Advances the renewal date of the subscribed customers in the queryset by one subscription period,
+        or by as many periods as needed for it to be after `until`, when given.
+
+        Runs one UPDATE per distinct renewal date (conditional on it, so renewing twice is harmless) instead
+        of saving each customer, and records a renewal event per customer and period renewed in the outbox
+        (the renewed customers are read first, so the querysets renewed must be bounded, i.e: chunks).
+        Their entitlements snapshots are invalidated. Returns the number of renewed customers.
+        """
+        using = self._db or router.db_for_write(self.model)
+        subscribed = self.using(using).filter(subscription__isnull=False, sub_renewal_date__isnull=False).order_by()
+        if until is not None:
+            subscribed = subscribed.filter(sub_renewal_date__lte=until)
+        renewed = None
+
+        while renewed is None or until is not None:
+            customers = defaultdict(list)
+            for customer_id, plan_id, renewal_date in subscribed.values_list(
+                'pk', 'subscription_id', 'sub_renewal_date'
+            ):
+                customers[renewal_date].append((customer_id, plan_id))
+            if not customers:
+                break
+
+            updated = 0
+            events = []
+            with transaction.atomic(using=using, savepoint=False):
+                for renewal_date, renewal_customers in customers.items():
+                    new_renewal_date = get_renewal_date(renewal_date)
+                    updated += subscribed.filter(sub_renewal_date=renewal_date).update(
+                        sub_renewal_date=new_renewal_date
+                    )
+                    events.extend(
+                        get_renewal_event(customer_id, plan_id, new_renewal_date)
+                        for customer_id, plan_id in renewal_customers
+                    )
+                record_events(events, using=using)
+                invalidate_entitlements(*(customer_id for _, customer_id, _ in events), using=using)
+            # the following rounds only catch up the customers overdue for more than one period
+            renewed = updated if renewed is None else renewed
+
+        return renewed or 0
+    renew.alters_data = True
+
+    def reserve_websites(self, total=1):
+        """
+        Increments the websites counter by `total`, but only for the customers whose plan has room for them.
+
+        The quota check and the write happen in the same conditional UPDATE statement, which only locks the
+        customers rows being updated, so concurrent writers can't push a customer over its plan limit.
+        Returns the number of customers that got the websites reserved.
+        """
+        has_room = Plan.objects.filter(pk=OuterRef('subscription_id')).filter(
+            Q(total_websites_allowed=0) | Q(total_websites_allowed__gte=OuterRef('websites_count') + total)
+        )
+
+        return self.annotate(has_room=Exists(has_room)).filter(has_room=True).update(
+            websites_count=F('websites_count') + total
+        )
+    reserve_websites.alters_data = True
+
+    def release_websites(self, total=1):
+        """Decrements the websites counter by `total`, giving back the reserved websites."""
+        return self.update(websites_count=F('websites_count') - total)
+    release_websites.alters_data = True
+
+    def over_quota(self):
+        """
+        Returns the customers owning more websites than their plan allows (i.e: after a downgrade), annotated
+        with `real_websites_count`: a single grouped query over the websites, not a check per customer.
+        """
+        return self.filter(subscription__total_websites_allowed__gt=0).annotate(
+            real_websites_count=Count('websites')
+        ).filter(real_websites_count__gt=F('subscription__total_websites_allowed'))
+
+    def detach_excess_websites(self):
+        """
+        Detaches the newest websites of the over quota customers in the queryset, the ones beyond what their
+        plan allows, returning how many were detached. The counters and outbox events follow (see
+        WebsiteQuerySet.update()).
+        """
+        using = self._db or router.db_for_write(self.model)
+        customers = self.using(using).over_quota().order_by().values_list('pk', 'subscription__total_websites_allowed')
+        website_ids = []
+        for customer_id, total_allowed in customers:
+            website_ids.extend(Website.objects.using(using).filter(customer=customer_id).order_by(
+                'id'
+            ).values_list('pk', flat=True)[total_allowed:])
+
+        if not website_ids:
+            return 0
+        return Website.objects.using(using).filter(pk__in=website_ids).update(customer=None)
+    detach_excess_websites.alters_data = True
+
+    def with_websites_count_drift(self):
+        """Returns the customers whose websites_count doesn't match the real number of websites."""
+        return self.annotate(real_websites_count=Count('websites')).exclude(
+            websites_count=F('real_websites_count')
+        )
+
+
+class CustomerManager(UserManager.from_queryset(CustomerQuerySet)):
+    pass
+
+
+class SubscriptionManager(models.Manager.from_queryset(CustomerQuerySet)):
     """
     Manager to handle the Customer subscriptions.
     """
 
     def get_queryset(self):
         """Override get queryset to return only the customers with current subscriptions."""
-        return super().get_queryset().exclude(subscription=None)
+        return super().get_queryset().filter(subscription__isnull=False)
 
+    @timed_operation('subscribe_plan')
     def subscribe_plan(self, customer, plan):
         """Method responsible of associating a plan to a customer object."""
-        if customer.subscription:
-            raise ValueError('User already subscribed to a plan ({})'.format(customer.subscription))
+        if customer.subscription_id:
+            raise ValueError('User already subscribed to a plan ({})'.format(customer.plan))
 
-        customer.subscription = plan
-        customer.save()
+        if customer._state.adding:
+            customer.subscription = plan
+            customer.save()
+        else:
+            self._update_subscription(customer, plan)
 
-        return customer.subscription
+        return customer.plan
 
+    @timed_operation('change_plan')
     def change_plan(self, customer, new_plan):
         """Method responsible of substituting the customer current subscription with another."""
-        if not customer.subscription:
+        if not customer.subscription_id:
             raise ValueError('There\'s no subscription plan to update')
-        if customer.subscription == new_plan:
+        if customer.subscription_id == new_plan.pk:
             raise ValueError('This plan ({}) is already associated with this customer ({})'.format(new_plan, customer))
 
-        # reset the renewal date since a new plan will be added
-        customer.sub_renewal_date = None
-        customer.subscription = new_plan
-        customer.save()
+        self._update_subscription(customer, new_plan)
 
         return True
 
+    def _update_subscription(self, customer, plan):
+        """
+        Writes only the subscription fields, with an UPDATE conditional on the subscription the customer
+        object holds (optimistic concurrency), raising SubscriptionConflict if it was changed meanwhile.
+        The renewal date is reset, since a new plan starts a new subscription period.
+        """
+        renewal_date = get_renewal_date(date.today())
+        modified = timezone.now()
+        using = router.db_for_write(self.model, instance=customer)
+        customers = self.model._base_manager.using(using).filter(pk=customer.pk)
+
+        with transaction.atomic(using=using, savepoint=False):
+            updated = customers.filter(subscription_id=customer.subscription_id).update(
+                subscription=plan, sub_renewal_date=renewal_date, modified=modified
+            )
+            if updated:
+                websites_count = Subquery(customers.order_by().values('websites_count'))
+                record_rollup_changes([
+                    (customer.pk, customer.subscription_id, -1, -websites_count),
+                    (customer.pk, plan.pk, 1, websites_count),
+                ], using=using)
+                record_subscription_changes(
+                    [(customer.pk, customer.date_joined, customer.subscription_id, plan.pk, renewal_date)], using=using
+                )
+        if not updated:
+            raise SubscriptionConflict('The subscription of {} was changed meanwhile'.format(customer))
+
+        customer.subscription = plan
+        customer.sub_renewal_date = renewal_date
+        customer.modified = modified
+        customer._loaded_subscription_id = plan.pk
+        invalidate_entitlements(customer.pk, using=using)
+
 
 class Customer(AbstractUser):
     # I can get the name field already with the first_name and last_name fields in the AbstractUser,
@@ -50,50 +309,186 @@ class Customer(AbstractUser):
     subscription = models.ForeignKey('Plan', on_delete=models.SET_NULL, null=True, blank=True)
     # readonly field (could make it 'editable=False', but I want to access it through ModelAdmin)
     sub_renewal_date = models.DateField(_('renewal date'), null=True, blank=True)
-
-    objects = UserManager()
+    # denormalized counter of the customer websites, maintained by the Website write paths,
+    # so the quota checks don't need to count the websites table rows.
+    websites_count = models.PositiveIntegerField(_('websites count'), default=0, editable=False)
+    # version stamp of the customer, its subscription and websites, moved by every write to them
+    # (see CustomerQuerySet.update()), so the API can answer the conditional requests from it alone.
+    modified = models.DateTimeField(_('modified'), auto_now=True)
+    # set by the quotas reconciliation (see the reconcile_quotas command) while owning more websites than allowed
+    over_quota_since = models.DateTimeField(_('over quota since'), null=True, blank=True, editable=False)
+    # set when the reconciliation block policy deactivated the customer, so only those are reactivated by it
+    blocked_for_quota = models.BooleanField(_('blocked for quota'), default=False, editable=False)
+
+    objects = CustomerManager()
     with_subscriptions = SubscriptionManager()
 
     class Meta:
         verbose_name = _('customer')
         verbose_name_plural = _('customers')
         ordering = ('-date_joined',)
+        indexes = [
+            # customers per plan, and per plan renewal windows
+            models.Index(fields=['subscription', 'sub_renewal_date'], name='customer_plan_renewal_idx'),
+            # renewal windows scans
+            models.Index(fields=['sub_renewal_date'], name='customer_renewal_idx'),
+            # customers keyset pages (see pagination.customer_keyset()), the default ordering with the id tiebreaker
+            models.Index(fields=['-date_joined', '-id'], name='customer_joined_id_idx'),
+            # with_subscriptions keyset pages (partial where the backend supports it)
+            models.Index(
+                fields=['-date_joined', '-id'], name='customer_subscribed_id_idx',
+                condition=Q(subscription__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         return 'Customer: {}'.format(self.username)
 
-    def save(self, *args, **kwargs):
-        self.sub_renewal_date = self.set_renewal_date()
-        super().save(*args, **kwargs)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The subscription the customer has in the database, so the renewal date is only recalculated on changes.
+        self._loaded_subscription_id = self.__dict__.get('subscription_id')
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        if fields is None or 'subscription' in fields or 'subscription_id' in fields:
+            self._loaded_subscription_id = self.subscription_id
 
-    def can_add_website(self):
-        if not self.subscription:
+    def save(self, *args, **kwargs):
+        if self.pk is None and sharding_enabled():
+            # the id decides the shard, so it must be unique across all of them (not one shard sequence)
+            self.pk = allocate_customer_ids()[0]
+            kwargs['force_insert'] = True
+
+        update_fields = kwargs.get('update_fields')
+        subscription_changed = self.subscription_id != self._loaded_subscription_id and (
+            update_fields is None or 'subscription' in update_fields or 'subscription_id' in update_fields
+        )
+        adding = self._state.adding
+
+        if self._state.adding or subscription_changed:
+            if not self._state.adding:
+                # a plan change starts a new subscription period, as in SubscriptionManager.change_plan()
+                self.sub_renewal_date = None
+            self.sub_renewal_date = self.set_renewal_date()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'sub_renewal_date'}
+
+        if kwargs.get('update_fields'):
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'modified'}
+
+        # websites_count is only changed through atomic F() updates, therefore a full save of an
+        # already existing customer (probably holding a stale counter value) must not overwrite it.
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'websites_count'
+            ]
+
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            super().save(*args, **kwargs)
+            if adding:
+                record_rollup_changes([(self.pk, self.subscription_id, 1, self.websites_count)], using=using)
+                record_subscription_changes(
+                    [(self.pk, self.date_joined, None, self.subscription_id, self.sub_renewal_date)], using=using
+                )
+            elif subscription_changed:
+                # the in memory counter could be stale, see above
+                websites_count = Subquery(type(self)._base_manager.using(using).filter(pk=self.pk).order_by().values(
+                    'websites_count'
+                ))
+                record_rollup_changes([
+                    (self.pk, self._loaded_subscription_id, -1, -websites_count),
+                    (self.pk, self.subscription_id, 1, websites_count),
+                ], using=using)
+                record_subscription_changes([(
+                    self.pk, self.date_joined, self._loaded_subscription_id, self.subscription_id,
+                    self.sub_renewal_date,
+                )], using=using)
+        self._loaded_subscription_id = self.subscription_id
+
+    @property
+    def plan(self):
+        """The subscribed plan, resolved through the plan registry instead of fetching the foreign key."""
+        if not self.subscription_id:
+            return None
+
+        subscription_field = self._meta.get_field('subscription')
+        if not subscription_field.is_cached(self):
+            subscription_field.set_cached_value(self, plan_registry.get(self.subscription_id))
+
+        return self.subscription
+
+    @timed_operation('quota_check')
+    def can_add_website(self, use_snapshot=False):
+        """
+        Checks if the customer plan allows one more website.
+
+        With `use_snapshot` the check is made against the cached entitlements snapshot (see get_entitlements()),
+        which is meant for read only checks, the writes are always checked by Website.save().
+        """
+        if use_snapshot:
+            entitlements = self.get_entitlements()
+            if entitlements.plan_type is None:
+                raise models.ObjectDoesNotExist('Customer Subscription doesn\'t exist')
+            return entitlements.allows_websites()
+
+        plan = self.plan
+        if not plan:
             raise models.ObjectDoesNotExist('Customer Subscription doesn\'t exist')
 
-        allows_infinite = self.subscription.total_websites_allowed == 0
-        return allows_infinite or self.websites.count() + 1 <= self.subscription.total_websites_allowed
+        allows_infinite = plan.total_websites_allowed == 0
+        return allows_infinite or self.websites_count + 1 <= plan.total_websites_allowed
+
+    def get_entitlements(self):
+        """Returns the (cached) snapshot of the customer plan type, websites limit, usage and renewal date."""
+        return get_entitlements(self.pk)
+
+    def get_add_website_error(self):
+        """Returns the exception to raise when a website can't be added to this customer."""
+        if not self.subscription_id:
+            return models.ObjectDoesNotExist('Customer Subscription doesn\'t exist')
+
+        return CustomerAddWebsitePermissionDenied(
+            'Customer can\'t add more websites. Total allowed: {}'.format(self.get_total_websites_allowed())
+        )
 
     def get_name(self):
         return '{} {}'.format(self.first_name, self.last_name)
 
     def get_total_websites_allowed(self):
-        if self.subscription:
-            return self.subscription.total_websites_allowed
+        if self.plan:
+            return self.plan.total_websites_allowed
 
     def set_renewal_date(self):
         """Calculates the renewal subscription date based if the user has an active subscription or not"""
-        renewal_date = None
+        # An active subscription keeps its renewal date (it's moved forward by the renewals processing).
+        renewal_date = self.sub_renewal_date if self.subscription_id else None
 
         # If there's a subscription and not renewal_date then calculate it now.
-        if self.subscription and not self.sub_renewal_date:
-            today = date.today()
-
-            sub_ttl_days = getattr(settings, 'SUBSCRIPTION_TTL_DAYS', get_year_total_days(today.year + 1))
-            renewal_date = today + timedelta(days=sub_ttl_days)
+        if self.subscription_id and not self.sub_renewal_date:
+            renewal_date = get_renewal_date(date.today())
 
         return renewal_date
 
 
+class IdSequence(models.Model):
+    """
+    Named sequences in the default database, for the ids that must be unique across the shards
+    (see sharding.allocate_customer_ids()).
+    """
+    name = models.CharField(_('name'), max_length=60, unique=True)
+    last_value = models.BigIntegerField(_('last value'), default=0)
+
+    class Meta:
+        verbose_name = _('id sequence')
+        verbose_name_plural = _('id sequences')
+
+    def __str__(self):
+        return 'IdSequence: {}'.format(self.name)
+
+
 class Plan(models.Model):
     PLAN_TYPE_CHOICES = (('single', _('single')), ('plus', _('plus')), ('infinite', _('unlimited')))
 
@@ -133,25 +528,376 @@ class Plan(models.Model):
         super().save(*args, **kwargs)
 
 
+class SubscriptionChange(models.Model):
+    """
+    History of the customers subscriptions: a row per plan change, subscribing (no old plan) and cancelling
+    (no new plan) included, read by the cohort and churn analytics (see analytics.py).
+
+    The customer signup date is copied, so the cohorts don't need the customers table, and the history
+    outlives the customers and plans it references (no foreign key constraints).
+    """
+    customer = models.ForeignKey(
+        'Customer', on_delete=models.DO_NOTHING, db_constraint=False, related_name='subscription_changes'
+    )
+    customer_joined = models.DateTimeField(_('customer joined'))
+    old_plan = models.ForeignKey(
+        'Plan', on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+'
+    )
+    new_plan = models.ForeignKey(
+        'Plan', on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+'
+    )
+    created = models.DateTimeField(_('created'), default=timezone.now)
+
+    class Meta:
+        verbose_name = _('subscription change')
+        verbose_name_plural = _('subscription changes')
+        indexes = [
+            # the customers history in order, streamed by the cohorts
+            models.Index(fields=['customer', 'created'], name='subchange_customer_created_idx'),
+            # the changes of a period, grouped by the churn matrix
+            models.Index(fields=['created'], name='subchange_created_idx'),
+        ]
+
+    def __str__(self):
+        return 'SubscriptionChange: {} {} -> {}'.format(self.customer_id, self.old_plan_id, self.new_plan_id)
+
+
+def record_subscription_changes(changes, using):
+    """
+    Writes the (customer_id, customer_joined, old_plan_id, new_plan_id, renewal_date) changes to the subscription
+    history, and their events to the outbox (see outbox.record_events()).
+    """
+    changes = [change for change in changes if change[2] != change[3]]
+    if not changes:
+        return
+
+    created = timezone.now()
+    SubscriptionChange.objects.using(using).bulk_create([
+        SubscriptionChange(
+            customer_id=customer_id, customer_joined=customer_joined, old_plan_id=old_plan_id,
+            new_plan_id=new_plan_id, created=created,
+        ) for customer_id, customer_joined, old_plan_id, new_plan_id, _ in changes
+    ])
+    record_events([
+        get_subscription_event(customer_id, old_plan_id, new_plan_id, renewal_date)
+        for customer_id, _, old_plan_id, new_plan_id, renewal_date in changes
+    ], using=using)
+
+
+class OutboxEvent(models.Model):
+    """
+    A subscription event waiting to be published to the downstream services (see outbox.py), written in the
+    same transaction as the change it describes. `payload` is JSON text.
+    """
+    event_type = models.CharField(_('event type'), max_length=60)
+    customer = models.ForeignKey(
+        'Customer', on_delete=models.DO_NOTHING, db_constraint=False, related_name='outbox_events'
+    )
+    payload = models.TextField(_('payload'))
+    created = models.DateTimeField(_('created'), default=timezone.now)
+    # set by the relay once the sink took the event
+    published = models.DateTimeField(_('published'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('outbox event')
+        verbose_name_plural = _('outbox events')
+        indexes = [
+            # the pending events in order, read by the relay (partial where the backend supports it)
+            models.Index(fields=['id'], name='outbox_pending_idx', condition=Q(published__isnull=True)),
+        ]
+
+    def __str__(self):
+        return 'OutboxEvent: {} {}'.format(self.pk, self.event_type)
+
+
+class DeliveryOffset(models.Model):
+    """The last outbox event id published to a sink, and how many were, moved with every relayed batch."""
+    sink = models.CharField(_('sink'), max_length=255, unique=True)
+    last_event_id = models.BigIntegerField(_('last event id'), default=0)
+    delivered = models.BigIntegerField(_('delivered'), default=0)
+    updated = models.DateTimeField(_('updated'), default=timezone.now)
+
+    class Meta:
+        verbose_name = _('delivery offset')
+        verbose_name_plural = _('delivery offsets')
+
+    def __str__(self):
+        return 'DeliveryOffset: {} {}'.format(self.sink, self.last_event_id)
+
+
+class WebsiteQuerySet(ShardedQuerySetMixin, models.QuerySet):
+    """
+    QuerySet that keeps the Customer.websites_count counter, the plans rollups and the outbox events in step
+    with the bulk operations.
+    """
+    # bulk_register() policies, when the batch doesn't fit in the customer plan
+    REJECT_POLICY = 'reject'  # nothing is registered
+    PARTIAL_POLICY = 'partial'  # the urls that fit are registered, following the batch order
+
+    @timed_operation('website_bulk_register')
+    def bulk_register(self, customer, urls, policy=REJECT_POLICY, batch_size=None):
+        """
+        Registers a batch of urls to a customer, checking the plan quota once for the whole batch.
+
+        The websites are reserved with a single conditional UPDATE (see CustomerQuerySet.reserve_websites())
+        and inserted with bulk_create, in the same transaction. Raises CustomerAddWebsitePermissionDenied
+        when no website could be registered (or the batch doesn't fit, with the reject policy).
+        """
+        if policy not in (self.REJECT_POLICY, self.PARTIAL_POLICY):
+            raise ValueError('Unknown bulk register policy ({})'.format(policy))
+
+        urls = list(urls)
+        if not urls:
+            return []
+
+        using = self._db or router.db_for_write(self.model, instance=customer)
+        customers = Customer.objects.using(using).filter(pk=customer.pk)
+        total = len(urls)
+
+        with transaction.atomic(using=using, savepoint=False):
+            reserved = customers.reserve_websites(total)
+
+            # Every failed reservation means other writers took some of the remaining websites,
+            # so the loop always ends (at most when there's no room left at all).
+            while not reserved and policy == self.PARTIAL_POLICY and total:
+                websites_count, total_allowed = customers.values_list(
+                    'websites_count', 'subscription__total_websites_allowed'
+                ).get()
+                total = max((total_allowed or 0) - websites_count, 0)
+                reserved = total and customers.reserve_websites(total)
+
+            websites = []
+            if reserved:
+                websites = self.using(using).bulk_create(
+                    [self.model(url=url, customer=customer) for url in urls[:total]], batch_size=batch_size
+                )
+                invalidate_entitlements(customer.pk, using=using)
+                record_rollup_changes([(customer.pk, customer.subscription_id, 0, total)], using=using)
+                # the website ids are only known on the backends returning them from bulk inserts
+                record_events([
+                    get_website_event(WEBSITE_ADDED_EVENT, customer.pk, website.pk, website.url) for website in websites
+                ], using=using)
+
+        if not reserved:
+            raise customer.get_add_website_error()
+
+        customer.websites_count += total
+        return websites
+    bulk_register.alters_data = True
+
+    def update(self, **kwargs):
+        # the websites are read from the database written to, not a (lagging) replica
+        using = self._db or router.db_for_write(self.model)
+        queryset = self.using(using)
+        if 'customer' not in kwargs and 'customer_id' not in kwargs:
+            with transaction.atomic(using=using, savepoint=False):
+                customer_ids = set(queryset.exclude(customer=None).values_list('customer_id', flat=True).distinct())
+                rows = super().update(**kwargs)
+                # the websites changed, but not their customers counters
+                if customer_ids:
+                    Customer.objects.using(using).filter(pk__in=customer_ids).touch()
+            return rows
+
+        new_customer = kwargs.get('customer', kwargs.get('customer_id'))
+        new_customer_id = getattr(new_customer, 'pk', new_customer)
+        customers = Customer.objects.using(using)
+        with transaction.atomic(using=using, savepoint=False):
+            changes = queryset.get_rollup_changes(-1)
+            websites = queryset.get_websites()
+            customer_ids = {customer_id for _, customer_id, _ in websites if customer_id is not None}
+            # the websites moved in are checked against the plan quota as a batch, see bulk_register()
+            added = sum(1 for _, customer_id, _ in websites if customer_id != new_customer_id)
+            reserved = new_customer_id is None or not added or customers.filter(
+                pk=new_customer_id
+            ).reserve_websites(added)
+
+            if reserved:
+                rows = super().update(**kwargs)
+                if new_customer_id is not None:
+                    customer_ids.add(new_customer_id)
+                    changes.append((
+                        new_customer_id, customers.filter(pk=new_customer_id).values_list(
+                            'subscription_id', flat=True
+                        ).first(), 0, rows,
+                    ))
+                if customer_ids:
+                    customers.filter(pk__in=customer_ids).recount_websites()
+                    invalidate_entitlements(*customer_ids, using=using)
+                record_rollup_changes(changes, using=using)
+                record_events([
+                    get_website_event(event_type, customer_id, website_id, url)
+                    for website_id, previous_customer_id, url in websites if previous_customer_id != new_customer_id
+                    for event_type, customer_id in (
+                        (WEBSITE_REMOVED_EVENT, previous_customer_id), (WEBSITE_ADDED_EVENT, new_customer_id),
+                    ) if customer_id is not None
+                ], using=using)
+
+        if not reserved:
+            raise customers.get(pk=new_customer_id).get_add_website_error()
+
+        return rows
+    update.alters_data = True
+
+    def delete(self):
+        using = self._db or router.db_for_write(self.model)
+        queryset = self.using(using)
+        with transaction.atomic(using=using, savepoint=False):
+            changes = queryset.get_rollup_changes(-1)
+            websites = queryset.get_websites()
+            customer_ids = {customer_id for _, customer_id, _ in websites if customer_id is not None}
+            deleted = super().delete()
+            if customer_ids:
+                Customer.objects.using(using).filter(pk__in=customer_ids).recount_websites()
+                invalidate_entitlements(*customer_ids, using=using)
+            record_rollup_changes(changes, using=using)
+            # the websites of a customer moved to another shard aren't removed (see sharding.move_customer())
+            if not is_moving_customer():
+                record_events([
+                    get_website_event(WEBSITE_REMOVED_EVENT, customer_id, website_id, url)
+                    for website_id, customer_id, url in websites if customer_id is not None
+                ], using=using)
+
+        return deleted
+    delete.alters_data = True
+
+    def get_websites(self):
+        """
+        The (id, customer_id, url) of the websites in the queryset, read before a bulk write for its outbox events,
+        so the querysets written must be bounded (i.e: a customer websites, the admin selection).
+        """
+        return list(self.order_by('pk').values_list('pk', 'customer_id', 'url'))
+
+    def get_rollup_changes(self, sign):
+        """The websites in the queryset as plans rollups changes (see rollups.record_rollup_changes())."""
+        customers = self.exclude(customer=None).order_by().values(
+            'customer_id', 'customer__subscription_id'
+        ).annotate(total=Count('pk'))
+        return [
+            (customer['customer_id'], customer['customer__subscription_id'], 0, sign * customer['total'])
+            for customer in customers
+        ]
+
+
 class Website(models.Model):
     url = models.URLField(_('url'))
     # Why overriding the related_name? It's mainly for redability reasons,
     # but I go by the default django convention (i.e: default related_name="website_set") if that's the convention you guys use.
     customer = models.ForeignKey('Customer', on_delete=models.SET_NULL, null=True, related_name='websites')
 
+    objects = models.Manager.from_queryset(WebsiteQuerySet)()
+
     class Meta:
         verbose_name = _('website')
         verbose_name_plural = _('websites')
+        indexes = [
+            # customer websites ordered by id, also the websites keyset pages (see pagination.website_keyset())
+            models.Index(fields=['customer', 'id'], name='website_customer_id_idx'),
+        ]
+        # the related managers bulk operations (i.e: customer.websites.add()) go through the base manager,
+        # so it needs to be the one maintaining the customers websites counter.
+        base_manager_name = 'objects'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The customer the website has in the database, used to move the websites counters on save.
+        self._loaded_customer_id = self.__dict__.get('customer_id')
 
     def __str__(self):
         return 'Website: {}'.format(self.url)
 
     def save(self, *args, **kwargs):
-        if self.customer and not self.customer.can_add_website():
-            raise CustomerAddWebsitePermissionDenied(
-                'Customer can\'t add more websites. Total allowed: {}'.format(
-                    self.customer.get_total_websites_allowed()
-                )
-            )
+        update_fields = kwargs.get('update_fields')
+        previous_customer_id = None if self._state.adding else self._loaded_customer_id
+        customer_changed = self.customer_id != previous_customer_id and (
+            update_fields is None or 'customer' in update_fields or 'customer_id' in update_fields
+        )
+
+        if not customer_changed:
+            using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+            with transaction.atomic(using=using, savepoint=False):
+                super().save(*args, **kwargs)
+                if self.customer_id is not None:
+                    Customer.objects.using(using).filter(pk=self.customer_id).touch()
+            return
+
+        with timed_operation('website_save'):
+            self._save_with_quota(previous_customer_id, *args, **kwargs)
+
+    def _save_with_quota(self, previous_customer_id, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        if not self._state.adding and self._state.db != using:
+            raise ValueError('Can\'t move a website to a customer in another database ({})'.format(using))
+        customers = Customer.objects.using(using)
+
+        with transaction.atomic(using=using, savepoint=False):
+            # the quota check and the counter increment are a single statement, see reserve_websites()
+            reserved = self.customer_id is None or customers.filter(pk=self.customer_id).reserve_websites()
+            if reserved:
+                super().save(*args, **kwargs)
+                if previous_customer_id is not None:
+                    customers.filter(pk=previous_customer_id).release_websites()
+                customer_ids = [pk for pk in (previous_customer_id, self.customer_id) if pk is not None]
+                invalidate_entitlements(*customer_ids, using=using)
+
+                plans = dict(customers.filter(pk__in=customer_ids).values_list('pk', 'subscription_id'))
+                record_rollup_changes([
+                    (previous_customer_id, plans.get(previous_customer_id), 0, -1),
+                    (self.customer_id, plans.get(self.customer_id), 0, 1),
+                ], using=using)
+                record_events([
+                    get_website_event(event_type, customer_id, self.pk, self.url) for event_type, customer_id in (
+                        (WEBSITE_REMOVED_EVENT, previous_customer_id), (WEBSITE_ADDED_EVENT, self.customer_id),
+                    ) if customer_id is not None
+                ], using=using)
+
+        # raised outside the atomic block, so an outer transaction is still usable by the caller
+        if not reserved:
+            raise self.customer.get_add_website_error()
+
+        # keep the in memory customer counter in step as well
+        if self.customer_id is not None and self._meta.get_field('customer').is_cached(self):
+            self.customer.websites_count += 1
+        self._loaded_customer_id = self.customer_id
+
+    def delete(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        # before the delete clears the id
+        event = get_website_event(WEBSITE_REMOVED_EVENT, self._loaded_customer_id, self.pk, self.url)
+        with transaction.atomic(using=using, savepoint=False):
+            deleted = super().delete(*args, **kwargs)
+            if self._loaded_customer_id is not None:
+                customers = Customer.objects.using(using).filter(pk=self._loaded_customer_id)
+                customers.release_websites()
+                invalidate_entitlements(self._loaded_customer_id, using=using)
+                record_rollup_changes([
+                    (self._loaded_customer_id, customers.values_list('subscription_id', flat=True).first(), 0, -1)
+                ], using=using)
+                record_events([event], using=using)
+
+        return deleted
+
+
+class PlanDailyRollup(models.Model):
+    """
+    Daily snapshot of a plan: its customers, their websites and the revenue (customers times the plan price).
 
-        super().save(*args, **kwargs)
+    Maintained incrementally by the subscription and website write paths (see rollups.record_rollup_changes()),
+    so the dashboards read a few rows per plan instead of aggregating the customers table. Each plan day is
+    spread over slot rows, by customer id (see rollups.get_rollup_slot()), and its snapshot is their sum. A slot
+    only gets a row on the days it changed, the rebuild_rollups command rewrites them from the customers table.
+    """
+    day = models.DateField(_('day'))
+    plan = models.ForeignKey('Plan', on_delete=models.CASCADE, related_name='daily_rollups')
+    slot = models.PositiveSmallIntegerField(_('slot'), default=0)
+    customers = models.IntegerField(_('customers'), default=0)
+    websites = models.IntegerField(_('websites'), default=0)
+    revenue = models.DecimalField(_('revenue'), max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = _('plan daily rollup')
+        verbose_name_plural = _('plan daily rollups')
+        # also the latest row of a slot lookup
+        unique_together = ('plan', 'slot', 'day')
+
+    def __str__(self):
+        return 'PlanDailyRollup: {} {} #{}'.format(self.plan_id, self.day, self.slot)
@@ -0,0 +1,194 @@
+"""
+Transactional outbox of the subscription events, for the downstream services (i.e: billing).
+
+The write paths record their events (record_events()) in the OutboxEvent table, in the same transaction
+(and database) as the write itself, so an event exists if and only if its write was committed, without
+any network call on the write path. The relay_outbox command publishes them afterwards to a sink, in
+batches (see relay()): delivery is at least once, the event ids are the idempotency keys downstream.
+"""
+import json
+import os
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .exceptions import OutboxDeliveryError
+
+SUBSCRIBED_EVENT = 'subscription.subscribed'
+PLAN_CHANGED_EVENT = 'subscription.plan_changed'
+CANCELLED_EVENT = 'subscription.cancelled'
+RENEWED_EVENT = 'subscription.renewed'
+WEBSITE_ADDED_EVENT = 'website.added'
+WEBSITE_REMOVED_EVENT = 'website.removed'
+
+
+def record_events(events, using=None):
+    """Writes the (event_type, customer_id, payload) events to the outbox, with a single INSERT."""
+    from .models import OutboxEvent
+
+    encoder = DjangoJSONEncoder()
+    created = timezone.now()
+    OutboxEvent.objects.using(using or DEFAULT_DB_ALIAS).bulk_create([
+        OutboxEvent(event_type=event_type, customer_id=customer_id, payload=encoder.encode(payload), created=created)
+        for event_type, customer_id, payload in events
+    ])
+
+
+def get_subscription_event(customer_id, old_plan_id, new_plan_id, renewal_date):
+    """The (event_type, customer_id, payload) event of a subscription change."""
+    if old_plan_id is None:
+        event_type = SUBSCRIBED_EVENT
+    elif new_plan_id is None:
+        event_type = CANCELLED_EVENT
+    else:
+        event_type = PLAN_CHANGED_EVENT
+
+    return event_type, customer_id, {
+        'customer_id': customer_id, 'old_plan_id': old_plan_id, 'plan_id': new_plan_id, 'renewal_date': renewal_date,
+    }
+
+
+def get_renewal_event(customer_id, plan_id, renewal_date):
+    return RENEWED_EVENT, customer_id, {'customer_id': customer_id, 'plan_id': plan_id, 'renewal_date': renewal_date}
+
+
+def get_website_event(event_type, customer_id, website_id, url):
+    return event_type, customer_id, {'customer_id': customer_id, 'website_id': website_id, 'url': url}
+
+
+def serialize_event(event):
+    return {
+        'id': event.pk, 'type': event.event_type, 'customer_id': event.customer_id,
+        'payload': json.loads(event.payload), 'created': event.created,
+    }
+
+
+class Sink:
+    """
+    Where the relay publishes the events. deliver() gets a batch of events (ordered by id) and must raise
+    when it couldn't take them all, so the batch stays in the outbox and is delivered again.
+    """
+    name = None
+
+    def deliver(self, events):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileSink(Sink):
+    """Appends the events to a local NDJSON file, synced to disk before the batch is marked as published."""
+    name = 'file'
+
+    def __init__(self, path='outbox.ndjson'):
+        self.path = path
+        self.encoder = DjangoJSONEncoder()
+
+    def deliver(self, events):
+        with open(self.path, 'a', encoding='utf-8') as sink_file:
+            sink_file.writelines(self.encoder.encode(serialize_event(event)) + '\n' for event in events)
+            sink_file.flush()
+            os.fsync(sink_file.fileno())
+
+
+class HttpSink(Sink):
+    """POSTs each batch as {"events": [...]} to an HTTP endpoint, standing in for the downstream service API."""
+    name = 'http'
+
+    def __init__(self, url, token=None, timeout=10):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        self.encoder = DjangoJSONEncoder()
+
+    def deliver(self, events):
+        request = urllib.request.Request(
+            self.url, data=self.encoder.encode({'events': [serialize_event(event) for event in events]}).encode(),
+            headers={'Content-Type': 'application/json'}, method='POST',
+        )
+        if self.token:
+            request.add_header('Authorization', 'Bearer {}'.format(self.token))
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                status = response.status
+        except (urllib.error.URLError, OSError) as error:
+            raise OutboxDeliveryError('Delivery to {} failed ({})'.format(self.url, error)) from error
+        if not 200 <= status < 300:
+            raise OutboxDeliveryError('Delivery to {} failed (HTTP {})'.format(self.url, status))
+
+
+SINKS = {FileSink.name: FileSink, HttpSink.name: HttpSink}
+
+
+def get_sink(name=None, **options):
+    """
+    Returns the sink `name` (a SINKS alias or a Sink subclass dotted path), settings.SUBSCRIPTION_OUTBOX_SINK by
+    default, built with settings.SUBSCRIPTION_OUTBOX_SINK_OPTIONS updated with `options`.
+    """
+    name = name or getattr(settings, 'SUBSCRIPTION_OUTBOX_SINK', FileSink.name)
+    sink_class = SINKS[name] if name in SINKS else import_string(name)
+    return sink_class(**{**getattr(settings, 'SUBSCRIPTION_OUTBOX_SINK_OPTIONS', {}), **options})
+
+
+def relay_batch(sink, using=None, batch_size=100):
+    """
+    Publishes the oldest pending events of the database to the sink, returning how many were.
+
+    The batch is locked with SELECT ... FOR UPDATE SKIP LOCKED (where supported), so concurrent relays take
+    different batches instead of waiting for each other, and is marked as published, moving the sink
+    delivery offset, in the same transaction: a failed delivery leaves it pending.
+    """
+    from .models import DeliveryOffset, OutboxEvent
+
+    using = using or DEFAULT_DB_ALIAS
+    features = connections[using].features
+
+    with transaction.atomic(using=using):
+        pending = OutboxEvent.objects.using(using).filter(published__isnull=True).order_by('pk')
+        if features.has_select_for_update:
+            pending = pending.select_for_update(skip_locked=features.has_select_for_update_skip_locked)
+        events = list(pending[:batch_size])
+        if not events:
+            return 0
+
+        sink.deliver(events)
+
+        OutboxEvent.objects.using(using).filter(pk__in=[event.pk for event in events]).update(
+            published=timezone.now()
+        )
+        offset, _ = DeliveryOffset.objects.using(using).get_or_create(sink=sink.name)
+        DeliveryOffset.objects.using(using).filter(pk=offset.pk).update(
+            last_event_id=Greatest(F('last_event_id'), events[-1].pk), delivered=F('delivered') + len(events),
+            updated=timezone.now(),
+        )
+
+    return len(events)
+
+
+def relay(sink, using=None, batch_size=100, max_batches=None):
+    """Publishes the pending events of the database in batches, until none is left (or `max_batches`)."""
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        relayed = relay_batch(sink, using=using, batch_size=batch_size)
+        if not relayed:
+            break
+        total += relayed
+        batches += 1
+    return total
+
+
+def purge_published(before, using=None):
+    """Deletes the events published before `before`, returning how many were."""
+    from .models import OutboxEvent
+
+    deleted, _ = OutboxEvent.objects.using(using or DEFAULT_DB_ALIAS).filter(published__lt=before).delete()
+    return deleted
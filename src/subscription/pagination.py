@@ -0,0 +1,160 @@
+import base64
+import binascii
+import datetime
+import json
+from collections import namedtuple
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from .exceptions import InvalidCursor
+from .models import Customer
+
+KeysetPage = namedtuple('KeysetPage', 'object_list next_cursor')
+
+CUSTOMER_ORDERING = ('-date_joined', '-id')
+WEBSITE_ORDERING = ('id',)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that avoids the exact COUNT(*) over very large tables.
+
+    For unfiltered querysets on PostgreSQL, the planner row estimate of the table is used instead, once it's
+    above `estimate_threshold` rows (below it the exact count is cheap enough). Any other case is counted.
+    """
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        estimate = self.get_estimated_count()
+        if estimate is not None and estimate >= self.estimate_threshold:
+            return estimate
+        return super().count
+
+    def get_estimated_count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where or query.distinct:
+            return None
+
+        connection = connections[self.object_list.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE relname = %s', [self.object_list.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+
+        return int(row[0]) if row else None
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """JSON encoder keeping the datetimes microseconds (DjangoJSONEncoder drops them), cursors must be exact."""
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset by its ordering keys (keyset/seek pagination) instead of OFFSET.
+
+    Every page is a `WHERE (keys) after (last keys of the previous page) ORDER BY keys LIMIT n` query, so
+    with an index matching `ordering` deep pages cost the same as the first one, and rows inserted meanwhile
+    don't shift the pages. The ordering fields must go in the same direction and end in a unique one. The
+    pages are addressed by opaque cursors (see get_page()) and only move forward.
+    """
+
+    def __init__(self, queryset, ordering, per_page=100):
+        descending = {field.startswith('-') for field in ordering}
+        if len(descending) != 1:
+            raise ValueError('The keyset ordering fields must go in the same direction ({})'.format(ordering))
+
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.descending = descending.pop()
+        self.fields = [field.lstrip('-') for field in ordering]
+        self.per_page = per_page
+
+    def get_page(self, cursor=None):
+        """Returns the KeysetPage after the `cursor` (the first one without it), raising InvalidCursor on bad ones."""
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self.get_after_filter(self.decode_cursor(cursor)))
+
+        object_list = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(object_list) > self.per_page:
+            object_list = object_list[:self.per_page]
+            next_cursor = self.encode_cursor(self.get_keys(object_list[-1]))
+
+        return KeysetPage(object_list, next_cursor)
+
+    def pages(self):
+        """Iterates the object lists of every page (a bounded query each), for the exports and batch jobs."""
+        cursor = None
+        while True:
+            page = self.get_page(cursor)
+            yield page.object_list
+            if page.next_cursor is None:
+                break
+            cursor = page.next_cursor
+
+    def __iter__(self):
+        for object_list in self.pages():
+            yield from object_list
+
+    def get_after_filter(self, keys):
+        """(a, b) > (x, y) as (a > x) OR (a = x AND b > y), which every backend can match with the index."""
+        lookup = 'lt' if self.descending else 'gt'
+        conditions = []
+        for position, field in enumerate(self.fields):
+            equal = {name: keys[number] for number, name in enumerate(self.fields[:position])}
+            conditions.append(Q(**equal, **{'{}__{}'.format(field, lookup): keys[position]}))
+        return reduce(lambda left, right: left | right, conditions)
+
+    def get_keys(self, obj):
+        if isinstance(obj, dict):
+            return [obj[field] for field in self.fields]
+        return [getattr(obj, field) for field in self.fields]
+
+    def encode_cursor(self, keys):
+        data = json.dumps(keys, cls=CursorEncoder, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            keys = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise InvalidCursor('Invalid cursor')
+        if not isinstance(keys, list) or len(keys) != len(self.fields):
+            raise InvalidCursor('Invalid cursor')
+
+        # back to the fields python types (i.e: the datetimes are strings in the cursor)
+        opts = self.queryset.model._meta
+        try:
+            return [
+                (opts.pk if field == 'pk' else opts.get_field(field)).to_python(key)
+                for field, key in zip(self.fields, keys)
+            ]
+        except ValidationError:
+            raise InvalidCursor('Invalid cursor')
+
+
+def customer_keyset(queryset=None, per_page=100):
+    """Keyset paginator of the customers (i.e: Customer.with_subscriptions.all()), newest first."""
+    return KeysetPaginator(Customer.objects.all() if queryset is None else queryset, CUSTOMER_ORDERING, per_page)
+
+
+def website_keyset(customer, per_page=100):
+    """Keyset paginator of the customer websites, by id."""
+    return KeysetPaginator(customer.websites.all(), WEBSITE_ORDERING, per_page)
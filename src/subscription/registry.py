@@ -0,0 +1,150 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class PlanRegistry:
+    """
+    Cached catalog of the subscription plans.
+
+    Plans are kept in a process local LRU and, optionally, in a django cache backend shared between
+    processes (settings.SUBSCRIPTION_PLAN_REGISTRY_CACHE), both populated lazily. The entries are
+    invalidated by the Plan post_save/post_delete signals (see signals.py), the local ones also expire
+    after settings.SUBSCRIPTION_PLAN_REGISTRY_LOCAL_TTL seconds, since other processes signals don't reach them.
+    """
+    cache_key_prefix = 'subscription:plan:'
+
+    def __init__(self):
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return getattr(settings, 'SUBSCRIPTION_PLAN_REGISTRY_SIZE', 128)
+
+    @property
+    def local_ttl(self):
+        return getattr(settings, 'SUBSCRIPTION_PLAN_REGISTRY_LOCAL_TTL', 300)
+
+    @property
+    def cache(self):
+        alias = getattr(settings, 'SUBSCRIPTION_PLAN_REGISTRY_CACHE', None)
+        return caches[alias] if alias else None
+
+    def get_cache_key(self, plan_id):
+        return '{}{}'.format(self.cache_key_prefix, plan_id)
+
+    def get(self, plan_id):
+        """Returns a copy of the plan with the given id, raising Plan.DoesNotExist if there's no such plan."""
+        plan = self._get_local(plan_id)
+        if plan is not None:
+            return copy.copy(plan)
+
+        cache = self.cache
+        plan = cache.get(self.get_cache_key(plan_id)) if cache else None
+        if plan is not None:
+            self.cache_hits += 1
+        else:
+            from .models import Plan
+
+            self.misses += 1
+            plan = Plan.objects.get(pk=plan_id)
+            if cache:
+                cache.set(self.get_cache_key(plan_id), plan)
+
+        self._set_local(plan_id, plan)
+        return copy.copy(plan)
+
+    def get_many(self, plan_ids):
+        """
+        Returns a {plan_id: plan copy} dict of the given plans (the missing ones left out), as get() does,
+        but fetching the plans missing from the registry with a single query.
+        """
+        plans = {}
+        missing = []
+        for plan_id in plan_ids:
+            plan = self._get_local(plan_id)
+            if plan is not None:
+                plans[plan_id] = plan
+            else:
+                missing.append(plan_id)
+
+        cache = self.cache
+        if cache and missing:
+            cached = cache.get_many([self.get_cache_key(plan_id) for plan_id in missing])
+            self.cache_hits += len(cached)
+            for plan_id in missing:
+                plan = cached.get(self.get_cache_key(plan_id))
+                if plan is not None:
+                    plans[plan_id] = plan
+                    self._set_local(plan_id, plan)
+            missing = [plan_id for plan_id in missing if plan_id not in plans]
+
+        if missing:
+            from .models import Plan
+
+            self.misses += len(missing)
+            fetched = Plan.objects.in_bulk(missing)
+            if cache and fetched:
+                cache.set_many({self.get_cache_key(plan_id): plan for plan_id, plan in fetched.items()})
+            for plan_id, plan in fetched.items():
+                plans[plan_id] = plan
+                self._set_local(plan_id, plan)
+
+        return {plan_id: copy.copy(plan) for plan_id, plan in plans.items()}
+
+    def invalidate(self, plan_id=None):
+        """Drops the given plan (or every plan, when no id is given) from the registry."""
+        with self._lock:
+            if plan_id is None:
+                self._plans.clear()
+            else:
+                self._plans.pop(plan_id, None)
+
+        cache = self.cache
+        if cache and plan_id is not None:
+            cache.delete(self.get_cache_key(plan_id))
+
+    def stats(self):
+        """Returns the registry hit/miss counters."""
+        return {
+            'hits': self.hits,
+            'cache_hits': self.cache_hits,
+            'misses': self.misses,
+            'size': len(self._plans),
+        }
+
+    def reset_stats(self):
+        self.hits = self.cache_hits = self.misses = 0
+
+    def _get_local(self, plan_id):
+        with self._lock:
+            entry = self._plans.get(plan_id)
+            if entry is None:
+                return None
+
+            plan, expires = entry
+            if expires < time.monotonic():
+                del self._plans[plan_id]
+                return None
+
+            self._plans.move_to_end(plan_id)
+            self.hits += 1
+            return plan
+
+    def _set_local(self, plan_id, plan):
+        with self._lock:
+            self._plans[plan_id] = (plan, time.monotonic() + self.local_ttl)
+            self._plans.move_to_end(plan_id)
+            while len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+
+
+plan_registry = PlanRegistry()
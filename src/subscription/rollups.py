@@ -0,0 +1,178 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from .registry import plan_registry
+from .sharding import get_shards, scatter_gather
+
+
+def get_rollup_slots():
+    return getattr(settings, 'SUBSCRIPTION_ROLLUP_SLOTS', 16)
+
+
+def get_rollup_slot(customer_id):
+    """
+    The slot of the plan rollups a customer writes to: each plan day is spread over several slot rows, so the
+    concurrent writes of different customers on the same plan don't queue on the lock of a single row.
+    """
+    return customer_id % get_rollup_slots()
+
+
+def record_rollup_changes(changes, using=None, day=None):
+    """
+    Applies the (customer_id, plan_id, customers, websites) deltas of a write to the plans rollups of the day
+    (today), in the slot rows of the customers (see get_rollup_slot()).
+
+    Meant to run in the same transaction as the write. A slot row is created on its first change of the day,
+    carrying forward the previous snapshot of the slot, then moved with F() updates: a day without changes has
+    no row and the slot snapshot is the last one before it (see get_snapshot()). The websites delta can be an
+    expression (i.e: a subquery of the customer counter), so the write doesn't need to read it first.
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for customer_id, plan_id, customers, websites in changes:
+        if plan_id is not None:
+            key = (plan_id, get_rollup_slot(customer_id))
+            totals[key][0] += customers
+            totals[key][1] += websites
+
+    using = using or DEFAULT_DB_ALIAS
+    day = day or timezone.localdate()
+    for (plan_id, slot), (customers, websites) in sorted(totals.items()):
+        if not customers and isinstance(websites, int) and not websites:
+            continue
+        changes = {'customers': F('customers') + customers, 'websites': F('websites') + websites}
+        if customers:
+            changes['revenue'] = F('revenue') + get_plan_price(plan_id) * customers
+        update_day_rollup(plan_id, slot, day, using, **changes)
+
+
+def get_plan_price(plan_id):
+    """The plan price as a subquery, read by the rollup UPDATE itself."""
+    from .models import Plan
+
+    return Subquery(Plan.objects.filter(pk=plan_id).order_by().values('price')[:1])
+
+
+def get_rollups(using):
+    from .models import PlanDailyRollup
+
+    return PlanDailyRollup.objects.using(using)
+
+
+def update_day_rollup(plan_id, slot, day, using, **changes):
+    """
+    Updates the plan slot row of the day, a single UPDATE statement once the row exists, creating it from the
+    previous snapshot of the slot on its first change of the day.
+    """
+    rollups = get_rollups(using).filter(plan_id=plan_id, slot=slot, day=day)
+    if not rollups.update(**changes):
+        create_day_rollup(plan_id, slot, day, using)
+        rollups.update(**changes)
+
+
+def create_day_rollup(plan_id, slot, day, using):
+    rollups = get_rollups(using)
+    previous = rollups.filter(plan_id=plan_id, slot=slot, day__lt=day).order_by('-day').values(
+        'customers', 'websites', 'revenue'
+    ).first() or {}
+    try:
+        with transaction.atomic(using=using):
+            rollups.create(plan_id=plan_id, slot=slot, day=day, **previous)
+    except IntegrityError:
+        # created meanwhile by a concurrent write
+        pass
+
+
+def get_plan_slots(plan_id, using):
+    return list(get_rollups(using).filter(plan_id=plan_id).order_by().values_list('slot', flat=True).distinct())
+
+
+def update_plan_revenue(plan, using=None, day=None):
+    """Reprices the plan slot rows of the day, after a plan price change."""
+    using = using or DEFAULT_DB_ALIAS
+    day = day or timezone.localdate()
+    for slot in get_plan_slots(plan.pk, using):
+        update_day_rollup(plan.pk, slot, day, using, revenue=F('customers') * plan.price)
+
+
+def rebuild_rollups(using=None, day=None):
+    """
+    Rewrites the plans rollups of the day (today) from the customers table, with a single grouped query,
+    for the writes that don't maintain them (i.e: bulk loads, rebalancing shards) or any drift.
+    Returns the number of plans rebuilt.
+    """
+    from .models import Customer, Plan
+
+    using = using or DEFAULT_DB_ALIAS
+    day = day or timezone.localdate()
+    totals = defaultdict(dict)
+    for row in Customer.objects.using(using).filter(subscription__isnull=False).annotate(
+        slot=Mod('pk', get_rollup_slots())
+    ).order_by().values('subscription_id', 'slot').annotate(customers=Count('pk'), websites=Sum('websites_count')):
+        totals[row['subscription_id']][row['slot']] = row
+
+    with transaction.atomic(using=using):
+        rebuilt = 0
+        for plan in Plan.objects.using(using).all():
+            slots = totals.get(plan.pk, {})
+            existing_slots = get_plan_slots(plan.pk, using)
+            # only the plans that ever had customers get rows, all their slots, so the day writes are only UPDATEs
+            if not slots and not existing_slots:
+                continue
+            for slot in sorted(set(range(get_rollup_slots())) | set(existing_slots)):
+                row = slots.get(slot, {})
+                customers, websites = row.get('customers', 0), row.get('websites') or 0
+                update_day_rollup(
+                    plan.pk, slot, day, using, customers=customers, websites=websites, revenue=plan.price * customers
+                )
+            rebuilt += 1
+
+    return rebuilt
+
+
+def get_snapshot(day=None):
+    """
+    Returns the plans snapshot on the day (today), {plan_id: {'customers', 'websites', 'revenue'}}, summing the
+    latest row of each plan slot (and the shards, when sharding is enabled), whatever the number of customers.
+    """
+    day = day or timezone.localdate()
+    snapshot = {}
+
+    for rows in scatter_gather(lambda shard: get_shard_snapshot(day, shard), shards=get_shards()):
+        for plan_id, values in rows.items():
+            totals = snapshot.setdefault(plan_id, {'customers': 0, 'websites': 0, 'revenue': Decimal('0')})
+            for name, value in values.items():
+                totals[name] += value
+    return snapshot
+
+
+def get_shard_snapshot(day, using):
+    rollups = get_rollups(using)
+    latest_day = rollups.filter(
+        plan=OuterRef('plan'), slot=OuterRef('slot'), day__lte=day
+    ).order_by('-day').values('day')[:1]
+    plans = rollups.filter(day__lte=day).annotate(latest_day=Subquery(latest_day)).filter(
+        day=F('latest_day')
+    ).order_by().values('plan_id').annotate(
+        customers=Sum('customers'), websites=Sum('websites'), revenue=Sum('revenue')
+    )
+
+    return {
+        plan.pop('plan_id'): plan for plan in plans
+    }
+
+
+def get_plan_type_distribution(day=None):
+    """The snapshot of the day summed by plan type, {plan_type: {'customers', 'websites', 'revenue'}}."""
+    distribution = {}
+    for plan_id, values in get_snapshot(day).items():
+        plan_type = plan_registry.get(plan_id).plan_type
+        totals = distribution.setdefault(plan_type, {'customers': 0, 'websites': 0, 'revenue': Decimal('0')})
+        for name, value in values.items():
+            totals[name] += value
+    return distribution
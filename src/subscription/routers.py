@@ -0,0 +1,171 @@
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS
+
+from .sharding import get_shard, get_shards, sharding_enabled
+
+_state = threading.local()
+
+
+def get_replicas():
+    return getattr(settings, 'SUBSCRIPTION_DATABASE_REPLICAS', [])
+
+
+def pin_primary():
+    """Sends the following reads (of this thread, until unpin_primary()) to the primary database."""
+    _state.pinned = True
+
+
+def unpin_primary():
+    _state.pinned = False
+
+
+def is_primary_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+@contextmanager
+def primary_pinning(pinned=False):
+    """
+    Scopes the primary pinning to the block, restoring the previous one when it ends.
+
+    PrimaryPinningMiddleware does it for each request. Outside of the requests (i.e: management commands,
+    workers) a write pins the rest of the thread to the primary, the long running ones should wrap each
+    unit of work (i.e: a task, a batch) in it, so their reads go back to the replicas.
+    """
+    previous = is_primary_pinned()
+    _state.pinned = pinned
+    try:
+        yield
+    finally:
+        _state.pinned = previous
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends the writes to the primary (default) database and the reads to one of the replicas in
+    settings.SUBSCRIPTION_DATABASE_REPLICAS (database aliases).
+
+    After a write, the reads stick to the primary (see primary_pinning() for its scope), so they never miss
+    what was just written because of the replication lag. The locking reads (select_for_update) are routed as
+    writes, to the primary. Without replicas, everything goes to the primary and nothing is pinned.
+    """
+
+    def get_replicas(self):
+        return get_replicas()
+
+    def is_foreign(self, instance):
+        """Whether the instance hint comes from a database other than the primary and its replicas (i.e: a shard)."""
+        return instance is not None and instance._state.db not in (None, DEFAULT_DB_ALIAS, *self.get_replicas())
+
+    def db_for_read(self, model, **hints):
+        if self.is_foreign(hints.get('instance')):
+            return None
+        replicas = self.get_replicas()
+        if not replicas or is_primary_pinned():
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if self.is_foreign(hints.get('instance')):
+            return None
+        if self.get_replicas():
+            pin_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *self.get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replicas get the schema through the replication
+        if db in self.get_replicas():
+            return False
+        return None
+
+
+class ShardRouter:
+    """
+    Places the customers, and their websites, in one of the settings.SUBSCRIPTION_SHARDS databases, by the
+    hash of the customer id (see sharding.get_shard()). Does nothing while sharding isn't enabled.
+
+    The routing needs the customer, so it only happens with an instance hint (saves, deletes, related
+    managers), the querysets go to the customer shard through on_shard(customer_id). The other models,
+    read for a sharded instance (i.e: its plan), are read from the same shard, where the plans are
+    replicated to. Goes before PrimaryReplicaRouter, which gets what isn't routed here.
+    """
+    sharded_models = {('subscription', 'customer'), ('subscription', 'website')}
+
+    def is_sharded(self, model):
+        return (model._meta.app_label, model._meta.model_name) in self.sharded_models
+
+    def get_customer_id(self, instance):
+        if instance._meta.model_name == 'customer':
+            return instance.pk
+        return getattr(instance, 'customer_id', None)
+
+    def db_for_instance(self, model, instance):
+        if instance is None or not self.is_sharded(type(instance)):
+            return None
+
+        if self.is_sharded(model):
+            customer_id = self.get_customer_id(instance)
+            if customer_id is not None:
+                return get_shard(customer_id)
+
+        if instance._state.db in get_shards():
+            return instance._state.db
+        return None
+
+    def db_for_read(self, model, **hints):
+        if sharding_enabled():
+            return self.db_for_instance(model, hints.get('instance'))
+        return None
+
+    def db_for_write(self, model, **hints):
+        if sharding_enabled() and self.is_sharded(model):
+            return self.db_for_instance(model, hints.get('instance'))
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the plans are in every shard, the customers and websites placement is decided on save
+        databases = {DEFAULT_DB_ALIAS, *get_shards()}
+        if sharding_enabled() and obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # every shard gets the whole schema
+        return None
+
+
+class PrimaryPinningMiddleware:
+    """
+    Scopes the primary pinning of PrimaryReplicaRouter to the request. A request that wrote also pins the
+    following requests of the same client for settings.SUBSCRIPTION_PRIMARY_PIN_SECONDS (through a cookie),
+    i.e: the page it redirects to. Not used without replicas.
+    """
+    cookie_name = 'subscription_primary'
+
+    def __init__(self, get_response):
+        if not get_replicas():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        pinned = bool(request.COOKIES.get(self.cookie_name))
+        with primary_pinning(pinned):
+            response = self.get_response(request)
+            if is_primary_pinned() and not pinned:
+                response.set_cookie(
+                    self.cookie_name, '1', max_age=getattr(settings, 'SUBSCRIPTION_PRIMARY_PIN_SECONDS', 5),
+                    httponly=True,
+                )
+
+        return response
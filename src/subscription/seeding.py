@@ -0,0 +1,176 @@
+import io
+import random
+from contextlib import ExitStack
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Customer, Plan, SubscriptionChange, Website
+from .rollups import rebuild_rollups
+from .sharding import allocate_customer_ids, get_shard, get_shards, sharding_enabled
+
+PLAN_PRICES = {'single': Decimal('9.99'), 'plus': Decimal('19.99'), 'infinite': Decimal('49.99')}
+# the day the seeded signup and renewal dates are relative to, by default, so they don't depend on the run date
+SEED_TODAY = date(2020, 1, 1)
+DEFAULT_PASSWORD = 'password'
+
+
+def websites_distribution(rng, skew, max_websites):
+    """Yields the websites per customer, following a (capped) pareto distribution: most have a few, some a lot."""
+    while True:
+        yield min(int(rng.paretovariate(skew)) - 1, max_websites)
+
+
+def get_or_create_plans(using='default'):
+    """Returns a plan of every plan type, creating the missing ones."""
+    plans = []
+    for plan_type, price in sorted(PLAN_PRICES.items()):
+        plan = Plan.objects.using(using).filter(plan_type=plan_type).order_by('pk').first()
+        if plan is None:
+            plan = Plan.objects.using(using).create(name='{} plan'.format(plan_type), plan_type=plan_type, price=price)
+        plans.append(plan)
+    return plans
+
+
+def seed_subscriptions(total_customers, seed=0, skew=1.5, max_websites=1000, batch_size=5000,
+                       password=DEFAULT_PASSWORD, use_copy=None, today=None, using=DEFAULT_DB_ALIAS):
+    """
+    Seeds plans, customers (with subscriptions and renewal dates) and websites in batches.
+
+    The data is deterministic for the same seed (and database state): the signup and renewal dates are relative
+    to `today` (SEED_TODAY by default), and every customer gets the same `password`, hashed only once (with a
+    salt from the seed). About a tenth of the customers is left without subscription and the websites per
+    customer are skewed (see websites_distribution()), but never more than the customer plan allows. With
+    sharding enabled the customers go to their shards (`using` is ignored), with ids from the shared sequence.
+    The rows are written with bulk_create, or with COPY on PostgreSQL (`use_copy`, default on that backend).
+    Returns the number of customers and websites created.
+    """
+    sharded = sharding_enabled()
+    databases = get_shards() if sharded else [using]
+    if use_copy is None:
+        use_copy = all(connections[database].vendor == 'postgresql' for database in databases)
+    write_rows = copy_rows if use_copy else bulk_create_rows
+
+    rng = random.Random(seed)
+    websites_per_customer = websites_distribution(rng, skew, max_websites)
+    password_hash = make_password(password, salt='seed{}'.format(seed))
+    today = today or SEED_TODAY
+    now = timezone.make_aware(datetime.combine(today, time.min))
+
+    with ExitStack() as stack:
+        # a transaction per database (every shard), committed at the end
+        for database in databases:
+            stack.enter_context(transaction.atomic(using=database))
+        # the plans are written to the default database, and replicated to the shards
+        plans = get_or_create_plans(DEFAULT_DB_ALIAS if sharded else using)
+
+        # explicit ids, so the websites can reference the customers without reading them back
+        next_customer_id = None if sharded else (Customer.objects.using(using).aggregate(pk=Max('pk'))['pk'] or 0) + 1
+        next_website_ids = {
+            database: (Website.objects.using(database).aggregate(pk=Max('pk'))['pk'] or 0) + 1
+            for database in databases
+        }
+        total_websites = 0
+
+        for batch_start in range(0, total_customers, batch_size):
+            batch_total = min(batch_size, total_customers - batch_start)
+            if sharded:
+                customer_ids = allocate_customer_ids(batch_total)
+            else:
+                customer_ids = range(next_customer_id + batch_start, next_customer_id + batch_start + batch_total)
+            batches = {database: ([], [], []) for database in databases}
+
+            for customer_id in customer_ids:
+                database = get_shard(customer_id) if sharded else using
+                customers, websites, changes = batches[database]
+                plan = rng.choice(plans) if rng.random() >= 0.1 else None
+                total = 0
+                if plan:
+                    total = next(websites_per_customer)
+                    if plan.total_websites_allowed:
+                        total = min(total, plan.total_websites_allowed)
+
+                date_joined = now - timedelta(days=rng.randrange(730))
+                customers.append({
+                    'id': customer_id, 'password': password_hash, 'last_login': None, 'is_superuser': False,
+                    'username': 'customer{}'.format(customer_id), 'first_name': '', 'last_name': '', 'email': '',
+                    'is_staff': False, 'is_active': True, 'date_joined': date_joined,
+                    'subscription_id': plan.pk if plan else None, 'websites_count': total,
+                    'sub_renewal_date': today + timedelta(days=rng.randrange(365)) if plan else None,
+                    'modified': now,
+                })
+                if plan:
+                    # subscribed on signup
+                    changes.append({
+                        'customer_id': customer_id, 'customer_joined': date_joined, 'old_plan_id': None,
+                        'new_plan_id': plan.pk, 'created': date_joined,
+                    })
+                for number in range(total):
+                    websites.append({
+                        'id': next_website_ids[database], 'customer_id': customer_id,
+                        'url': 'https://customer{}-{}.example.com'.format(customer_id, number),
+                    })
+                    next_website_ids[database] += 1
+
+            for database, (customers, websites, changes) in batches.items():
+                write_rows(Customer, customers, database)
+                write_rows(Website, websites, database)
+                write_rows(SubscriptionChange, changes, database)
+                total_websites += len(websites)
+
+        for database in databases:
+            # the sharded customer ids come from their own sequence (see allocate_customer_ids())
+            reset_sequences(database, [Website] if sharded else [Customer, Website])
+            # a single grouped query, instead of maintaining the rollups row by row
+            rebuild_rollups(using=database)
+
+    return total_customers, total_websites
+
+
+def bulk_create_rows(model, rows, using):
+    """Writes the rows (dicts by field attname) with bulk_create, in the backend max batch size."""
+    model.objects.using(using).bulk_create([model(**row) for row in rows])
+
+
+def copy_rows(model, rows, using):
+    """Writes the rows (dicts by field attname) with a single PostgreSQL COPY statement."""
+    if not rows:
+        return
+
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(to_copy_value(row[column]) for column in columns))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    with connections[using].cursor() as cursor:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+            model._meta.db_table, ', '.join('"{}"'.format(column) for column in columns)
+        ), buffer)
+
+
+def to_copy_value(value):
+    """Formats a value in the COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def reset_sequences(using, models):
+    """Moves the primary key sequences past the explicit ids inserted (on the backends that have them)."""
+    connection = connections[using]
+    statements = connection.ops.sequence_reset_sql(no_style(), models)
+    if statements:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
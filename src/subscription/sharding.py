@@ -0,0 +1,186 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F, Max
+
+CUSTOMER_ID_SEQUENCE = 'customer'
+
+_state = threading.local()
+
+
+def get_shards():
+    """The database aliases holding the customers (settings.SUBSCRIPTION_SHARDS), the default one when unset."""
+    return list(getattr(settings, 'SUBSCRIPTION_SHARDS', None) or [DEFAULT_DB_ALIAS])
+
+
+def sharding_enabled():
+    return bool(getattr(settings, 'SUBSCRIPTION_SHARDS', None))
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping & Veach) of the integer `key` into `buckets` buckets.
+
+    Appending a shard only moves 1/N of the keys (all of them to the new shard), so the shards list
+    must only grow at the end.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def get_shard(customer_id):
+    """Returns the database alias where the customer (and its websites) lives."""
+    shards = get_shards()
+    # hashed first, so the sequential ids don't end up in a predictable shard order
+    key = int.from_bytes(hashlib.md5(str(customer_id).encode()).digest()[:8], 'big')
+    return shards[jump_hash(key, len(shards))]
+
+
+def allocate_customer_ids(total=1):
+    """
+    Returns a range of `total` new customer ids, unique across the shards.
+
+    The ids come from a sequence row in the default database (see IdSequence), which starts
+    after the highest customer id already in the shards.
+    """
+    from .models import Customer, IdSequence
+
+    sequences = IdSequence.objects.using(DEFAULT_DB_ALIAS)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        # the UPDATE locks the sequence row until the commit, so the following read is ours
+        if not sequences.filter(name=CUSTOMER_ID_SEQUENCE).update(last_value=F('last_value') + total):
+            last_ids = scatter_gather(
+                lambda shard: Customer._base_manager.using(shard).aggregate(last_id=Max('pk'))['last_id']
+            )
+            sequences.get_or_create(
+                name=CUSTOMER_ID_SEQUENCE, defaults={'last_value': max(filter(None, last_ids), default=0)}
+            )
+            sequences.filter(name=CUSTOMER_ID_SEQUENCE).update(last_value=F('last_value') + total)
+        last_value = sequences.filter(name=CUSTOMER_ID_SEQUENCE).values_list('last_value', flat=True).get()
+
+    return range(last_value - total + 1, last_value + 1)
+
+
+def scatter_gather(function, shards=None):
+    """
+    Calls function(shard alias) for every shard, in parallel, returning the results in the shards order.
+
+    Meant for the cross shard reports, i.e: scatter_gather(lambda shard: Customer.objects.using(shard).count()).
+    Each call runs in its own thread, with its own database connections (closed when it ends).
+    """
+    shards = get_shards() if shards is None else list(shards)
+    if len(shards) <= 1:
+        return [function(shard) for shard in shards]
+
+    def run(shard):
+        try:
+            return function(shard)
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        return list(executor.map(run, shards))
+
+
+def replicate_plan(plan, deleted=False):
+    """Copies a plan write in the default database to the other shards, where the customers reference it."""
+    from .models import Plan
+
+    values = {field.attname: getattr(plan, field.attname) for field in Plan._meta.concrete_fields}
+    for shard in get_shards():
+        if shard == DEFAULT_DB_ALIAS:
+            continue
+        plans = Plan.objects.using(shard).filter(pk=plan.pk)
+        # queryset writes, so the copies don't send the model signals (and get replicated) again
+        if deleted:
+            plans.delete()
+        elif not plans.update(**values):
+            Plan.objects.using(shard).bulk_create([Plan(**values)])
+
+
+def sync_plans():
+    """Replicates every plan of the default database to the other shards."""
+    from .models import Plan
+
+    for plan in Plan.objects.using(DEFAULT_DB_ALIAS).all():
+        replicate_plan(plan)
+
+
+@contextmanager
+def moving_customer():
+    """
+    Marks the writes of the block (in this thread) as a shard move (see move_customer()), so deleting the
+    customer from its source shard isn't recorded as a cancellation.
+    """
+    _state.moving = True
+    try:
+        yield
+    finally:
+        _state.moving = False
+
+
+def is_moving_customer():
+    return getattr(_state, 'moving', False)
+
+
+def move_customer(customer_id, source, target):
+    """
+    Moves the customer, its websites, its subscription history and its pending outbox events, from the
+    `source` shard to the `target` one.
+
+    The copy is committed in the target before the source rows are deleted, so an interrupted move leaves
+    the customer in both shards and running it again finishes it. The writes to the customer must be paused
+    while it's being moved, since the ones reaching the source meanwhile are lost. The websites, history rows
+    and events get new ids, the pending events website ids are rewritten to the new ones (or to None, for the
+    websites removed already). The customer groups and permissions aren't moved.
+    """
+    from .models import Customer, OutboxEvent, SubscriptionChange, Website
+
+    customer = Customer._base_manager.using(source).filter(pk=customer_id).first()
+    if customer is None:
+        return False
+
+    websites = list(Website._base_manager.using(source).filter(customer_id=customer_id).order_by('pk').values_list(
+        'pk', 'url'
+    ))
+    changes = list(SubscriptionChange.objects.using(source).filter(customer_id=customer_id).order_by('pk'))
+    events = list(OutboxEvent.objects.using(source).filter(
+        customer_id=customer_id, published__isnull=True
+    ).order_by('pk'))
+    for row in changes + events:
+        row.pk = None
+
+    with transaction.atomic(using=target):
+        if not Customer._base_manager.using(target).filter(pk=customer_id).exists():
+            Customer._base_manager.using(target).bulk_create([customer])
+            Website._base_manager.using(target).bulk_create([
+                Website(url=url, customer_id=customer_id) for _, url in websites
+            ])
+            # the website ids are per shard, the events payloads follow the new ones (inserted in the same order)
+            website_ids = dict(zip((website_id for website_id, _ in websites), Website._base_manager.using(
+                target
+            ).filter(customer_id=customer_id).order_by('pk').values_list('pk', flat=True)))
+            for event in events:
+                payload = json.loads(event.payload)
+                if 'website_id' in payload:
+                    payload['website_id'] = website_ids.get(payload['website_id'])
+                    event.payload = json.dumps(payload)
+            SubscriptionChange.objects.using(target).bulk_create(changes)
+            OutboxEvent.objects.using(target).bulk_create(events)
+
+    with transaction.atomic(using=source), moving_customer():
+        Website._base_manager.using(source).filter(customer_id=customer_id).delete()
+        SubscriptionChange.objects.using(source).filter(customer_id=customer_id).delete()
+        OutboxEvent.objects.using(source).filter(customer_id=customer_id, published__isnull=True).delete()
+        Customer._base_manager.using(source).filter(pk=customer_id).delete()
+
+    return True
@@ -0,0 +1,57 @@
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .entitlements import invalidate_all_entitlements, invalidate_entitlements
+from .models import Customer, Plan, record_subscription_changes
+from .registry import plan_registry
+from .rollups import record_rollup_changes, update_plan_revenue
+from .sharding import get_shards, is_moving_customer, replicate_plan, sharding_enabled
+
+
+@receiver([post_save, post_delete], sender=Plan, dispatch_uid='subscription_invalidate_plan_registry')
+def invalidate_plan_registry(sender, instance, using, **kwargs):
+    plan_id = instance.pk
+    plan_registry.invalidate(plan_id)
+    # the plan could be read again before the transaction ends, so invalidate it once more after the commit
+    transaction.on_commit(lambda: plan_registry.invalidate(plan_id), using=using)
+
+
+@receiver([post_save, post_delete], sender=Plan, dispatch_uid='subscription_invalidate_plan_entitlements')
+def invalidate_plan_entitlements(sender, instance, using, **kwargs):
+    invalidate_all_entitlements(using=using)
+
+
+@receiver([post_save, post_delete], sender=Plan, dispatch_uid='subscription_replicate_plan')
+def replicate_plan_to_shards(sender, instance, using, **kwargs):
+    # the plans are written to the default database, the shards get a copy for their customers
+    if sharding_enabled() and using == DEFAULT_DB_ALIAS:
+        replicate_plan(instance, deleted='created' not in kwargs)
+
+
+@receiver(post_save, sender=Plan, dispatch_uid='subscription_update_plan_rollups_revenue')
+def update_plan_rollups_revenue(sender, instance, using, created, **kwargs):
+    # the price could have changed, the plan copies in the shards (saved without signals) have their rollups too
+    if not created:
+        for database in get_shards() if sharding_enabled() and using == DEFAULT_DB_ALIAS else [using]:
+            update_plan_revenue(instance, using=database)
+
+
+@receiver([post_save, post_delete], sender=Customer, dispatch_uid='subscription_invalidate_customer_entitlements')
+def invalidate_customer_entitlements(sender, instance, using, **kwargs):
+    invalidate_entitlements(instance.pk, using=using)
+
+
+@receiver(post_delete, sender=Customer, dispatch_uid='subscription_update_customer_rollups')
+def update_customer_rollups(sender, instance, using, **kwargs):
+    record_rollup_changes([(instance.pk, instance.subscription_id, -1, -instance.websites_count)], using=using)
+
+
+@receiver(post_delete, sender=Customer, dispatch_uid='subscription_record_customer_cancellation')
+def record_customer_cancellation(sender, instance, using, **kwargs):
+    # a deleted customer churns, its history is kept (a customer moved to another shard doesn't, see move_customer())
+    if is_moving_customer():
+        return
+    record_subscription_changes(
+        [(instance.pk, instance.date_joined, instance.subscription_id, None, None)], using=using
+    )
@@ -1,13 +1,45 @@
-from datetime import date
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+from io import StringIO
 from unittest import mock
 
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed, ObjectDoesNotExist
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
 
 from mixer.backend.django import mixer
 
-from .exceptions import CustomerAddWebsitePermissionDenied
-from .models import Customer, Plan, Website
+from .analytics import churn_matrix, cohort_matrix, compute_cohort_matrix, get_period_offset
+from .backends import ShardedModelBackend
+from .benchmarks import OperationStats, compare_results, run_benchmarks
+from .entitlements import get_cache_key, get_entitlements
+from .exports import export_rows
+from .instrumentation import track_queries, view_histograms
+from .loaders import Loader, SubscriptionLoaders
+from .metrics import aggregator
+from .pagination import customer_keyset, website_keyset
+from .exceptions import CustomerAddWebsitePermissionDenied, InvalidCursor, SubscriptionConflict
+from .models import (
+    Customer, DeliveryOffset, OutboxEvent, Plan, PlanDailyRollup, SubscriptionChange, Website,
+)
+from .registry import plan_registry
+from .rollups import get_plan_type_distribution, get_rollup_slot, get_rollup_slots, get_snapshot, rebuild_rollups
+from .routers import PrimaryPinningMiddleware, is_primary_pinned, primary_pinning, unpin_primary
+from .seeding import seed_subscriptions
+from .sharding import get_shard, jump_hash, scatter_gather
 
 
 class CustomerTestCase(TestCase):
@@ -171,3 +203,1850 @@ class PlanTestCase(TestCase):
         # Adding 100 websites, with no issue.
         self.customer.websites.add(*websites, bulk=False)
         self.assertEqual(self.customer.websites.count(), TOTAL_WEBSITES)
+
+
+class WebsitesCountTestCase(TestCase):
+    def setUp(self):
+        self.customer = mixer.blend(Customer, subscription=mixer.blend(Plan, plan_type='infinite'))
+        self.other_customer = mixer.blend(Customer, subscription=mixer.blend(Plan, plan_type='infinite'))
+
+    def assertWebsitesCount(self, customer, expected):
+        customer.refresh_from_db()
+        self.assertEqual(customer.websites_count, expected)
+        self.assertEqual(customer.websites.count(), expected)
+
+    def test_counter_follows_website_writes(self):
+        """Test that the websites counter is kept in step on create, reassignment, detach and delete"""
+        website = Website.objects.create(url='https://foo.bar', customer=self.customer)
+        Website.objects.create(url='https://bar.foo', customer=self.customer)
+        self.assertWebsitesCount(self.customer, 2)
+
+        # Reassignment moves the counter between customers
+        website.customer = self.other_customer
+        website.save()
+        self.assertWebsitesCount(self.customer, 1)
+        self.assertWebsitesCount(self.other_customer, 1)
+
+        # Saving the website again, without changing the customer, doesn't touch the counters
+        website.url = 'https://foo.baz'
+        website.save()
+        self.assertWebsitesCount(self.other_customer, 1)
+
+        # Detach (SET_NULL) path
+        website.customer = None
+        website.save()
+        self.assertWebsitesCount(self.other_customer, 0)
+
+        website.customer = self.customer
+        website.save()
+        website.delete()
+        self.assertWebsitesCount(self.customer, 1)
+
+    def test_counter_follows_bulk_operations(self):
+        """Test that the related manager and queryset bulk operations keep the websites counter in step"""
+        websites = mixer.cycle(3).blend(Website, customer=None)
+
+        self.customer.websites.add(*websites)
+        self.assertWebsitesCount(self.customer, 3)
+
+        self.customer.websites.remove(websites[0])
+        self.assertWebsitesCount(self.customer, 2)
+
+        Website.objects.filter(pk=websites[1].pk).update(customer=self.other_customer)
+        self.assertWebsitesCount(self.customer, 1)
+        self.assertWebsitesCount(self.other_customer, 1)
+
+        Website.objects.filter(customer__isnull=False).delete()
+        self.assertWebsitesCount(self.customer, 0)
+        self.assertWebsitesCount(self.other_customer, 0)
+
+    def test_bulk_operations_check_the_quota(self):
+        """Test that the websites moved to a customer in bulk are checked against its plan quota"""
+        customer = mixer.blend(Customer, subscription=mixer.blend(Plan, plan_type='single'))
+        websites = mixer.cycle(3).blend(Website, customer=None)
+
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            customer.websites.add(websites[0], websites[1])
+        self.assertWebsitesCount(customer, 0)
+
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            Website.objects.filter(pk__in=[website.pk for website in websites]).update(customer=customer)
+        self.assertWebsitesCount(customer, 0)
+
+        customer.websites.add(websites[0])
+        self.assertWebsitesCount(customer, 1)
+        # the websites the customer already owns don't take more room
+        Website.objects.filter(pk=websites[0].pk).update(customer=customer)
+        self.assertWebsitesCount(customer, 1)
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            Website.objects.filter(pk=websites[1].pk).update(customer_id=customer.pk)
+        self.assertWebsitesCount(customer, 1)
+
+        with self.assertRaises(ObjectDoesNotExist):
+            Website.objects.filter(pk=websites[2].pk).update(customer=mixer.blend(Customer))
+
+    def test_customer_save_keeps_counter(self):
+        """Test that saving a customer holding a stale counter doesn't overwrite the real one"""
+        stale_customer = Customer.objects.get(pk=self.customer.pk)
+        Website.objects.create(url='https://foo.bar', customer=self.customer)
+
+        stale_customer.first_name = 'Foo'
+        stale_customer.save()
+        self.assertWebsitesCount(self.customer, 1)
+
+    def test_rebuild_websites_count_command(self):
+        """Test that the rebuild command reports and fixes drifted counters"""
+        Website.objects.create(url='https://foo.bar', customer=self.customer)
+        Customer.objects.filter(pk=self.customer.pk).update(websites_count=5)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_websites_count', check=True, stdout=StringIO())
+
+        call_command('rebuild_websites_count', stdout=StringIO())
+        self.assertWebsitesCount(self.customer, 1)
+        call_command('rebuild_websites_count', check=True, stdout=StringIO())
+
+
+class WebsiteBulkRegisterTestCase(TestCase):
+    def setUp(self):
+        self.customer = mixer.blend(Customer, subscription=mixer.blend(Plan, plan_type='plus'))
+        self.urls = ['https://foo{}.bar'.format(number) for number in range(5)]
+
+    def test_bulk_register_within_quota(self):
+        """Test that a batch that fits the plan is registered with a single quota check"""
+        # quota reservation + bulk insert + plan rollup + outbox events
+        with self.assertNumQueries(4):
+            Website.objects.bulk_register(self.customer, self.urls[:3])
+
+        self.assertEqual(list(self.customer.websites.order_by('pk').values_list('url', flat=True)), self.urls[:3])
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.websites_count, 3)
+
+    def test_bulk_register_reject_policy(self):
+        """Test that, with the reject policy, a batch over the plan limit registers nothing"""
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            Website.objects.bulk_register(self.customer, self.urls)
+
+        self.assertFalse(self.customer.websites.exists())
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.websites_count, 0)
+
+    def test_bulk_register_partial_policy(self):
+        """Test that, with the partial policy, only the urls that fit the plan are registered"""
+        Website.objects.create(url='https://foo.bar', customer=self.customer)
+
+        Website.objects.bulk_register(self.customer, self.urls, policy='partial')
+        self.assertEqual(self.customer.websites.count(), 3)
+        self.assertEqual(self.customer.websites.filter(url__in=self.urls[:2]).count(), 2)
+
+        # There's no room left at all
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            Website.objects.bulk_register(self.customer, self.urls, policy='partial')
+
+    def test_bulk_register_without_subscription(self):
+        """Test that a customer without subscription can't bulk register websites"""
+        with self.assertRaises(ObjectDoesNotExist):
+            Website.objects.bulk_register(mixer.blend(Customer), self.urls[:1])
+
+
+class PlanRegistryTestCase(TestCase):
+    def setUp(self):
+        plan_registry.invalidate()
+        plan_registry.reset_stats()
+        self.plan = mixer.blend(Plan, plan_type='plus')
+        self.customer = mixer.blend(Customer, subscription=self.plan)
+
+    def test_customer_plan_resolved_through_registry(self):
+        """Test that the customers plan is fetched once and then served by the registry"""
+        # the customer and the plan registry miss
+        with self.assertNumQueries(2):
+            self.assertEqual(Customer.objects.get(pk=self.customer.pk).plan, self.plan)
+
+        with self.assertNumQueries(1):
+            customer = Customer.objects.get(pk=self.customer.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(customer.can_add_website())
+            self.assertEqual(customer.get_total_websites_allowed(), 3)
+
+        self.assertEqual(plan_registry.stats()['misses'], 1)
+        self.assertEqual(plan_registry.stats()['hits'], 1)
+
+    def test_registry_invalidated_on_plan_changes(self):
+        """Test that saving or deleting a plan drops it from the registry"""
+        self.assertEqual(plan_registry.get(self.plan.pk).total_websites_allowed, 3)
+
+        self.plan.plan_type = 'single'
+        self.plan.save()
+        self.assertEqual(plan_registry.get(self.plan.pk).total_websites_allowed, 1)
+        self.assertEqual(plan_registry.stats()['misses'], 2)
+
+        plan_id = self.plan.pk
+        self.plan.delete()
+        with self.assertRaises(Plan.DoesNotExist):
+            plan_registry.get(plan_id)
+
+    @override_settings(
+        SUBSCRIPTION_PLAN_REGISTRY_CACHE='default',
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    def test_registry_with_cache_backend(self):
+        """Test that the plans are shared through the django cache backend when configured"""
+        plan_registry.get(self.plan.pk)
+        # another process would only have the shared cache populated
+        plan_registry._plans.clear()
+
+        with self.assertNumQueries(0):
+            plan_registry.get(self.plan.pk)
+        self.assertEqual(plan_registry.stats()['cache_hits'], 1)
+
+        self.plan.save()
+        self.assertIsNone(plan_registry.cache.get(plan_registry.get_cache_key(self.plan.pk)))
+
+    def test_registry_get_many(self):
+        """Test that the plans missing from the registry are fetched together, in a single query"""
+        plans = mixer.cycle(3).blend(Plan)
+        plan_registry.get(plans[0].pk)
+
+        with self.assertNumQueries(1):
+            plans_by_id = plan_registry.get_many([plan.pk for plan in plans] + [0])
+        self.assertEqual(plans_by_id, {plan.pk: plan for plan in plans})
+        with self.assertNumQueries(0):
+            self.assertEqual(plan_registry.get_many([plans[1].pk, plans[2].pk]), {
+                plans[1].pk: plans[1], plans[2].pk: plans[2],
+            })
+        self.assertEqual(plan_registry.stats()['misses'], 4)
+
+    def test_registry_lru_size(self):
+        """Test that the local registry doesn't hold more plans than its size"""
+        plans = mixer.cycle(3).blend(Plan)
+
+        with self.settings(SUBSCRIPTION_PLAN_REGISTRY_SIZE=2):
+            for plan in plans:
+                plan_registry.get(plan.pk)
+        self.assertEqual(plan_registry.stats()['size'], 2)
+
+
+class EntitlementsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.plan = mixer.blend(Plan, plan_type='plus')
+        self.customer = mixer.blend(Customer)
+        Customer.with_subscriptions.subscribe_plan(self.customer, self.plan)
+
+    def test_entitlements_snapshot(self):
+        """Test the snapshot values and that it's served from the cache once built"""
+        Website.objects.create(url='https://foo.bar', customer=self.customer)
+
+        entitlements = self.customer.get_entitlements()
+        self.assertEqual(entitlements.plan_type, 'plus')
+        self.assertEqual(entitlements.total_allowed, 3)
+        self.assertEqual(entitlements.used, 1)
+        self.assertEqual(entitlements.remaining, 2)
+        self.assertEqual(entitlements.renewal_date, self.customer.sub_renewal_date)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.customer.get_entitlements(), entitlements)
+            self.assertTrue(self.customer.can_add_website(use_snapshot=True))
+
+    def test_entitlements_invalidation(self):
+        """Test that the website, customer and plan writes drop the snapshots"""
+        self.assertEqual(self.customer.get_entitlements().used, 0)
+
+        Website.objects.bulk_register(self.customer, ['https://foo.bar', 'https://bar.foo'])
+        self.assertEqual(self.customer.get_entitlements().remaining, 1)
+
+        Website.objects.filter(customer=self.customer).delete()
+        self.assertEqual(self.customer.get_entitlements().remaining, 3)
+
+        self.plan.plan_type = 'infinite'
+        self.plan.save()
+        self.assertIsNone(self.customer.get_entitlements().remaining)
+
+        Customer.with_subscriptions.change_plan(self.customer, mixer.blend(Plan, plan_type='single'))
+        self.assertEqual(self.customer.get_entitlements().remaining, 1)
+
+        self.customer.subscription = None
+        self.customer.save()
+        self.assertFalse(self.customer.get_entitlements().allows_websites())
+        with self.assertRaises(ObjectDoesNotExist):
+            self.customer.can_add_website(use_snapshot=True)
+
+    def test_entitlements_cold_key_lock(self):
+        """Test that, when another caller is building the snapshot, it's waited for instead of built again"""
+        entitlements = get_entitlements(self.customer.pk)
+        cache_key = get_cache_key(self.customer.pk, cache.get('subscription:entitlements:generation'))
+        cache.delete(cache_key)
+        cache.add('{}:lock'.format(cache_key), True)
+
+        def build_snapshot(seconds):
+            cache.set(cache_key, entitlements)
+
+        with mock.patch('subscription.entitlements.time.sleep', side_effect=build_snapshot):
+            with self.assertNumQueries(0):
+                self.assertEqual(get_entitlements(self.customer.pk), entitlements)
+
+
+class QueryPlanTestCase(TestCase):
+    def setUp(self):
+        plan = mixer.blend(Plan)
+        self.customers = mixer.cycle(5).blend(Customer, subscription=plan, sub_renewal_date=date.today())
+
+    def assertUsesIndex(self, queryset):
+        table = queryset.model._meta.db_table
+
+        if connection.vendor == 'sqlite':
+            query_plan = queryset.explain()
+            self.assertIn('USING', query_plan)
+            self.assertNotRegex(query_plan, r'(?m)SCAN (TABLE )?{}\s*$'.format(table))
+        elif connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # the test tables are too small for the planner to pick the indexes on its own
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            query_plan = queryset.explain()
+            self.assertNotIn('Seq Scan on {}'.format(table), query_plan)
+        else:
+            raise unittest.SkipTest('Query plan assertions not available for {}'.format(connection.vendor))
+
+    def test_with_subscriptions_uses_index(self):
+        """Test that the subscribed customers listing uses an index"""
+        self.assertUsesIndex(Customer.with_subscriptions.all())
+
+    def test_renewal_window_uses_index(self):
+        """Test that the renewal window queries use an index"""
+        today = date.today()
+        self.assertUsesIndex(Customer.objects.renewal_window(today, today + timedelta(days=30)))
+        self.assertUsesIndex(Customer.with_subscriptions.filter(sub_renewal_date__lte=today))
+
+    def test_customers_per_plan_uses_index(self):
+        """Test that the customers per plan query uses an index"""
+        self.assertUsesIndex(Customer.objects.filter(subscription=self.customers[0].subscription))
+
+    def test_customer_websites_use_index(self):
+        """Test that the customer websites, ordered by id, use an index"""
+        self.assertUsesIndex(self.customers[0].websites.order_by('id'))
+
+    def test_customer_keyset_page_uses_index(self):
+        """Test that the customers keyset pages use an index"""
+        paginator = customer_keyset(per_page=2)
+        customer = self.customers[2]
+        self.assertUsesIndex(paginator.queryset.order_by(*paginator.ordering).filter(
+            paginator.get_after_filter([customer.date_joined, customer.pk])
+        ))
+
+
+class KeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        self.plan = mixer.blend(Plan, plan_type='infinite')
+        joined = timezone.now()
+        # a few customers joined at the same time, so the pages must break the ties by id
+        self.customers = mixer.cycle(7).blend(
+            Customer, subscription=mixer.sequence(self.plan, None, self.plan, self.plan, None, self.plan, self.plan),
+            date_joined=mixer.sequence(joined, joined, joined, joined - timedelta(days=1), joined, joined, joined),
+        )
+
+    def get_all_pages(self, paginator):
+        objects, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = paginator.get_page(cursor)
+            objects.extend(page.object_list)
+            if page.next_cursor is None:
+                return objects
+            cursor = page.next_cursor
+
+    def test_customer_keyset_pages(self):
+        """Test that the customers keyset pages follow the default ordering, without skipping or repeating"""
+        self.assertEqual(
+            self.get_all_pages(customer_keyset(per_page=2)), list(Customer.objects.order_by('-date_joined', '-id'))
+        )
+        self.assertEqual(
+            self.get_all_pages(customer_keyset(Customer.with_subscriptions.all(), per_page=3)),
+            list(Customer.with_subscriptions.order_by('-date_joined', '-id')),
+        )
+        self.assertEqual(list(customer_keyset(per_page=4)), list(Customer.objects.order_by('-date_joined', '-id')))
+
+    def test_website_keyset_pages(self):
+        """Test that the customer websites keyset pages go by id"""
+        customer = self.customers[0]
+        Website.objects.bulk_register(customer, ['https://example{}.com'.format(number) for number in range(5)])
+        mixer.blend(Website, customer=self.customers[2])
+
+        self.assertEqual(
+            self.get_all_pages(website_keyset(customer, per_page=2)), list(customer.websites.order_by('id'))
+        )
+
+    def test_invalid_cursor(self):
+        """Test that the tampered cursors are rejected"""
+        paginator = customer_keyset(per_page=2)
+        cursor = paginator.get_page().next_cursor
+        self.assertEqual(len(paginator.get_page(cursor).object_list), 2)
+
+        for cursor in ('foo', cursor[:-3], paginator.encode_cursor([1]), paginator.encode_cursor(['foo', 1])):
+            with self.assertRaises(InvalidCursor):
+                paginator.get_page(cursor)
+
+
+@override_settings(SUBSCRIPTION_TTL_DAYS=30)
+class ProcessRenewalsTestCase(TestCase):
+    def setUp(self):
+        plan = mixer.blend(Plan)
+        self.as_of = date(2020, 1, 31)
+        self.due = [
+            mixer.blend(Customer, subscription=plan, sub_renewal_date=date(2020, 1, day)) for day in (10, 10, 20, 31)
+        ]
+        self.not_due = mixer.blend(Customer, subscription=plan, sub_renewal_date=date(2020, 2, 1))
+        self.overdue = mixer.blend(Customer, subscription=plan, sub_renewal_date=date(2019, 12, 1))
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'renewals.json')
+
+    def assertRenewalDate(self, customer, expected):
+        customer.refresh_from_db()
+        self.assertEqual(customer.sub_renewal_date, expected)
+
+    def test_process_renewals(self):
+        """Test that the due subscriptions are renewed by one period and the others are left alone"""
+        call_command('process_renewals', date=self.as_of.isoformat(), chunk_size=2, stdout=StringIO())
+
+        for customer in self.due:
+            expected = customer.sub_renewal_date + timedelta(days=30)
+            self.assertRenewalDate(customer, expected)
+        self.assertRenewalDate(self.not_due, date(2020, 2, 1))
+        # overdue for more than one period, it's renewed until it's no longer due (2019-12-31 is still due)
+        self.assertRenewalDate(self.overdue, date(2020, 2, 29))
+
+    def test_process_renewals_resumes_from_checkpoint(self):
+        """Test that a run resumes after the customer saved in the checkpoint"""
+        first, second = sorted(self.due[:2], key=lambda customer: customer.pk)
+        with open(self.checkpoint, 'w') as checkpoint_file:
+            json.dump({'date': self.as_of.isoformat(), 'position': {'renewal_date': '2020-01-10', 'pk': first.pk}},
+                      checkpoint_file)
+
+        call_command(
+            'process_renewals', date=self.as_of.isoformat(), checkpoint=self.checkpoint, stdout=StringIO()
+        )
+
+        self.assertRenewalDate(first, date(2020, 1, 10))
+        self.assertRenewalDate(second, date(2020, 2, 9))
+        self.assertRenewalDate(self.overdue, date(2019, 12, 1))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_renew_is_set_based(self):
+        """Test that renewing a queryset runs one UPDATE per distinct renewal date"""
+        # due customers + one update per date (10, 20 and 31) + outbox events
+        with self.assertNumQueries(5):
+            renewed = Customer.objects.filter(pk__in=[customer.pk for customer in self.due]).renew()
+        self.assertEqual(renewed, 4)
+
+    def test_renew_invalidates_entitlements(self):
+        """Test that renewing a queryset drops the renewed customers entitlements snapshots"""
+        cache.clear()
+        customer = self.due[-1]
+        self.assertEqual(get_entitlements(customer.pk).renewal_date, date(2020, 1, 31))
+
+        Customer.objects.filter(pk=customer.pk).renew()
+        self.assertEqual(get_entitlements(customer.pk).renewal_date, date(2020, 3, 1))
+
+
+class BulkPlanChangeTestCase(TestCase):
+    def setUp(self):
+        self.old_plan = mixer.blend(Plan, plan_type='infinite')
+        self.new_plan = mixer.blend(Plan, plan_type='plus')
+        self.customers = mixer.cycle(5).blend(Customer, subscription=self.old_plan)
+        self.unsubscribed = mixer.blend(Customer)
+        self.other_plan_customer = mixer.blend(Customer, subscription=mixer.blend(Plan))
+
+    def test_migrate_plan(self):
+        """Test that every customer of the old plan is moved in chunks, with the renewal date reset"""
+        Customer.objects.filter(pk=self.customers[0].pk).update(sub_renewal_date=date(2000, 1, 1))
+        Website.objects.bulk_register(self.customers[1], ['https://foo{}.bar'.format(number) for number in range(4)])
+
+        reports = Customer.objects.migrate_plan(self.old_plan, self.new_plan, chunk_size=2)
+
+        self.assertEqual([report.updated for report in reports], [2, 2, 1])
+        self.assertEqual(sum((report.over_quota_ids for report in reports), []), [self.customers[1].pk])
+        self.assertEqual(Customer.objects.filter(subscription=self.new_plan).count(), 5)
+        self.assertFalse(Customer.objects.filter(subscription=self.old_plan).exists())
+
+        self.customers[0].refresh_from_db()
+        self.assertEqual(self.customers[0].sub_renewal_date, self.customers[1].sub_renewal_date)
+        self.assertGreater(self.customers[0].sub_renewal_date, date.today())
+
+    def test_change_plan_skips_unsubscribed_customers(self):
+        """Test that the customers without subscription are left without one"""
+        reports = Customer.objects.change_plan(self.new_plan)
+
+        self.assertEqual(sum(report.updated for report in reports), 6)
+        self.unsubscribed.refresh_from_db()
+        self.assertIsNone(self.unsubscribed.subscription_id)
+        self.assertEqual(Customer.with_subscriptions.exclude(subscription=self.new_plan).count(), 0)
+
+
+class SubscriptionWritePathTestCase(TestCase):
+    def setUp(self):
+        self.customer = mixer.blend(Customer)
+        self.plan = mixer.blend(Plan)
+        self.new_plan = mixer.blend(Plan)
+
+    def test_subscription_changes_only_write_subscription_fields(self):
+        """Test that subscribing or changing a plan is a single UPDATE that keeps the other columns"""
+        Customer.objects.filter(pk=self.customer.pk).update(first_name='Foo')
+        for plan in (self.plan, self.new_plan):
+            PlanDailyRollup.objects.create(plan=plan, slot=get_rollup_slot(self.customer.pk), day=timezone.localdate())
+
+        # plus the UPDATE of the day rollup of each plan involved, the history and outbox INSERTs
+        with self.assertNumQueries(4):
+            Customer.with_subscriptions.subscribe_plan(self.customer, self.plan)
+        with self.assertNumQueries(5):
+            Customer.with_subscriptions.change_plan(self.customer, self.new_plan)
+
+        customer = Customer.objects.get(pk=self.customer.pk)
+        self.assertEqual(customer.first_name, 'Foo')
+        self.assertEqual(customer.subscription, self.new_plan)
+        self.assertEqual(customer.sub_renewal_date, self.customer.sub_renewal_date)
+
+    def test_concurrent_subscription_change_conflicts(self):
+        """Test that changing a plan based on a stale subscription raises SubscriptionConflict"""
+        Customer.with_subscriptions.subscribe_plan(self.customer, self.plan)
+        stale_customer = Customer.objects.get(pk=self.customer.pk)
+        Customer.with_subscriptions.change_plan(self.customer, self.new_plan)
+
+        with self.assertRaises(SubscriptionConflict):
+            Customer.with_subscriptions.change_plan(stale_customer, mixer.blend(Plan))
+        self.assertEqual(Customer.objects.get(pk=self.customer.pk).subscription, self.new_plan)
+
+    def test_save_recalculates_renewal_date_on_subscription_changes(self):
+        """Test that only the subscription changes reset the renewal date on save"""
+        Customer.with_subscriptions.subscribe_plan(self.customer, self.plan)
+        Customer.objects.filter(pk=self.customer.pk).update(sub_renewal_date=date(2000, 1, 1))
+        customer = Customer.objects.get(pk=self.customer.pk)
+
+        customer.first_name = 'Foo'
+        customer.save()
+        self.assertEqual(Customer.objects.get(pk=customer.pk).sub_renewal_date, date(2000, 1, 1))
+
+        customer.subscription = self.new_plan
+        customer.save(update_fields=['subscription'])
+        self.assertEqual(Customer.objects.get(pk=customer.pk).sub_renewal_date, self.customer.sub_renewal_date)
+
+
+class AdminChangelistTestCase(TestCase):
+    def setUp(self):
+        self.client.force_login(Customer.objects.create_superuser('admin', 'admin@foo.bar', 'admin'))
+        self.plans = [mixer.blend(Plan, plan_type=plan_type) for plan_type in ('single', 'plus', 'infinite')]
+
+    def add_rows(self, total):
+        customers = mixer.cycle(total).blend(
+            Customer, subscription=(self.plans[number % 3] for number in range(total)), sub_renewal_date=date.today()
+        )
+        Website.objects.bulk_create([Website(url='https://foo.bar', customer=customer) for customer in customers])
+
+    def count_changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url):
+        self.add_rows(50)
+        # the first request fills the plan registry
+        self.count_changelist_queries(url)
+        queries = self.count_changelist_queries(url)
+        # bigger than a page (list_per_page=100), the queries must not grow with the rows in the page
+        self.add_rows(150)
+        self.assertEqual(self.count_changelist_queries(url), queries)
+        self.assertEqual(self.count_changelist_queries(url + '?p=1'), queries)
+
+    def test_customer_changelist_queries(self):
+        """Test that the customers changelist runs the same queries for any page size"""
+        self.assertConstantQueries(reverse('admin:subscription_customer_changelist'))
+
+    def test_customer_changelist_filters_queries(self):
+        """Test that the plan type and renewal window filters run the same queries for any page size"""
+        self.assertConstantQueries(reverse('admin:subscription_customer_changelist') + '?plan_type=plus&renewal=week')
+
+    def test_website_changelist_queries(self):
+        """Test that the websites changelist runs the same queries for any page size"""
+        self.assertConstantQueries(reverse('admin:subscription_website_changelist'))
+
+    def test_changelist_filters(self):
+        """Test that the plan type and renewal window filters select the right customers"""
+        self.add_rows(6)
+        Customer.objects.filter(subscription=self.plans[0]).update(sub_renewal_date=date.today() - timedelta(days=1))
+        url = reverse('admin:subscription_customer_changelist')
+
+        response = self.client.get(url, {'plan_type': 'plus'})
+        self.assertEqual(response.context['cl'].result_count, 2)
+        response = self.client.get(url, {'renewal': 'overdue'})
+        self.assertEqual(response.context['cl'].result_count, 2)
+        response = self.client.get(url, {'renewal': 'week', 'plan_type': 'single'})
+        self.assertEqual(response.context['cl'].result_count, 0)
+
+
+class BenchmarksTestCase(TestCase):
+    def setUp(self):
+        seed_subscriptions(50, seed=1)
+
+    def test_seeded_data(self):
+        """Test that the seeded customers websites respect their plans and counters"""
+        self.assertEqual(Customer.objects.count(), 50)
+        self.assertFalse(Customer.objects.with_websites_count_drift().exists())
+        for plan_type, total_allowed in (('single', 1), ('plus', 3)):
+            self.assertFalse(Customer.objects.filter(
+                subscription__plan_type=plan_type, websites_count__gt=total_allowed
+            ).exists())
+
+    def test_seed_is_deterministic(self):
+        """Test that the same seed generates the same data, whatever the day it runs"""
+        fields = (
+            'username', 'subscription__plan_type', 'websites_count', 'date_joined', 'sub_renewal_date', 'password',
+        )
+        customers = list(Customer.objects.order_by('pk').values_list(*fields))
+        Website.objects.all().delete()
+        Customer.objects.all().delete()
+
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(days=3)):
+            call_command('seed_subscriptions', customers=50, seed=1, stdout=StringIO())
+        self.assertEqual(list(Customer.objects.order_by('pk').values_list(*fields)), customers)
+        self.assertTrue(Customer.objects.order_by('pk').first().check_password('password'))
+
+        Website.objects.all().delete()
+        Customer.objects.all().delete()
+        call_command('seed_subscriptions', customers=50, seed=1, today='2026-01-01', password='foo', stdout=StringIO())
+        customer = Customer.objects.order_by('pk').first()
+        self.assertTrue(customer.check_password('foo'))
+        self.assertLessEqual(customer.date_joined.date(), date(2026, 1, 1))
+        with self.assertRaises(CommandError):
+            call_command('seed_subscriptions', customers=1, today='foo', stdout=StringIO())
+
+    def test_run_benchmarks(self):
+        """Test that every hot path is measured, with the expected queries per operation"""
+        results = run_benchmarks(iterations=5)
+
+        self.assertEqual(set(results), {'can_add_website', 'website_save', 'subscribe_plan', 'change_plan'})
+        self.assertEqual(results['subscribe_plan']['iterations'], 5)
+        # the subscription UPDATE, plus the rollups UPDATE of each plan involved, the history and outbox INSERTs
+        self.assertEqual(results['subscribe_plan']['queries_per_op'], 4)
+        self.assertEqual(results['change_plan']['queries_per_op'], 5)
+        self.assertLessEqual(results['can_add_website']['queries_per_op'], 1)
+        self.assertEqual(compare_results(results, results), [])
+
+    def test_operation_stats(self):
+        """Test that the rows read and written per operation are counted, and the p95 is the nearest rank one"""
+        stats = OperationStats()
+        with stats.measure():
+            list(Customer.objects.all()[:20])
+            Customer.objects.order_by('pk').first()
+        with stats.measure():
+            Customer.objects.filter(pk__in=Customer.objects.order_by('pk').values('pk')[:10]).update(first_name='Foo')
+        self.assertEqual(stats.as_dict()['rows_per_op'], (20 + 1 + 10) / 2)
+
+        stats.durations = [number / 1000 for number in range(1, 21)]
+        self.assertEqual(stats.as_dict()['p95_ms'], 19)
+        stats.durations = [number / 1000 for number in range(1, 11)]
+        self.assertEqual(stats.as_dict()['p95_ms'], 10)
+
+    def test_compare_results_regressions(self):
+        """Test that slower paths, and paths running more queries, are reported as regressions"""
+        baseline = {'change_plan': {'mean_ms': 1.0, 'queries_per_op': 1}}
+
+        self.assertEqual(compare_results({'change_plan': {'mean_ms': 1.1, 'queries_per_op': 1}}, baseline), [])
+        self.assertEqual(len(compare_results({'change_plan': {'mean_ms': 1.5, 'queries_per_op': 1}}, baseline)), 1)
+        self.assertEqual(len(compare_results({'change_plan': {'mean_ms': 1.0, 'queries_per_op': 2}}, baseline)), 1)
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        view_histograms.clear()
+        self.client.force_login(Customer.objects.create_superuser('admin', 'admin@foo.bar', 'admin'))
+
+    def test_track_queries(self):
+        """Test that the queries, duplicated queries and times of a block are measured and logged"""
+        customer = mixer.blend(Customer)
+
+        with self.assertLogs('subscription.instrumentation', 'INFO') as logs:
+            with track_queries('customers') as stats:
+                Customer.objects.get(pk=customer.pk)
+                Customer.objects.get(pk=customer.pk)
+                Plan.objects.count()
+
+        self.assertEqual(stats.queries, 3)
+        self.assertEqual(stats.duplicates, 1)
+        self.assertGreater(stats.seconds, 0)
+        self.assertEqual(json.loads(logs.records[0].getMessage())['block'], 'customers')
+
+    @override_settings(
+        MIDDLEWARE=['subscription.instrumentation.SQLInstrumentationMiddleware'] + list(settings.MIDDLEWARE)
+    )
+    def test_middleware(self):
+        """Test that the sampled requests get a Server-Timing header and feed the view histograms"""
+        url = reverse('admin:subscription_customer_changelist')
+
+        with self.settings(SUBSCRIPTION_SQL_SAMPLE_RATE=0):
+            self.assertNotIn('Server-Timing', self.client.get(url))
+        # only a small fraction of the requests is sampled by default
+        with mock.patch('subscription.instrumentation.random.random', return_value=0.5):
+            self.assertNotIn('Server-Timing', self.client.get(url))
+        self.assertEqual(view_histograms.summary(), {})
+
+        with self.settings(SUBSCRIPTION_SQL_SAMPLE_RATE=1), self.assertLogs('subscription.instrumentation', 'INFO'):
+            response = self.client.get(url)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[0-9.]+;desc="\d+ queries, \d+ duplicated"')
+        summary = view_histograms.summary()['admin:subscription_customer_changelist']
+        self.assertEqual(summary['queries']['count'], 1)
+        self.assertGreater(summary['queries']['p50'], 0)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        aggregator.clear()
+        self.customer = mixer.blend(Customer)
+        self.url = reverse('subscription:metrics')
+
+    def test_operations_metrics(self):
+        """Test that the subscription operations and quota rejections are counted and timed"""
+        Customer.with_subscriptions.subscribe_plan(self.customer, mixer.blend(Plan, plan_type='single'))
+        Website.objects.create(url='https://foo.bar', customer=self.customer)
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            Website.objects.create(url='https://bar.foo', customer=self.customer)
+        self.customer.can_add_website()
+
+        self.assertEqual(aggregator.counters[('subscribe_plan', 'ok')], 1)
+        self.assertEqual(aggregator.counters[('website_save', 'ok')], 1)
+        self.assertEqual(aggregator.counters[('website_save', 'rejected')], 1)
+        self.assertEqual(aggregator.counters[('quota_check', 'ok')], 1)
+
+        metrics = aggregator.render()
+        self.assertIn('subscription_operations_total{operation="website_save",outcome="rejected"} 1', metrics)
+        self.assertIn('subscription_operation_duration_seconds_count{operation="website_save"} 2', metrics)
+        self.assertIn('subscription_operation_duration_seconds{operation="subscribe_plan",quantile="0.99"}', metrics)
+
+    def test_metrics_endpoint_access(self):
+        """Test that the metrics endpoint is only readable by the staff or with the configured token"""
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+        self.client.force_login(Customer.objects.create_superuser('admin', 'admin@foo.bar', 'admin'))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+        self.client.logout()
+        with self.settings(SUBSCRIPTION_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer foo').status_code, 403)
+            self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.plan = mixer.blend(Plan, name='Plus', plan_type='plus', price=Decimal('19.99'))
+        self.customer = mixer.blend(Customer, username='foo', email='foo@bar.com', subscription=self.plan)
+        Website.objects.bulk_register(self.customer, ['https://example.com', 'https://example.org'])
+        self.unsubscribed = mixer.blend(Customer, username='bar', email='bar@foo.com')
+        self.url = reverse('subscription:export')
+
+    def test_export_rows_single_query(self):
+        """Test that the export rows come from a single query, with the plan and websites count"""
+        with self.assertNumQueries(1):
+            rows = list(export_rows())
+        self.assertEqual(list(export_rows(chunk_size=1)), rows)
+
+        self.assertEqual(rows, [
+            (
+                self.customer.pk, 'foo', 'foo@bar.com', 'Plus', 'plus', Decimal('19.99'),
+                self.customer.sub_renewal_date, 2,
+            ),
+            (self.unsubscribed.pk, 'bar', 'bar@foo.com', None, None, None, None, 0),
+        ])
+
+    def test_export_endpoint(self):
+        """Test that the export endpoint streams the CSV and NDJSON formats"""
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(Customer.objects.create_superuser('admin', 'admin@foo.bar', 'admin'))
+
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,username,email,plan,plan_type,price,renewal_date,websites_count')
+        self.assertEqual(lines[1], '{},foo,foo@bar.com,Plus,plus,19.99,{},2'.format(
+            self.customer.pk, self.customer.sub_renewal_date
+        ))
+        self.assertEqual(len(lines), 4)
+
+        response = self.client.get(self.url, {'format': 'ndjson'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(rows[0]['websites_count'], 2)
+        self.assertEqual(rows[0]['renewal_date'], self.customer.sub_renewal_date.isoformat())
+        self.assertEqual(self.client.get(self.url, {'format': 'xml'}).status_code, 400)
+
+    def test_export_command(self):
+        """Test that the export command writes the export to a file"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.ndjson')
+            out = StringIO()
+            call_command('export_subscriptions', '--format', 'ndjson', '--output', path, stdout=out)
+
+            with open(path) as export:
+                self.assertEqual([json.loads(line)['username'] for line in export], ['foo', 'bar'])
+        self.assertIn('Exported 2 customer(s)', out.getvalue())
+
+
+class ImportTestCase(TestCase):
+    def setUp(self):
+        self.plan = mixer.blend(Plan, name='Plus', plan_type='plus')
+        mixer.blend(Customer, username='taken')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as input_file:
+            input_file.write(content)
+        return path
+
+    def test_import_command(self):
+        """Test that the valid rows are imported and the invalid ones rejected, with the reason"""
+        path = self.write_file('customers.csv', '\n'.join([
+            'username,email,plan,renewal_date,websites',
+            'foo,foo@bar.com,plus,2030-01-01,https://foo.com https://foo.org',
+            'bar,bar@foo.com,,,',
+            'baz,,Plus,,not-an-url',
+            'qux,,plus,,https://a.com https://b.com https://c.com https://d.com',
+            'quux,,gold,,',
+            'taken,,,,',
+            'foo,,,,',
+            'corge,,,,https://corge.com',
+        ]))
+        reject_path = os.path.join(self.directory.name, 'rejects.ndjson')
+
+        out = StringIO()
+        call_command('import_subscriptions', path, '--batch-size', '3', '--reject-file', reject_path, stdout=out)
+        self.assertIn('Imported 2 customers and 2 websites, rejected 6 row(s)', out.getvalue())
+
+        foo = Customer.objects.get(username='foo')
+        self.assertEqual((foo.subscription, foo.sub_renewal_date, foo.websites_count), (self.plan, date(2030, 1, 1), 2))
+        self.assertEqual(sorted(foo.websites.values_list('url', flat=True)), ['https://foo.com', 'https://foo.org'])
+        self.assertIsNone(Customer.objects.get(username='bar').subscription)
+        self.assertFalse(Customer.objects.with_websites_count_drift().exists())
+        # the imported websites are announced downstream, as the other website writes
+        payloads = [json.loads(payload) for payload in OutboxEvent.objects.filter(
+            event_type='website.added'
+        ).values_list('payload', flat=True)]
+        self.assertEqual(sorted((payload['website_id'], payload['url']) for payload in payloads), sorted(
+            foo.websites.values_list('pk', 'url')
+        ))
+
+        with open(reject_path) as reject_file:
+            rejects = [json.loads(line) for line in reject_file]
+        self.assertEqual([reject['line'] for reject in rejects], [4, 5, 6, 7, 8, 9])
+        self.assertTrue(rejects[0]['errors'][0].endswith('(not-an-url)'))
+        self.assertIn('4 websites, but the plan only allows 3.', rejects[1]['errors'])
+        self.assertIn('Unknown plan (gold).', rejects[2]['errors'])
+        self.assertEqual(rejects[3]['errors'], rejects[4]['errors'])
+        self.assertIn('Websites need a subscription.', rejects[5]['errors'])
+
+        new_customer = Customer.objects.create_user('grault')
+        self.assertGreater(new_customer.pk, foo.pk)
+
+    def test_import_resume(self):
+        """Test that an import with a checkpoint resumes after the last imported line"""
+        path = self.write_file('customers.ndjson', '\n'.join([
+            json.dumps({'username': 'foo', 'plan': 'plus', 'websites': ['https://foo.com']}),
+            '{not json',
+            json.dumps({'username': 'bar'}),
+        ]))
+        checkpoint_path = self.write_file('checkpoint.json', json.dumps({'input': path, 'line': 1}))
+
+        out = StringIO()
+        call_command('import_subscriptions', path, '--checkpoint', checkpoint_path, stdout=out)
+        self.assertIn('Resuming after line 1', out.getvalue())
+        self.assertIn('Imported 1 customers and 0 websites, rejected 1 row(s)', out.getvalue())
+        self.assertFalse(Customer.objects.filter(username='foo').exists())
+        self.assertTrue(Customer.objects.filter(username='bar').exists())
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+
+@override_settings(SUBSCRIPTION_API_TOKEN='secret')
+class SubscriptionApiTestCase(TestCase):
+    def setUp(self):
+        self.plan = mixer.blend(Plan, name='Plus', plan_type='plus', price=Decimal('19.99'))
+        self.other_plan = mixer.blend(Plan, name='Unlimited', plan_type='infinite')
+        self.customer = mixer.blend(Customer, subscription=self.plan)
+        Website.objects.bulk_register(self.customer, ['https://example.com', 'https://example.org'])
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer secret'}
+        self.detail_url = reverse('subscription:customer-detail', args=[self.customer.pk])
+
+    def post(self, name, data, customer=None, **extra):
+        url = reverse('subscription:{}'.format(name), args=[(customer or self.customer).pk])
+        return self.client.post(url, json.dumps(data), content_type='application/json', **extra)
+
+    def test_customer_detail(self):
+        """Test that the customer detail has the plan and the websites quota usage"""
+        self.assertEqual(self.client.get(self.detail_url).status_code, 403)
+
+        response = self.client.get(self.detail_url, **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['plan']['name'], 'Plus')
+        self.assertEqual(response.json()['websites'], {'used': 2, 'allowed': 3, 'remaining': 1})
+        self.assertEqual(response.json()['renewal_date'], self.customer.sub_renewal_date.isoformat())
+
+        url = reverse('subscription:customer-detail', args=[self.customer.pk + 100])
+        self.assertEqual(self.client.get(url, **self.auth).status_code, 404)
+
+    def test_conditional_get(self):
+        """Test that the unchanged resources answer 304 from the customer version stamp alone"""
+        response = self.client.get(self.detail_url, **self.auth)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag, **self.auth)
+        self.assertEqual(response.status_code, 304)
+        websites_url = reverse('subscription:customer-websites', args=[self.customer.pk])
+        with self.assertNumQueries(1):
+            response = self.client.get(websites_url, HTTP_IF_NONE_MATCH=etag, **self.auth)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.detail_url, HTTP_IF_MODIFIED_SINCE=last_modified, **self.auth)
+        self.assertEqual(response.status_code, 304)
+
+        website = self.customer.websites.first()
+        website.url = 'https://example.net'
+        website.save()
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag, **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        Plan.objects.filter(pk=self.plan.pk).update(name='Plus+')
+        plan_registry.invalidate()
+        self.assertNotEqual(self.client.get(self.detail_url, **self.auth)['ETag'], response['ETag'])
+
+    def test_customer_websites(self):
+        """Test that the customer websites are listed in keyset pages"""
+        url = reverse('subscription:customer-websites', args=[self.customer.pk])
+        response = self.client.get(url, {'per_page': 1}, **self.auth)
+        self.assertEqual([website['url'] for website in response.json()['results']], ['https://example.com'])
+
+        response = self.client.get(url, {'per_page': 1, 'cursor': response.json()['next_cursor']}, **self.auth)
+        self.assertEqual(response.json(), {
+            'results': [{'id': self.customer.websites.last().pk, 'url': 'https://example.org'}], 'next_cursor': None,
+        })
+        self.assertEqual(self.client.get(url, {'cursor': 'foo'}, **self.auth).status_code, 400)
+
+    def test_subscribe(self):
+        """Test that a customer without subscription can subscribe a plan, only once"""
+        customer = mixer.blend(Customer)
+        self.assertEqual(self.post('customer-subscribe', {'plan': 0}, customer, **self.auth).status_code, 400)
+
+        response = self.post('customer-subscribe', {'plan': self.plan.pk}, customer, **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['plan']['id'], self.plan.pk)
+        self.assertEqual(Customer.objects.get(pk=customer.pk).subscription, self.plan)
+
+        response = self.post('customer-subscribe', {'plan': self.plan.pk}, customer, **self.auth)
+        self.assertEqual(response.status_code, 400)
+
+    def test_change_plan_preconditions(self):
+        """Test that the plan changes honor If-Match, and answer the new ETag"""
+        etag = self.client.get(self.detail_url, **self.auth)['ETag']
+
+        response = self.post('customer-change-plan', {'plan': self.other_plan.pk}, HTTP_IF_MATCH='"stale"', **self.auth)
+        self.assertEqual(response.status_code, 412)
+
+        response = self.post('customer-change-plan', {'plan': self.other_plan.pk}, HTTP_IF_MATCH=etag, **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['websites'], {'used': 2, 'allowed': None, 'remaining': None})
+        self.assertEqual(response['ETag'], self.client.get(self.detail_url, **self.auth)['ETag'])
+
+        response = self.post('customer-change-plan', {'plan': self.other_plan.pk}, **self.auth)
+        self.assertEqual(response.status_code, 400)
+
+    def test_customer_session_access(self):
+        """Test that the customers can only read the API for themselves, the staff writes need the CSRF token"""
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.customer)
+
+        self.assertEqual(client.get(self.detail_url).status_code, 200)
+        other_customer = mixer.blend(Customer)
+        url = reverse('subscription:customer-detail', args=[other_customer.pk])
+        self.assertEqual(client.get(url).status_code, 403)
+
+        url = reverse('subscription:customer-change-plan', args=[self.customer.pk])
+        data = json.dumps({'plan': self.other_plan.pk})
+        client.cookies[settings.CSRF_COOKIE_NAME] = 'a' * 64
+        response = client.post(url, data, content_type='application/json', HTTP_X_CSRFTOKEN='a' * 64)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Customer.objects.get(pk=self.customer.pk).subscription_id, self.customer.subscription_id)
+
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(mixer.blend(Customer, is_staff=True))
+        self.assertEqual(client.post(url, data, content_type='application/json').status_code, 403)
+        client.cookies[settings.CSRF_COOKIE_NAME] = 'a' * 64
+        response = client.post(url, data, content_type='application/json', HTTP_X_CSRFTOKEN='a' * 64)
+        self.assertEqual(response.status_code, 200)
+
+
+class LoadersTestCase(TestCase):
+    def setUp(self):
+        plan_registry.invalidate()
+        self.plans = mixer.cycle(2).blend(Plan, plan_type='infinite')
+        self.customers = mixer.cycle(6).blend(Customer, subscription=mixer.sequence(*self.plans, None))
+        for customer in self.customers:
+            if customer.subscription_id:
+                Website.objects.bulk_register(customer, ['https://{}.com'.format(customer.username)])
+
+    def test_loader_batches_and_memoizes(self):
+        """Test that the loader resolves the queued keys in a single batch, once"""
+        batches = []
+        loader = Loader(lambda keys: batches.append(sorted(keys)) or {key: key * 2 for key in keys if key != 3})
+
+        loader.queue(1, 2)
+        self.assertEqual(loader.load(3), None)
+        self.assertEqual(loader.load_many([1, 2, 3, 4]), [2, 4, None, 8])
+        self.assertEqual(loader.load(1), 2)
+        self.assertEqual(batches, [[1, 2, 3], [4]])
+
+    def test_prime_customers(self):
+        """Test that the customers plans and websites are loaded in one query per relation"""
+        customers = list(Customer.objects.order_by('pk'))
+        with self.assertNumQueries(2):
+            SubscriptionLoaders().prime_customers(customers, websites=True)
+        # the plans come from the plan registry once it holds them
+        with self.assertNumQueries(1):
+            SubscriptionLoaders().prime_customers(customers, websites=True)
+
+        with self.assertNumQueries(0):
+            for customer in customers:
+                self.assertEqual(customer.plan, customer.subscription)
+                self.assertEqual(customer.get_total_websites_allowed(), 0 if customer.subscription else None)
+                self.assertEqual(len(customer.websites.all()), customer.websites_count)
+
+        self.assertEqual([customer.subscription for customer in customers], [
+            customer.subscription for customer in self.customers
+        ])
+
+    @override_settings(SUBSCRIPTION_API_TOKEN='secret')
+    def test_customer_list_queries(self):
+        """Test that the customers listing costs the same queries whatever the number of customers"""
+        url = reverse('subscription:customer-list')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'websites': '1'}, HTTP_AUTHORIZATION='Bearer secret')
+        # the customers page and their websites, the plans are in the plan registry already
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                self.client.get(url, {'websites': '1'}, HTTP_AUTHORIZATION='Bearer secret').json(), response.json()
+            )
+        results = response.json()['results']
+        self.assertEqual([result['id'] for result in results], [
+            customer.pk for customer in Customer.objects.order_by('-date_joined', '-id')
+        ])
+        result = next(result for result in results if result['id'] == self.customers[0].pk)
+        self.assertEqual(result['plan']['id'], self.plans[0].pk)
+        self.assertEqual([website['url'] for website in result['websites']['items']], [
+            'https://{}.com'.format(self.customers[0].username)
+        ])
+
+    def test_export_websites(self):
+        """Test that the export websites urls are batch loaded, a query per page"""
+        with self.assertNumQueries(2):
+            rows = list(export_rows(websites=True))
+        self.assertEqual(rows[0][-1], ['https://{}.com'.format(self.customers[0].username)])
+        self.assertEqual(rows[-1][-1], [])
+
+        # 2 pages of customers and their websites
+        with self.assertNumQueries(4):
+            self.assertEqual(list(export_rows(chunk_size=3, websites=True)), rows)
+
+
+class OverQuotaReconciliationTestCase(TestCase):
+    def setUp(self):
+        self.single_plan = mixer.blend(Plan, plan_type='single')
+        infinite_plan = mixer.blend(Plan, plan_type='infinite')
+        self.customers = mixer.cycle(3).blend(Customer, subscription=infinite_plan)
+        for number, customer in enumerate(self.customers):
+            Website.objects.bulk_register(customer, ['https://{}-{}.com'.format(customer.pk, n) for n in range(3)])
+            if number < 2:
+                # downgraded, keeping the websites
+                Customer.with_subscriptions.change_plan(customer, self.single_plan)
+
+    def test_over_quota_single_query(self):
+        """Test that the over quota customers are found with a single grouped query"""
+        with self.assertNumQueries(1):
+            over_quota = list(Customer.objects.over_quota().order_by('pk'))
+
+        self.assertEqual(over_quota, self.customers[:2])
+        self.assertEqual([customer.real_websites_count for customer in over_quota], [3, 3])
+
+    def test_detach_policy(self):
+        """Test that the detach policy detaches the newest websites beyond the plan limit"""
+        out = StringIO()
+        call_command('reconcile_quotas', '--policy', 'detach', '--chunk-size', '1', stdout=out)
+        self.assertIn('2 over quota customer(s), policy detach applied', out.getvalue())
+
+        customer = Customer.objects.get(pk=self.customers[0].pk)
+        self.assertEqual(customer.websites_count, 1)
+        self.assertEqual(
+            list(customer.websites.values_list('url', flat=True)), ['https://{}-0.com'.format(customer.pk)]
+        )
+        self.assertEqual(Website.objects.filter(customer=None).count(), 4)
+        self.assertFalse(Customer.objects.over_quota().exists())
+
+    def test_flag_and_block_policies(self):
+        """Test that the flag and block policies mark the customers, until they're within the limit again"""
+        call_command('reconcile_quotas', stdout=StringIO())
+        self.assertFalse(Customer.objects.filter(over_quota_since__isnull=False).exists())
+
+        call_command('reconcile_quotas', '--policy', 'block', stdout=StringIO())
+        self.assertEqual(
+            set(Customer.objects.filter(over_quota_since__isnull=False, is_active=False)), set(self.customers[:2])
+        )
+
+        self.customers[0].websites.order_by('-id')[0].delete()
+        self.customers[0].websites.order_by('-id')[0].delete()
+        out = StringIO()
+        call_command('reconcile_quotas', '--policy', 'block', stdout=out)
+        self.assertIn('Cleared 1 customer(s)', out.getvalue())
+        customer = Customer.objects.get(pk=self.customers[0].pk)
+        self.assertEqual((customer.over_quota_since, customer.is_active), (None, True))
+
+    def test_block_policy_only_reactivates_its_blocks(self):
+        """Test that the block policy doesn't reactivate the customers deactivated for other reasons"""
+        call_command('reconcile_quotas', '--policy', 'flag', stdout=StringIO())
+        # disabled by the staff meanwhile
+        Customer.objects.filter(pk=self.customers[1].pk).update(is_active=False)
+        call_command('reconcile_quotas', '--policy', 'block', stdout=StringIO())
+        self.assertEqual(set(Customer.objects.filter(blocked_for_quota=True)), {self.customers[0]})
+
+        for customer in self.customers[:2]:
+            customer.websites.filter(pk__in=customer.websites.order_by('-id').values('pk')[:2]).delete()
+        call_command('reconcile_quotas', '--policy', 'block', stdout=StringIO())
+        customers = Customer.objects.filter(pk__in=[customer.pk for customer in self.customers[:2]]).order_by('pk')
+        self.assertEqual(
+            list(customers.values_list('over_quota_since', 'is_active', 'blocked_for_quota')),
+            [(None, True, False), (None, False, False)],
+        )
+
+
+class RollupsTestCase(TestCase):
+    def setUp(self):
+        self.single_plan = mixer.blend(Plan, plan_type='single', price=Decimal('5.00'))
+        self.plus_plan = mixer.blend(Plan, plan_type='plus', price=Decimal('10.00'))
+        self.infinite_plan = mixer.blend(Plan, plan_type='infinite', price=Decimal('20.00'))
+        self.customer = mixer.blend(Customer, subscription=self.infinite_plan)
+
+    def assertSnapshotMatchesCustomers(self):
+        expected = {}
+        for customer in Customer.with_subscriptions.select_related('subscription'):
+            totals = expected.setdefault(
+                customer.subscription_id, {'customers': 0, 'websites': 0, 'revenue': Decimal('0')}
+            )
+            totals['customers'] += 1
+            totals['websites'] += customer.websites_count
+            totals['revenue'] += customer.subscription.price
+        snapshot = {plan_id: totals for plan_id, totals in get_snapshot().items() if totals['customers']}
+        self.assertEqual(snapshot, expected)
+
+    def test_write_paths_maintain_rollups(self):
+        """Test that the subscription and website writes keep the rollups in step with the customers"""
+        website = Website.objects.create(url='https://foo.bar', customer=self.customer)
+        Website.objects.bulk_register(self.customer, ['https://foo{}.bar'.format(number) for number in range(3)])
+        self.assertSnapshotMatchesCustomers()
+
+        other = mixer.blend(Customer, subscription=None)
+        Customer.with_subscriptions.subscribe_plan(other, self.plus_plan)
+        website.customer = other
+        website.save()
+        self.assertSnapshotMatchesCustomers()
+
+        Customer.with_subscriptions.change_plan(self.customer, self.single_plan)
+        Customer.objects.filter(pk=other.pk).change_plan(self.infinite_plan)
+        self.assertSnapshotMatchesCustomers()
+
+        other.refresh_from_db()
+        other.subscription = self.plus_plan
+        other.save()
+        self.customer.websites.all()[:1].get().delete()
+        Website.objects.filter(customer=self.customer).update(customer=other)
+        self.assertSnapshotMatchesCustomers()
+
+        Website.objects.filter(customer=other)[:1].get().delete()
+        Website.objects.filter(customer=other).delete()
+        self.customer.delete()
+        self.assertSnapshotMatchesCustomers()
+
+    def test_plan_price_change(self):
+        """Test that a plan price change reprices its rollup"""
+        mixer.cycle(2).blend(Customer, subscription=self.plus_plan)
+        self.plus_plan.price = Decimal('12.50')
+        self.plus_plan.save()
+
+        self.assertEqual(get_snapshot()[self.plus_plan.pk]['revenue'], Decimal('25.00'))
+        self.assertSnapshotMatchesCustomers()
+
+    def test_snapshot_carries_forward(self):
+        """Test that a day without changes reads the previous snapshot, and the next change starts from it"""
+        today = timezone.localdate()
+        PlanDailyRollup.objects.filter(plan=self.infinite_plan).update(day=today - timedelta(days=2))
+
+        self.assertEqual(get_snapshot(today - timedelta(days=3)), {})
+        self.assertEqual(get_snapshot(today - timedelta(days=1))[self.infinite_plan.pk]['customers'], 1)
+
+        # in the same rollup slot
+        mixer.blend(Customer, id=self.customer.pk + get_rollup_slots(), subscription=self.infinite_plan)
+        self.assertEqual(get_snapshot()[self.infinite_plan.pk]['customers'], 2)
+        self.assertEqual(get_snapshot(today - timedelta(days=1))[self.infinite_plan.pk]['customers'], 1)
+        self.assertEqual(PlanDailyRollup.objects.filter(plan=self.infinite_plan).count(), 2)
+
+    def test_snapshot_single_query(self):
+        """Test that the dashboard snapshot reads the rollups in a single query, whatever the customers"""
+        mixer.cycle(5).blend(Customer, subscription=self.single_plan)
+
+        with self.assertNumQueries(1):
+            snapshot = get_snapshot()
+        self.assertEqual(set(snapshot), {self.single_plan.pk, self.infinite_plan.pk})
+        self.assertEqual(get_plan_type_distribution()['single']['revenue'], Decimal('25.00'))
+
+    def test_rebuild_rollups(self):
+        """Test that the rebuild rewrites the rollups from the customers table"""
+        mixer.cycle(3).blend(Customer, subscription=self.plus_plan)
+        PlanDailyRollup.objects.update(customers=0, websites=0, revenue=0)
+
+        out = StringIO()
+        call_command('rebuild_rollups', stdout=out)
+        self.assertIn('Rebuilt 2 plan rollup(s)', out.getvalue())
+        self.assertSnapshotMatchesCustomers()
+        self.assertEqual(rebuild_rollups(), 2)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rollups', '--date', 'foo', stdout=StringIO())
+
+
+class AnalyticsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.single_plan = mixer.blend(Plan, plan_type='single')
+        self.plus_plan = mixer.blend(Plan, plan_type='plus')
+
+    def add_history(self, joined, *changes):
+        customer = mixer.blend(Customer, subscription=None, date_joined=self.at(joined))
+        old_plan = None
+        for changed, new_plan in changes:
+            SubscriptionChange.objects.create(
+                customer=customer, customer_joined=customer.date_joined, old_plan=old_plan, new_plan=new_plan,
+                created=self.at(changed),
+            )
+            old_plan = new_plan
+        return customer
+
+    def at(self, day):
+        return timezone.make_aware(datetime.combine(day, datetime.min.time()) + timedelta(hours=12))
+
+    def add_cohorts(self):
+        # subscribed in january and cancelled in february
+        self.add_history(date(2026, 1, 10), (date(2026, 1, 10), self.single_plan), (date(2026, 2, 15), None))
+        # subscribed in january, still subscribed
+        self.add_history(date(2026, 1, 20), (date(2026, 1, 20), self.plus_plan))
+        # joined in february, subscribed in march
+        self.add_history(date(2026, 2, 5), (date(2026, 3, 1), self.single_plan))
+        # never subscribed
+        self.add_history(date(2026, 1, 5))
+
+    def test_write_paths_record_history(self):
+        """Test that every subscription change is recorded, subscribing and cancelling included"""
+        customer = mixer.blend(Customer, subscription=None)
+        new_plan = mixer.blend(Plan)
+        Customer.with_subscriptions.subscribe_plan(customer, self.single_plan)
+        Customer.with_subscriptions.change_plan(customer, self.plus_plan)
+        Customer.objects.filter(pk=customer.pk).change_plan(new_plan)
+        customer.refresh_from_db()
+        customer.subscription = None
+        customer.save()
+        other = mixer.blend(Customer, subscription=self.single_plan)
+        other.delete()
+
+        self.assertEqual(list(customer.subscription_changes.order_by('pk').values_list('old_plan', 'new_plan')), [
+            (None, self.single_plan.pk), (self.single_plan.pk, self.plus_plan.pk), (self.plus_plan.pk, new_plan.pk),
+            (new_plan.pk, None),
+        ])
+        # the deleted customer history is kept, with its cancellation
+        self.assertEqual(list(SubscriptionChange.objects.exclude(customer=customer).order_by('pk').values_list(
+            'old_plan', 'new_plan'
+        )), [(None, self.single_plan.pk), (self.single_plan.pk, None)])
+
+    def test_cohort_matrix(self):
+        """Test that the cohorts retention counts the customers subscribed in each period since they joined"""
+        self.add_cohorts()
+
+        january, february = date(2026, 1, 1), date(2026, 2, 1)
+        matrix = cohort_matrix(start=january, end=date(2026, 3, 31))
+        self.assertEqual(matrix, {
+            (january, self.single_plan.pk): [1, 1, 0],
+            (january, self.plus_plan.pk): [1, 1, 1],
+            (february, self.single_plan.pk): [0, 1],
+        })
+
+        # the closed periods are cached
+        self.add_history(date(2026, 1, 2), (date(2026, 1, 2), self.plus_plan))
+        with self.assertNumQueries(0):
+            self.assertEqual(cohort_matrix(start=january, end=date(2026, 3, 31)), matrix)
+        self.assertEqual(
+            compute_cohort_matrix('month', january, date(2026, 4, 1))[(january, self.plus_plan.pk)], [2, 2, 2]
+        )
+
+    def test_churn_matrix(self):
+        """Test that the plan changes are grouped by period and transition"""
+        self.add_cohorts()
+
+        self.assertEqual(churn_matrix(start=date(2026, 1, 1), end=date(2026, 3, 31)), {
+            date(2026, 1, 1): {(None, self.single_plan.pk): 1, (None, self.plus_plan.pk): 1},
+            date(2026, 2, 1): {(self.single_plan.pk, None): 1},
+            date(2026, 3, 1): {(None, self.single_plan.pk): 1},
+        })
+        # whole weeks, the last one ends on march 1st
+        self.assertEqual(churn_matrix('week', start=date(2026, 2, 2), end=date(2026, 2, 28)), {
+            date(2026, 2, 9): {(self.single_plan.pk, None): 1},
+            date(2026, 2, 23): {(None, self.single_plan.pk): 1},
+        })
+
+    def test_period_offsets(self):
+        """Test the periods between two days"""
+        self.assertEqual(get_period_offset(date(2026, 11, 1), date(2027, 2, 15), 'month'), 3)
+        self.assertEqual(get_period_offset(date(2026, 10, 12), date(2026, 10, 26), 'week'), 2)
+        self.assertEqual(get_period_offset(date(2026, 10, 12), date(2026, 10, 13), 'day'), 1)
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.plan = mixer.blend(Plan, plan_type='plus')
+        self.new_plan = mixer.blend(Plan, plan_type='infinite')
+        self.customer = mixer.blend(Customer, subscription=None)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'events.ndjson')
+
+    def add_events(self):
+        Customer.with_subscriptions.subscribe_plan(self.customer, self.plan)
+        Customer.with_subscriptions.change_plan(self.customer, self.new_plan)
+        website = Website.objects.create(url='https://foo.bar', customer=self.customer)
+        Website.objects.bulk_register(self.customer, ['https://foo.org', 'https://foo.com'])
+        website.delete()
+        Customer.objects.filter(pk=self.customer.pk).renew()
+
+    def read_sink(self):
+        with open(self.path) as sink_file:
+            return [json.loads(line) for line in sink_file]
+
+    def test_write_paths_record_events(self):
+        """Test that the subscription and website writes record their events in the outbox"""
+        self.add_events()
+
+        events = list(OutboxEvent.objects.order_by('pk'))
+        self.assertEqual([event.event_type for event in events], [
+            'subscription.subscribed', 'subscription.plan_changed', 'website.added', 'website.added',
+            'website.added', 'website.removed', 'subscription.renewed',
+        ])
+        self.assertTrue(all(event.customer_id == self.customer.pk for event in events))
+        self.assertEqual(json.loads(events[1].payload), {
+            'customer_id': self.customer.pk, 'old_plan_id': self.plan.pk, 'plan_id': self.new_plan.pk,
+            'renewal_date': self.customer.sub_renewal_date.isoformat(),
+        })
+        self.assertEqual(json.loads(events[5].payload)['url'], 'https://foo.bar')
+        self.assertEqual(
+            json.loads(events[6].payload)['renewal_date'],
+            Customer.objects.get(pk=self.customer.pk).sub_renewal_date.isoformat(),
+        )
+
+    def test_bulk_website_writes_record_events(self):
+        """Test that the queryset website writes (detaching, moving, deleting) record their events in the outbox"""
+        Customer.with_subscriptions.subscribe_plan(self.customer, self.new_plan)
+        Website.objects.bulk_register(self.customer, ['https://foo.org', 'https://foo.com', 'https://foo.bar'])
+        Customer.with_subscriptions.change_plan(self.customer, mixer.blend(Plan, plan_type='single'))
+        OutboxEvent.objects.all().delete()
+
+        def get_events():
+            events = [
+                (event.event_type, event.customer_id, json.loads(event.payload)['url'])
+                for event in OutboxEvent.objects.order_by('pk')
+            ]
+            OutboxEvent.objects.all().delete()
+            return events
+
+        call_command('reconcile_quotas', '--policy', 'detach', stdout=StringIO())
+        self.assertEqual(get_events(), [
+            ('website.removed', self.customer.pk, 'https://foo.com'),
+            ('website.removed', self.customer.pk, 'https://foo.bar'),
+        ])
+
+        other_customer = mixer.blend(Customer, subscription=self.new_plan)
+        OutboxEvent.objects.all().delete()
+        Website.objects.filter(url__in=['https://foo.org', 'https://foo.com']).update(customer=other_customer)
+        self.assertEqual(get_events(), [
+            ('website.removed', self.customer.pk, 'https://foo.org'),
+            ('website.added', other_customer.pk, 'https://foo.org'),
+            ('website.added', other_customer.pk, 'https://foo.com'),
+        ])
+
+        other_customer.websites.all().delete()
+        self.assertEqual(get_events(), [
+            ('website.removed', other_customer.pk, 'https://foo.org'),
+            ('website.removed', other_customer.pk, 'https://foo.com'),
+        ])
+
+    def test_events_roll_back_with_their_write(self):
+        """Test that the events of a rolled back write are never published"""
+        # no subscription, no websites
+        with self.assertRaises(ObjectDoesNotExist):
+            Website.objects.create(url='https://foo.bar', customer=self.customer)
+        stale_customer = Customer(pk=self.customer.pk, subscription=self.plan)
+        with self.assertRaises(SubscriptionConflict):
+            Customer.with_subscriptions.change_plan(stale_customer, self.new_plan)
+
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_relay_to_file_sink(self):
+        """Test that the relay publishes the pending events in batches, in order, moving the sink offset"""
+        self.add_events()
+        out = StringIO()
+        call_command('relay_outbox', '--path', self.path, '--batch-size', '3', stdout=out)
+
+        event_ids = list(OutboxEvent.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertIn('Published 7 event(s) to the file sink', out.getvalue())
+        self.assertEqual([event['id'] for event in self.read_sink()], event_ids)
+        self.assertEqual(self.read_sink()[0]['type'], 'subscription.subscribed')
+        self.assertFalse(OutboxEvent.objects.filter(published__isnull=True).exists())
+        self.assertEqual(
+            DeliveryOffset.objects.values_list('sink', 'last_event_id', 'delivered').get(), ('file', event_ids[-1], 7)
+        )
+
+        # nothing is published twice
+        Customer.objects.filter(pk=self.customer.pk).renew()
+        call_command('relay_outbox', '--path', self.path, '--purge-days', '0', stdout=StringIO())
+        self.assertEqual(len(self.read_sink()), 8)
+        self.assertEqual(DeliveryOffset.objects.get().delivered, 8)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_failed_delivery_keeps_events_pending(self):
+        """Test that a batch the sink couldn't take stays pending and is published by the next run"""
+        Customer.with_subscriptions.subscribe_plan(self.customer, self.plan)
+
+        with mock.patch('urllib.request.urlopen', side_effect=urllib.error.URLError('down')):
+            with self.assertRaises(CommandError):
+                call_command('relay_outbox', '--sink', 'http', '--url', 'http://billing.test/events', stdout=StringIO())
+        self.assertTrue(OutboxEvent.objects.filter(published__isnull=True).exists())
+        self.assertFalse(DeliveryOffset.objects.exists())
+
+        response = mock.MagicMock(status=202)
+        response.__enter__.return_value = response
+        with mock.patch('urllib.request.urlopen', return_value=response) as urlopen:
+            call_command('relay_outbox', '--sink', 'http', '--url', 'http://billing.test/events', stdout=StringIO())
+
+        request = urlopen.call_args[0][0]
+        self.assertEqual(request.full_url, 'http://billing.test/events')
+        self.assertEqual([event['type'] for event in json.loads(request.data)['events']], ['subscription.subscribed'])
+        self.assertFalse(OutboxEvent.objects.filter(published__isnull=True).exists())
+        self.assertEqual(DeliveryOffset.objects.get().sink, 'http')
+
+
+@override_settings(SUBSCRIPTION_DATABASE_REPLICAS=['replica'])
+class PrimaryReplicaRouterTestCase(TransactionTestCase):
+    # the replica is a test mirror of the default database, only sharing its committed data
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.customer = mixer.blend(Customer)
+        unpin_primary()
+
+    def tearDown(self):
+        unpin_primary()
+
+    def test_reads_go_to_replicas_until_a_write(self):
+        """Test that the reads go to the replicas, and stick to the primary after a write"""
+        self.assertEqual(Customer.objects.all().db, 'replica')
+        self.assertEqual(Customer.objects.get(pk=self.customer.pk), self.customer)
+
+        Customer.objects.filter(pk=self.customer.pk).update(first_name='Foo')
+        self.assertTrue(is_primary_pinned())
+        self.assertEqual(Customer.objects.all().db, 'default')
+
+    def test_entitlements_read_from_primary(self):
+        """Test that the entitlements snapshots are built from the primary, not a (lagging) replica"""
+        cache.clear()
+        with CaptureQueriesContext(connections['replica']) as replica_queries:
+            with CaptureQueriesContext(connections['default']) as primary_queries:
+                self.assertEqual(get_entitlements(self.customer.pk).used, 0)
+        self.assertEqual(len(replica_queries), 0)
+        self.assertEqual(len(primary_queries), 1)
+        self.assertFalse(is_primary_pinned())
+
+    def test_bulk_writes_go_to_primary(self):
+        """Test that the queryset write paths read, write and record their side effects only on the primary"""
+        plan = Plan.objects.create(name='Plus', price=Decimal('99.00'), plan_type='plus')
+        other_plan = Plan.objects.create(name='Infinite', price=Decimal('199.00'), plan_type='infinite')
+        Customer.objects.filter(pk=self.customer.pk).update(subscription=plan, sub_renewal_date=date(2020, 1, 1))
+        other_customer = mixer.blend(Customer, subscription=plan)
+        Website.objects.bulk_register(self.customer, ['https://example.com', 'https://example.org'])
+
+        writes = (
+            lambda: Website.objects.filter(url='https://example.com').update(url='https://example.net'),
+            lambda: Website.objects.filter(url='https://example.net').update(customer=other_customer),
+            lambda: Website.objects.filter(url='https://example.org').delete(),
+            lambda: Customer.objects.filter(pk=self.customer.pk).renew(),
+            lambda: Customer.objects.filter(pk=self.customer.pk).change_plan(other_plan),
+            lambda: Customer.objects.filter(pk=other_customer.pk).detach_excess_websites(),
+        )
+        for write in writes:
+            unpin_primary()
+            with CaptureQueriesContext(connections['replica']) as replica_queries:
+                write()
+            self.assertEqual([query['sql'] for query in replica_queries], [])
+
+        self.assertEqual(Customer.objects.using('default').get(pk=other_customer.pk).websites_count, 1)
+        self.assertEqual(
+            OutboxEvent.objects.using('default').filter(event_type='website.removed').count(), 2
+        )
+
+    def test_locking_reads_go_to_primary(self):
+        """Test that the select_for_update reads go to the primary"""
+        self.assertEqual(Customer.objects.select_for_update().db, 'default')
+
+    def test_pinning_middleware(self):
+        """Test that the requests that wrote pin the following ones to the primary, through a cookie"""
+        def write_view(request):
+            Customer.objects.filter(pk=self.customer.pk).update(first_name='Foo')
+            return HttpResponse()
+
+        def read_view(request):
+            return HttpResponse(Customer.objects.all().db)
+
+        request = RequestFactory().get('/')
+        response = PrimaryPinningMiddleware(read_view)(request)
+        self.assertEqual(response.content, b'replica')
+        self.assertNotIn(PrimaryPinningMiddleware.cookie_name, response.cookies)
+
+        response = PrimaryPinningMiddleware(write_view)(RequestFactory().post('/'))
+        self.assertIn(PrimaryPinningMiddleware.cookie_name, response.cookies)
+        self.assertFalse(is_primary_pinned())
+
+        request.COOKIES[PrimaryPinningMiddleware.cookie_name] = '1'
+        self.assertEqual(PrimaryPinningMiddleware(read_view)(request).content, b'default')
+
+    def test_pinning_scope(self):
+        """Test that the pinning of the writes outside the requests can be scoped to a block"""
+        with primary_pinning():
+            Customer.objects.filter(pk=self.customer.pk).update(first_name='Foo')
+            self.assertEqual(Customer.objects.all().db, 'default')
+        self.assertFalse(is_primary_pinned())
+        self.assertEqual(Customer.objects.all().db, 'replica')
+
+    @override_settings(SUBSCRIPTION_DATABASE_REPLICAS=[])
+    def test_no_pinning_without_replicas(self):
+        """Test that without replicas the writes pin nothing, and the requests get no cookie"""
+        Customer.objects.filter(pk=self.customer.pk).update(first_name='Foo')
+        self.assertFalse(is_primary_pinned())
+        with self.assertRaises(MiddlewareNotUsed):
+            PrimaryPinningMiddleware(lambda request: HttpResponse())
+
+        self.customer.set_password('secret')
+        self.customer.is_staff = True
+        self.customer.save()
+        response = Client().post(reverse('admin:login'), {'username': self.customer.username, 'password': 'secret'})
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(PrimaryPinningMiddleware.cookie_name, response.cookies)
+
+
+@override_settings(SUBSCRIPTION_SHARDS=['shard_1', 'shard_2'])
+class ShardingTestCase(TransactionTestCase):
+    databases = {'default', 'shard_1', 'shard_2'}
+
+    def setUp(self):
+        self.plan = Plan.objects.create(name='Single', price=Decimal('49.00'), plan_type='single')
+        self.plus_plan = Plan.objects.create(name='Plus', price=Decimal('99.00'), plan_type='plus')
+
+    def create_customers(self, total, plan=None):
+        customers = [Customer(username='customer{}'.format(number), subscription=plan) for number in range(total)]
+        for customer in customers:
+            customer.save()
+        return customers
+
+    def test_placement(self):
+        """Test that the customers placement is stable, spread, and only moves to an appended shard"""
+        shards = [get_shard(customer_id) for customer_id in range(1, 201)]
+        self.assertEqual(shards, [get_shard(customer_id) for customer_id in range(1, 201)])
+        self.assertEqual(set(shards), {'shard_1', 'shard_2'})
+
+        for key in range(1000):
+            bucket = jump_hash(key, 3)
+            self.assertIn(bucket, (jump_hash(key, 2), 2))
+
+    def test_customers_and_websites_live_in_their_shard(self):
+        """Test that the customers, their websites and the quota checks go to the customer shard"""
+        customers = self.create_customers(10, plan=self.plan)
+        self.assertEqual(len({customer.pk for customer in customers}), 10)
+        self.assertFalse(Customer.objects.using('default').exists())
+
+        customer = customers[0]
+        shard = get_shard(customer.pk)
+        self.assertEqual(customer._state.db, shard)
+        self.assertTrue(Customer.objects.on_shard(customer.pk).filter(pk=customer.pk).exists())
+
+        website = Website.objects.create(url='https://example.com', customer=customer)
+        self.assertEqual(website._state.db, shard)
+        self.assertEqual(customer.websites.get(), website)
+        self.assertEqual(Customer.objects.on_shard(customer.pk).get(pk=customer.pk).websites_count, 1)
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            Website.objects.create(url='https://example.org', customer=customer)
+
+        Customer.with_subscriptions.change_plan(customer, self.plus_plan)
+        self.assertEqual(Customer.objects.on_shard(customer.pk).get(pk=customer.pk).subscription_id, self.plus_plan.pk)
+        self.assertEqual(Website.objects.bulk_register(customer, ['https://example.org'])[0].customer_id, customer.pk)
+        self.assertEqual(customer.get_entitlements().used, 2)
+
+        counts = scatter_gather(lambda shard: Customer.objects.using(shard).count())
+        self.assertEqual(sum(counts), 10)
+        # the rollups of every shard are summed
+        self.assertEqual(get_snapshot()[self.plan.pk]['customers'], 9)
+        self.assertEqual(get_snapshot()[self.plus_plan.pk], {'customers': 1, 'websites': 2, 'revenue': Decimal('99')})
+
+    def test_seeding(self):
+        """Test that the seeded customers go to their shards, with ids unique across them"""
+        customers, websites = seed_subscriptions(40, seed=1)
+
+        for shard in ('shard_1', 'shard_2'):
+            customer_ids = list(Customer.objects.using(shard).values_list('pk', flat=True))
+            self.assertTrue(customer_ids)
+            self.assertTrue(all(get_shard(customer_id) == shard for customer_id in customer_ids))
+            self.assertFalse(Customer.objects.using(shard).with_websites_count_drift().exists())
+        self.assertEqual(sum(scatter_gather(lambda shard: Customer.objects.using(shard).count())), customers)
+        self.assertEqual(sum(scatter_gather(lambda shard: Website.objects.using(shard).count())), websites)
+        self.assertFalse(Customer.objects.using('default').exists())
+        subscribed = scatter_gather(lambda shard: Customer.with_subscriptions.using(shard).count())
+        self.assertEqual(sum(plan['customers'] for plan in get_snapshot().values()), sum(subscribed))
+
+    @override_settings(SUBSCRIPTION_TTL_DAYS=30)
+    def test_process_renewals_command(self):
+        """Test that the renewals are processed in every shard, and resumed in the shard of the checkpoint"""
+        customers = self.create_customers(10, plan=self.plan)
+        Customer.objects.using('shard_1').update(sub_renewal_date=date(2020, 1, 10))
+        Customer.objects.using('shard_2').update(sub_renewal_date=date(2020, 1, 10))
+
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'renewals.json')
+        with open(checkpoint, 'w') as checkpoint_file:
+            json.dump({'date': '2020-01-31', 'position': {
+                'database': 'shard_2', 'renewal_date': '2020-01-01', 'pk': 0,
+            }}, checkpoint_file)
+        call_command('process_renewals', date='2020-01-31', checkpoint=checkpoint, stdout=StringIO())
+        self.assertEqual(set(Customer.objects.using('shard_1').values_list('sub_renewal_date', flat=True)), {
+            date(2020, 1, 10)
+        })
+        self.assertEqual(set(Customer.objects.using('shard_2').values_list('sub_renewal_date', flat=True)), {
+            date(2020, 2, 9)
+        })
+
+        call_command('process_renewals', date='2020-01-31', chunk_size=3, stdout=StringIO())
+        for customer in customers:
+            customer = Customer.objects.on_shard(customer.pk).get(pk=customer.pk)
+            self.assertEqual(customer.sub_renewal_date, date(2020, 2, 9))
+
+    def test_rebuild_websites_count_command(self):
+        """Test that the websites counters drifted in every shard are reported and rebuilt"""
+        customers = self.create_customers(10, plan=self.plus_plan)
+        for customer in customers:
+            Website.objects.create(url='https://example.com', customer=customer)
+        for shard in ('shard_1', 'shard_2'):
+            Customer.objects.using(shard).update(websites_count=3)
+
+        with self.assertRaisesMessage(CommandError, '10 customer(s)'):
+            call_command('rebuild_websites_count', check=True, stdout=StringIO())
+
+        call_command('rebuild_websites_count', stdout=StringIO())
+        for shard in ('shard_1', 'shard_2'):
+            self.assertEqual(set(Customer.objects.using(shard).values_list('websites_count', flat=True)), {1})
+        call_command('rebuild_websites_count', check=True, stdout=StringIO())
+
+    @override_settings(AUTHENTICATION_BACKENDS=['subscription.backends.ShardedModelBackend'])
+    def test_admin(self):
+        """Test that the admin lists a shard at a time, and finds the customers and websites in theirs"""
+        customers = self.create_customers(10, plan=self.plus_plan)
+        for customer in customers:
+            Website.objects.create(url='https://example.com', customer=customer)
+        client = Client()
+        client.force_login(Customer.objects.create_superuser('admin', 'admin@foo.bar', 'admin'))
+        customer = next(customer for customer in customers if get_shard(customer.pk) == 'shard_2')
+
+        url = reverse('admin:subscription_customer_changelist')
+        response = client.get(url)
+        self.assertEqual(response.context['cl'].result_count, Customer.objects.using('shard_1').count())
+        response = client.get(url, {'shard': 'shard_2', 'plan_type': 'plus'})
+        subscribed = Customer.objects.using('shard_2').filter(subscription=self.plus_plan)
+        self.assertEqual(response.context['cl'].result_count, subscribed.count())
+
+        response = client.get(reverse('admin:subscription_customer_change', args=[customer.pk]))
+        self.assertEqual(response.context['original'], customer)
+
+        website = Website.objects.on_shard(customer.pk).get(customer=customer)
+        url = reverse('admin:subscription_website_changelist')
+        response = client.get(url, {'shard': 'shard_2'})
+        self.assertEqual(response.context['cl'].result_count, Website.objects.using('shard_2').count())
+        response = client.get(
+            reverse('admin:subscription_website_change', args=[website.pk]), {'_changelist_filters': 'shard=shard_2'}
+        )
+        self.assertEqual(response.context['original'], website)
+        self.assertEqual(response.context['original']._state.db, 'shard_2')
+
+    def test_authentication_backend(self):
+        """Test that the authentication backend finds the customers in their shard"""
+        customer = self.create_customers(1)[0]
+        customer.set_password('secret')
+        customer.save()
+
+        backend = ShardedModelBackend()
+        self.assertEqual(backend.authenticate(None, username=customer.username, password='secret'), customer)
+        self.assertIsNone(backend.authenticate(None, username=customer.username, password='wrong'))
+        self.assertEqual(backend.get_user(customer.pk), customer)
+
+    def test_rebalance_command(self):
+        """Test that the rebalance command moves the customers to the shard they hash to"""
+        with override_settings(SUBSCRIPTION_SHARDS=['shard_1']):
+            customers = self.create_customers(20, plan=self.plus_plan)
+            for customer in customers:
+                Website.objects.create(url='https://example.com', customer=customer)
+                Website.objects.create(url='https://example.org', customer=customer)
+                Website.objects.create(url='https://example.net', customer=customer).delete()
+        moved = [customer.pk for customer in customers if get_shard(customer.pk) == 'shard_2']
+        self.assertTrue(moved)
+
+        out = StringIO()
+        call_command('rebalance_shards', '--dry-run', stdout=out)
+        self.assertIn('Would move {} customer(s)'.format(len(moved)), out.getvalue())
+        self.assertFalse(Customer.objects.using('shard_2').exists())
+
+        call_command('rebalance_shards', stdout=StringIO())
+        self.assertEqual(set(Customer.objects.using('shard_2').values_list('pk', flat=True)), set(moved))
+        self.assertEqual(Customer.objects.using('shard_1').count(), 20 - len(moved))
+        self.assertEqual(Website.objects.on_shard(moved[0]).filter(customer_id=moved[0]).count(), 2)
+        self.assertEqual(Customer.objects.on_shard(moved[0]).get(pk=moved[0]).websites_count, 2)
+        self.assertFalse(Customer.objects.using('shard_2').with_websites_count_drift().exists())
+        self.assertEqual(
+            get_snapshot()[self.plus_plan.pk], {'customers': 20, 'websites': 40, 'revenue': Decimal('1980')}
+        )
+
+        # a move isn't a cancellation, the history and the pending events go along with the customer
+        for shard in ('shard_1', 'shard_2'):
+            self.assertFalse(SubscriptionChange.objects.using(shard).filter(new_plan=None).exists())
+            self.assertFalse(OutboxEvent.objects.using(shard).filter(event_type='subscription.cancelled').exists())
+        self.assertFalse(SubscriptionChange.objects.using('shard_1').filter(customer_id__in=moved).exists())
+        self.assertFalse(OutboxEvent.objects.using('shard_1').filter(customer_id__in=moved).exists())
+        self.assertEqual(
+            list(SubscriptionChange.objects.using('shard_2').filter(customer_id=moved[0]).values_list(
+                'old_plan_id', 'new_plan_id'
+            )), [(None, self.plus_plan.pk)]
+        )
+        self.assertEqual(
+            sorted(OutboxEvent.objects.using('shard_2').filter(customer_id=moved[0]).values_list(
+                'event_type', flat=True
+            )), ['subscription.subscribed', 'website.added', 'website.added', 'website.added', 'website.removed']
+        )
+        # the moved websites got new ids, which their events follow
+        website_ids = dict(Website.objects.using('shard_2').filter(customer_id=moved[0]).values_list('url', 'pk'))
+        payloads = [json.loads(payload) for payload in OutboxEvent.objects.using('shard_2').filter(
+            customer_id=moved[0], event_type__startswith='website.'
+        ).values_list('payload', flat=True)]
+        self.assertEqual(
+            sorted((payload['url'], payload['website_id']) for payload in payloads), sorted([
+                ('https://example.com', website_ids['https://example.com']), ('https://example.net', None),
+                ('https://example.net', None), ('https://example.org', website_ids['https://example.org']),
+            ])
+        )
+
+
+class WebsiteQuotaConcurrencyTestCase(TransactionTestCase):
+    def setUp(self):
+        self.plan = mixer.blend(Plan, plan_type='plus')
+        self.customer = mixer.blend(Customer, subscription=self.plan)
+        # another customer on the same plan, its rollup writes go to another slot row
+        self.other_customer = mixer.blend(Customer, subscription=self.plan)
+        rebuild_rollups()
+
+    def test_quota_holds_under_concurrent_writers(self):
+        """Test that concurrent website writes for two customers of a plan never exceed the plan limit"""
+        TOTAL_THREADS = 8
+        WEBSITES_PER_THREAD = 3
+        start = threading.Barrier(TOTAL_THREADS)
+        outcomes = []
+
+        def add_websites(thread_number):
+            start.wait()
+            try:
+                for number in range(WEBSITES_PER_THREAD):
+                    customer_id = (self.customer.pk, self.other_customer.pk)[(thread_number + number) % 2]
+                    customer = Customer.objects.get(pk=customer_id)
+                    try:
+                        Website.objects.create(
+                            url='https://foo{}-{}.bar'.format(thread_number, number), customer=customer
+                        )
+                        outcomes.append(True)
+                    except CustomerAddWebsitePermissionDenied:
+                        outcomes.append(False)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add_websites, args=(number,)) for number in range(TOTAL_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(outcomes), TOTAL_THREADS * WEBSITES_PER_THREAD)
+        self.assertEqual(outcomes.count(True), 6)
+        for customer in (self.customer, self.other_customer):
+            self.assertEqual(Website.objects.filter(customer=customer).count(), 3)
+            customer.refresh_from_db()
+            self.assertEqual(customer.websites_count, 3)
+
+        self.assertEqual(get_snapshot()[self.plan.pk]['websites'], 6)
+        slots = {get_rollup_slot(self.customer.pk), get_rollup_slot(self.other_customer.pk)}
+        self.assertEqual(len(slots), 2)
+        self.assertEqual(set(PlanDailyRollup.objects.filter(
+            plan=self.plan, day=timezone.localdate(), websites=3
+        ).values_list('slot', flat=True)), slots)
+
+    def test_same_plan_writers_dont_serialize(self):
+        """Test that a website write doesn't wait for an open one of another customer on the same plan"""
+        if connection.vendor == 'sqlite':
+            raise unittest.SkipTest('sqlite locks the whole database for a write transaction')
+        first_written, second_written = threading.Event(), threading.Event()
+        outcomes = []
+
+        def write_first():
+            try:
+                with transaction.atomic():
+                    Website.objects.create(url='https://foo.bar', customer=Customer.objects.get(pk=self.customer.pk))
+                    first_written.set()
+                    # still holding the locks of its write
+                    outcomes.append(second_written.wait(timeout=5))
+            finally:
+                connection.close()
+
+        def write_second():
+            try:
+                first_written.wait(timeout=5)
+                Website.objects.create(
+                    url='https://foo.org', customer=Customer.objects.get(pk=self.other_customer.pk)
+                )
+                second_written.set()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write_first), threading.Thread(target=write_second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outcomes, [True])
+        self.assertEqual(get_snapshot()[self.plan.pk]['websites'], 2)
+
+    def test_website_without_subscription(self):
+        """Test that adding a website to a customer without subscription keeps raising ObjectDoesNotExist"""
+        customer = mixer.blend(Customer)
+
+        with self.assertRaises(ObjectDoesNotExist):
+            Website.objects.create(url='https://foo.bar', customer=customer)
+        self.assertFalse(Website.objects.exists())
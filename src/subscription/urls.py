@@ -0,0 +1,15 @@
+from django.urls import path
+
+from . import views
+
+app_name = 'subscription'
+
+urlpatterns = [
+    path('metrics/', views.metrics, name='metrics'),
+    path('export/', views.export, name='export'),
+    path('customers/', views.customer_list, name='customer-list'),
+    path('customers/<int:customer_id>/', views.customer_detail, name='customer-detail'),
+    path('customers/<int:customer_id>/websites/', views.customer_websites, name='customer-websites'),
+    path('customers/<int:customer_id>/subscribe/', views.customer_subscribe, name='customer-subscribe'),
+    path('customers/<int:customer_id>/change-plan/', views.customer_change_plan, name='customer-change-plan'),
+]
@@ -1,5 +1,7 @@
 import datetime
 
+from django.conf import settings
+
 def get_year_total_days(year=None):
     """Util function that calculates the total days a year have."""
 
@@ -11,4 +13,9 @@ def get_year_total_days(year=None):
 
     # needs to add one more day so we get 365/366 results
     return (last_day_year - first_day_year).days + 1
- 
\ No newline at end of file
+ 
+
+def get_renewal_date(start_date):
+    """Util function that calculates when a subscription starting (or renewed) on the given date must be renewed."""
+    sub_ttl_days = getattr(settings, 'SUBSCRIPTION_TTL_DAYS', get_year_total_days(start_date.year + 1))
+    return start_date + datetime.timedelta(days=sub_ttl_days)
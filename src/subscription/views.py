@@ -1,3 +1,286 @@
-from django.shortcuts import render
+import hashlib
+import json
+from functools import wraps
 
-# Create your views here.
+from django.conf import settings
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse,
+)
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.crypto import constant_time_compare
+from django.utils.http import quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_GET, require_POST
+
+from .exceptions import InvalidCursor, SubscriptionConflict
+from .exports import CONTENT_TYPES, CSV_FORMAT, FORMATS, export_rows, get_export_columns, stream_export
+from .loaders import get_loaders
+from .metrics import aggregator
+from .models import Customer, Plan
+from .pagination import customer_keyset, website_keyset
+from .registry import plan_registry
+
+
+def is_authorized(request, token):
+    """
+    Whether the request has `Authorization: Bearer <token>`, for scripted clients,
+    without a token configured only the staff users are authorized.
+    """
+    if token:
+        return constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer {}'.format(token))
+    return request.user.is_staff
+
+
+@require_GET
+def metrics(request):
+    """
+    Plain text metrics of the subscription operations, for scrapers.
+
+    Scrapers authenticate with `Authorization: Bearer <settings.SUBSCRIPTION_METRICS_TOKEN>`,
+    without a token configured only the staff users can read them.
+    """
+    if not is_authorized(request, getattr(settings, 'SUBSCRIPTION_METRICS_TOKEN', None)):
+        return HttpResponseForbidden()
+
+    return HttpResponse(aggregator.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@require_GET
+def export(request):
+    """
+    Streams every customer with its plan, renewal date and websites count, as CSV (default) or NDJSON
+    (`?format=ndjson`), and their websites urls with `?websites=1`, see exports.export_rows().
+
+    Authenticated like the metrics view, with settings.SUBSCRIPTION_EXPORT_TOKEN.
+    """
+    if not is_authorized(request, getattr(settings, 'SUBSCRIPTION_EXPORT_TOKEN', None)):
+        return HttpResponseForbidden()
+
+    export_format = request.GET.get('format', CSV_FORMAT)
+    if export_format not in FORMATS:
+        return HttpResponseBadRequest('Unknown export format ({})'.format(export_format))
+
+    websites = request.GET.get('websites') == '1'
+    response = StreamingHttpResponse(
+        stream_export(export_rows(websites=websites), export_format, get_export_columns(websites)),
+        content_type=CONTENT_TYPES[export_format],
+    )
+    response['Content-Disposition'] = 'attachment; filename="subscriptions.{}"'.format(export_format)
+    return response
+
+
+def api_view(view):
+    """
+    Authorizes the subscription API views: with `Authorization: Bearer <settings.SUBSCRIPTION_API_TOKEN>`
+    for the other services, otherwise the staff users or the customer itself, through their session.
+    The customers can only read (the plan changes go through billing), and the staff unsafe requests
+    need the CSRF token as usual.
+    """
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, customer_id, *args, **kwargs):
+        token = getattr(settings, 'SUBSCRIPTION_API_TOKEN', None)
+        if not (token and is_authorized(request, token)):
+            safe = request.method in ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+            if not (request.user.is_staff or (safe and request.user.pk == customer_id)):
+                return HttpResponseForbidden()
+            if not safe:
+                rejected = CsrfViewMiddleware().process_view(request, None, (), {})
+                if rejected is not None:
+                    return rejected
+
+        return view(request, customer_id, *args, **kwargs)
+
+    return wrapper
+
+
+def get_customer_stamp(request, customer_id):
+    """
+    The customer (modified, subscription_id) version stamp, read once per request: a single indexed row
+    read, which is all the conditional requests need (the websites table isn't touched).
+    """
+    stamps = request.__dict__.setdefault('_subscription_customer_stamps', {})
+    if customer_id not in stamps:
+        stamps[customer_id] = Customer.objects.on_shard(customer_id).filter(pk=customer_id).values_list(
+            'modified', 'subscription_id'
+        ).first()
+    return stamps[customer_id]
+
+
+def get_customer_etag(customer_id, modified, subscription_id):
+    # the plan comes from the registry, so the plans edits change the etag as well, without a query
+    plan = plan_registry.get(subscription_id) if subscription_id else None
+    plan_key = plan and (plan.pk, plan.name, str(plan.price), plan.plan_type, plan.total_websites_allowed)
+    return hashlib.md5(repr((customer_id, modified.isoformat(), plan_key)).encode()).hexdigest()
+
+
+def customer_etag(request, customer_id, *args, **kwargs):
+    stamp = get_customer_stamp(request, customer_id)
+    return get_customer_etag(customer_id, *stamp) if stamp else None
+
+
+def customer_last_modified(request, customer_id, *args, **kwargs):
+    stamp = get_customer_stamp(request, customer_id)
+    return stamp[0] if stamp else None
+
+
+def get_customer(customer_id):
+    customer = Customer.objects.on_shard(customer_id).filter(pk=customer_id).first()
+    if customer is None:
+        raise Http404('No such customer')
+    return customer
+
+
+def serialize_plan(plan):
+    return {
+        'id': plan.pk, 'name': plan.name, 'plan_type': plan.plan_type, 'price': str(plan.price),
+        'total_websites_allowed': plan.total_websites_allowed,
+    }
+
+
+def get_per_page(request):
+    """The `per_page` request parameter, up to 100, raising ValueError when it isn't a number."""
+    return min(max(int(request.GET.get('per_page', 100)), 1), 100)
+
+
+def serialize_website(website):
+    return {'id': website.pk, 'url': website.url}
+
+
+def serialize_customer(customer):
+    plan = customer.plan
+    # None for the unlimited plans (and without subscription)
+    allowed = (plan.total_websites_allowed or None) if plan else None
+
+    return {
+        'id': customer.pk,
+        'username': customer.username,
+        'plan': serialize_plan(plan) if plan else None,
+        'renewal_date': customer.sub_renewal_date,
+        'websites': {
+            'used': customer.websites_count,
+            'allowed': allowed,
+            'remaining': max(allowed - customer.websites_count, 0) if allowed else None,
+        },
+    }
+
+
+def customer_response(customer, status=200):
+    response = JsonResponse(serialize_customer(customer), status=status)
+    response['ETag'] = quote_etag(get_customer_etag(customer.pk, customer.modified, customer.subscription_id))
+    return response
+
+
+@require_GET
+def customer_list(request):
+    """
+    The customers (as in customer_detail()), newest first in keyset pages (`?cursor=<next_cursor>&per_page=<up
+    to 100>`), with their websites with `?websites=1`. The plans and websites of a page are batch loaded (see
+    loaders.SubscriptionLoaders), so a page costs the same number of queries whatever its size.
+    Only for the other services and the staff users.
+    """
+    if not (is_authorized(request, getattr(settings, 'SUBSCRIPTION_API_TOKEN', None)) or request.user.is_staff):
+        return HttpResponseForbidden()
+
+    try:
+        per_page = get_per_page(request)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid per_page ({})'.format(request.GET['per_page']))
+
+    try:
+        page = customer_keyset(per_page=per_page).get_page(request.GET.get('cursor'))
+    except InvalidCursor as error:
+        return HttpResponseBadRequest(str(error))
+
+    websites = request.GET.get('websites') == '1'
+    results = []
+    for customer in get_loaders(request).prime_customers(page.object_list, websites=websites):
+        result = serialize_customer(customer)
+        if websites:
+            result['websites']['items'] = [serialize_website(website) for website in customer.websites.all()]
+        results.append(result)
+
+    return JsonResponse({'results': results, 'next_cursor': page.next_cursor})
+
+
+@require_GET
+@api_view
+@condition(etag_func=customer_etag, last_modified_func=customer_last_modified)
+def customer_detail(request, customer_id):
+    """The customer plan, renewal date and websites quota usage."""
+    return JsonResponse(serialize_customer(get_customer(customer_id)))
+
+
+@require_GET
+@api_view
+@condition(etag_func=customer_etag, last_modified_func=customer_last_modified)
+def customer_websites(request, customer_id):
+    """The customer websites by id, in keyset pages (`?cursor=<next_cursor>&per_page=<up to 100>`)."""
+    try:
+        per_page = get_per_page(request)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid per_page ({})'.format(request.GET['per_page']))
+
+    paginator = website_keyset(get_customer(customer_id), per_page=per_page)
+    try:
+        page = paginator.get_page(request.GET.get('cursor'))
+    except InvalidCursor as error:
+        return HttpResponseBadRequest(str(error))
+
+    return JsonResponse({
+        'results': [serialize_website(website) for website in page.object_list],
+        'next_cursor': page.next_cursor,
+    })
+
+
+def get_request_plan(request):
+    """The plan of the JSON request body (`{"plan": <id>}`), None when there's no such plan."""
+    try:
+        plan_id = int(json.loads(request.body.decode() or '{}').get('plan'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    try:
+        return plan_registry.get(plan_id)
+    except Plan.DoesNotExist:
+        return None
+
+
+@require_POST
+@api_view
+@condition(etag_func=customer_etag, last_modified_func=customer_last_modified)
+def customer_subscribe(request, customer_id):
+    """Subscribes the customer to the plan in the request body, the preconditions (If-Match) are honored."""
+    plan = get_request_plan(request)
+    if plan is None:
+        return HttpResponseBadRequest('Invalid plan')
+
+    customer = get_customer(customer_id)
+    try:
+        Customer.with_subscriptions.subscribe_plan(customer, plan)
+    except SubscriptionConflict as error:
+        return JsonResponse({'error': str(error)}, status=409)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    return customer_response(customer)
+
+
+@require_POST
+@api_view
+@condition(etag_func=customer_etag, last_modified_func=customer_last_modified)
+def customer_change_plan(request, customer_id):
+    """Moves the customer to the plan in the request body, the preconditions (If-Match) are honored."""
+    plan = get_request_plan(request)
+    if plan is None:
+        return HttpResponseBadRequest('Invalid plan')
+
+    customer = get_customer(customer_id)
+    try:
+        Customer.with_subscriptions.change_plan(customer, plan)
+    except SubscriptionConflict as error:
+        return JsonResponse({'error': str(error)}, status=409)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    return customer_response(customer)